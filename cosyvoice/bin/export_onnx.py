@@ -41,12 +41,75 @@ def get_dummy_input(batch_size, seq_len, out_channels, device):
     return x, mask, mu, t, spks, cond
 
 
+def get_hift_dummy_input(hift, seq_len, device):
+    # conv_pre output and source stft of a random mel, the inputs of HiFTGenerator.decode_body
+    speech_feat = torch.rand((1, 80, seq_len), dtype=torch.float32, device=device)
+    s = hift.f0_upsamp(hift.f0_predictor(speech_feat)[:, None]).transpose(1, 2)
+    s, _, _ = hift.m_source(s)
+    s_stft_real, s_stft_imag = hift._stft(s.transpose(1, 2).squeeze(1))
+    return hift.conv_pre(speech_feat), torch.cat([s_stft_real, s_stft_imag], dim=1)
+
+
+class HiFTDecodeBody(torch.nn.Module):
+    def __init__(self, hift):
+        super().__init__()
+        self.hift = hift
+
+    def forward(self, x, s_stft):
+        return self.hift.decode_body(x, s_stft)
+
+
+def export(module, inputs, onnx_model, input_names, output_names, dynamic_axes):
+    torch.onnx.export(
+        module,
+        inputs,
+        onnx_model,
+        export_params=True,
+        opset_version=18,
+        do_constant_folding=True,
+        input_names=input_names,
+        output_names=output_names,
+        dynamic_axes=dynamic_axes
+    )
+
+
+def check(module, onnx_model, get_input, device, rtol=1e-2, atol=1e-4):
+    option = onnxruntime.SessionOptions()
+    option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    option.intra_op_num_threads = 1
+    session = onnxruntime.InferenceSession(onnx_model, sess_options=option, providers=['CPUExecutionProvider'])
+    input_names = [i.name for i in session.get_inputs()]
+    for _ in tqdm(range(10)):
+        inputs = get_input(random.randint(16, 512))
+        output_pytorch = module(*inputs)
+        output_onnx = session.run(None, dict(zip(input_names, [i.cpu().numpy() for i in inputs])))[0]
+        torch.testing.assert_allclose(output_pytorch, torch.from_numpy(output_onnx).to(device), rtol=rtol, atol=atol)
+
+
+def quantize(onnx_model, op_types):
+    # NOTE dynamic quantization, weights are int8 and activations are quantized per run, no calibration data needed
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    int8_model = onnx_model.replace('.fp32.onnx', '.int8.onnx')
+    quantize_dynamic(onnx_model, int8_model, op_types_to_quantize=op_types, weight_type=QuantType.QInt8)
+    logging.info('successfully quantize {} to {}'.format(onnx_model, int8_model))
+
+
 def get_args():
     parser = argparse.ArgumentParser(description='export your model for deployment')
     parser.add_argument('--model_dir',
                         type=str,
                         default='pretrained_models/CosyVoice-300M',
                         help='local path')
+    parser.add_argument('--cpu',
+                        action='store_true',
+                        help='also export hift decode body and flow pre lookahead layer for the onnx cpu profile')
+    parser.add_argument('--int8',
+                        action='store_true',
+                        help='also write dynamic int8 quantized *.int8.onnx of the exported models')
+    parser.add_argument('--int8_ops',
+                        type=str,
+                        default='MatMul,Gemm',
+                        help='comma separated op types to quantize, add Conv to quantize hift and pre lookahead convs')
     args = parser.parse_args()
     print(args)
     return args
@@ -108,6 +171,36 @@ def main():
         output_onnx = estimator_onnx.run(None, ort_inputs)[0]
         torch.testing.assert_allclose(output_pytorch, torch.from_numpy(output_onnx).to(device), rtol=1e-2, atol=1e-4)
     logging.info('successfully export estimator')
+    if args.cpu is False:
+        if args.int8 is True:
+            quantize('{}/flow.decoder.estimator.fp32.onnx'.format(args.model_dir), args.int8_ops.split(','))
+        return
+
+    # 3. export hift decode body, f0 predictor, source and stft stay in torch
+    hift = HiFTDecodeBody(model.model.hift).eval()
+    export(hift, get_hift_dummy_input(model.model.hift, seq_len, device), '{}/hift.decode_body.fp32.onnx'.format(args.model_dir),
+           ['x', 's_stft'], ['decode_body_out'], {'x': {2: 'seq_len'}, 's_stft': {2: 'stft_len'}, 'decode_body_out': {2: 'out_len'}})
+    check(hift, '{}/hift.decode_body.fp32.onnx'.format(args.model_dir), lambda i: get_hift_dummy_input(model.model.hift, i, device), device)
+    logging.info('successfully export hift decode body')
+    onnx_models = ['{}/flow.decoder.estimator.fp32.onnx'.format(args.model_dir), '{}/hift.decode_body.fp32.onnx'.format(args.model_dir)]
+
+    # 4. export flow pre lookahead layer, CosyVoice3 only, the conformer encoder of CosyVoice/CosyVoice2 stays in torch
+    if hasattr(model.model.flow, 'pre_lookahead_layer'):
+        pre_lookahead_layer = model.model.flow.pre_lookahead_layer
+        channels, context_len = pre_lookahead_layer.in_channels, pre_lookahead_layer.pre_lookahead_len
+
+        def get_pre_lookahead_input(i):
+            return (torch.rand((1, i, channels), dtype=torch.float32, device=device),
+                    torch.rand((1, context_len, channels), dtype=torch.float32, device=device))
+        export(pre_lookahead_layer, get_pre_lookahead_input(seq_len), '{}/flow.pre_lookahead_layer.fp32.onnx'.format(args.model_dir),
+               ['inputs', 'context'], ['pre_lookahead_layer_out'], {'inputs': {1: 'seq_len'}, 'pre_lookahead_layer_out': {1: 'seq_len'}})
+        check(pre_lookahead_layer, '{}/flow.pre_lookahead_layer.fp32.onnx'.format(args.model_dir), get_pre_lookahead_input, device)
+        logging.info('successfully export pre lookahead layer')
+        onnx_models.append('{}/flow.pre_lookahead_layer.fp32.onnx'.format(args.model_dir))
+
+    if args.int8 is True:
+        for onnx_model in onnx_models:
+            quantize(onnx_model, args.int8_ops.split(','))
 
 
 if __name__ == "__main__":
@@ -12,7 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
+import queue
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import Generator
 from tqdm import tqdm
 from hyperpyyaml import load_hyperpyyaml
@@ -20,6 +25,7 @@ from modelscope import snapshot_download
 import torch
 from cosyvoice.cli.frontend import CosyVoiceFrontEnd
 from cosyvoice.cli.model import CosyVoiceModel, CosyVoice2Model, CosyVoice3Model
+from cosyvoice.utils.common import Crossfader
 from cosyvoice.utils.file_utils import logging
 from cosyvoice.utils.class_utils import get_model_type
 try:
@@ -31,7 +37,9 @@ except Exception:
 
 class CosyVoice:
 
-    def __init__(self, model_dir, load_jit=False, load_trt=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_jit=False, load_trt=False, fp16=False, trt_concurrent=1, onnx_concurrent=1, onnx_num_threads=1,
+                 load_onnx_cpu=False, onnx_cpu_int8=False, load_static_decode=False, onnx_cpu_num_threads=0,
+                 pipeline_workers=0, components=None):
         self.model_dir = model_dir
         self.fp16 = fp16
         if not os.path.exists(model_dir):
@@ -39,20 +47,27 @@ class CosyVoice:
         hyper_yaml_path = '{}/cosyvoice.yaml'.format(model_dir)
         if not os.path.exists(hyper_yaml_path):
             raise ValueError('{} not found!'.format(hyper_yaml_path))
-        with open(hyper_yaml_path, 'r') as f:
-            configs = load_hyperpyyaml(f)
+        configs = self._load_configs(hyper_yaml_path, components)
         assert get_model_type(configs) == CosyVoiceModel, 'do not use {} for CosyVoice initialization!'.format(model_dir)
         self.frontend = CosyVoiceFrontEnd(configs['get_tokenizer'],
                                           configs['feat_extractor'],
                                           '{}/campplus.onnx'.format(model_dir),
                                           '{}/speech_tokenizer_v1.onnx'.format(model_dir),
                                           '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
+                                          configs['allowed_special'],
+                                          onnx_concurrent,
+                                          onnx_num_threads)
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_jit is True or load_trt is True or fp16 is True):
             load_jit, load_trt, fp16 = False, False, False
             logging.warning('no cuda device, set load_jit/load_trt/fp16 to False')
-        self.model = CosyVoiceModel(configs['llm'], configs['flow'], configs['hift'], fp16)
+        if torch.cuda.is_available() is True and load_onnx_cpu is True:
+            load_onnx_cpu = False
+            logging.warning('cuda device found, set load_onnx_cpu to False')
+        if load_static_decode is True:
+            load_static_decode = False
+            logging.warning('static kv cache decode is only implemented for CosyVoice2/3, set load_static_decode to False')
+        self.model = CosyVoiceModel(configs['llm'], configs['flow'], configs['hift'], fp16, preloaded=components or {})
         self.model.load('{}/llm.pt'.format(model_dir),
                         '{}/flow.pt'.format(model_dir),
                         '{}/hift.pt'.format(model_dir))
@@ -65,8 +80,35 @@ class CosyVoice:
                                 '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
                                 trt_concurrent,
                                 self.fp16)
+        if load_onnx_cpu:
+            self._load_onnx_cpu(model_dir, onnx_cpu_int8, onnx_cpu_num_threads, onnx_concurrent, onnx_num_threads)
+        self._init_pipeline(pipeline_workers)
         del configs
 
+    @staticmethod
+    def _load_configs(hyper_yaml_path, components=None, overrides=None):
+        # NOTE components already loaded by another model, see ModelRegistry, are not built again, hifigan only wraps hift for training
+        components = components or {}
+        overrides = dict(overrides or {}, **{k: None for k in components})
+        if 'hift' in components:
+            overrides['hifigan'] = None
+        with open(hyper_yaml_path, 'r') as f:
+            configs = load_hyperpyyaml(f, overrides=overrides)
+        configs.update(components)
+        return configs
+
+    def _load_onnx_cpu(self, model_dir, onnx_cpu_int8, onnx_cpu_num_threads, onnx_concurrent, onnx_num_threads):
+        # NOTE onnx_cpu_num_threads 0 splits the cores the campplus and speech tokenizer sessions of the frontend do not use
+        self.model.load_onnx_cpu(model_dir, onnx_cpu_int8, num_threads=onnx_cpu_num_threads, concurrent=onnx_concurrent,
+                                 reserved_threads=2 * onnx_concurrent * onnx_num_threads)
+
+    def _init_pipeline(self, pipeline_workers):
+        # sentence pipeline of pipeline_lookahead > 0, see _inference_pipeline. pipeline_workers > 0 shares one pool between
+        # concurrent requests, size it to max concurrent requests * (pipeline_lookahead + 1) so a request never waits for
+        # the sentences of another one. 0 gives every request its own lookahead + 1 threads
+        self.pipeline_executor = ThreadPoolExecutor(max_workers=pipeline_workers, thread_name_prefix='pipeline') if pipeline_workers > 0 else None
+        self.pipeline_max_chunks = 8
+
     def list_available_spks(self):
         spks = list(self.frontend.spk2info.keys())
         return spks
@@ -76,76 +118,214 @@ class CosyVoice:
         model_input = self.frontend.frontend_zero_shot('', prompt_text, prompt_wav, self.sample_rate, '')
         del model_input['text']
         del model_input['text_len']
+        # speaker constant flow inputs, reused by every sentence and chunk of this speaker
+        if hasattr(self.model, 'prepare_flow_prompt'):
+            model_input['flow_prompt_cache'] = self.model.prepare_flow_prompt(model_input['flow_prompt_speech_token'],
+                                                                              model_input['prompt_speech_feat'],
+                                                                              model_input['flow_embedding'])
         self.frontend.spk2info[zero_shot_spk_id] = model_input
         return True
 
+    def add_zero_shot_spk_batch(self, prompt_texts, prompt_wavs, zero_shot_spk_ids):
+        assert '' not in zero_shot_spk_ids, 'do not use empty zero_shot_spk_id'
+        for model_input, zero_shot_spk_id in zip(self.frontend.frontend_prompt_batch(prompt_texts, prompt_wavs, self.sample_rate), zero_shot_spk_ids):
+            if hasattr(self.model, 'prepare_flow_prompt'):
+                model_input['flow_prompt_cache'] = self.model.prepare_flow_prompt(model_input['flow_prompt_speech_token'],
+                                                                                  model_input['prompt_speech_feat'],
+                                                                                  model_input['flow_embedding'])
+            self.frontend.spk2info[zero_shot_spk_id] = model_input
+        return True
+
     def save_spkinfo(self):
         torch.save(self.frontend.spk2info, '{}/spk2info.pt'.format(self.model_dir))
 
-    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True, n_timesteps=10, solver=None, cfg_strategy=None, pipeline_lookahead=0,
+                      first_max_n=0):
+        texts = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend, first_max_n=first_max_n)
+        if pipeline_lookahead > 0:
+            jobs = [partial(self.frontend.frontend_sft, i, spk_id) for i in texts]
+            for model_output in self._inference_pipeline(jobs, pipeline_lookahead, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver, cfg_strategy=cfg_strategy):
+                yield model_output
+            return
+        for i in tqdm(texts):
             model_input = self.frontend.frontend_sft(i, spk_id)
             start_time = time.time()
             logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+            for model_output in self.model.tts(**model_input, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver, cfg_strategy=cfg_strategy):
                 speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
                 logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
                 yield model_output
                 start_time = time.time()
 
-    def inference_zero_shot(self, tts_text, prompt_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
+    def inference_zero_shot(self, tts_text, prompt_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True, n_timesteps=10, solver=None, cfg_strategy=None,
+                            pipeline_lookahead=0, first_max_n=0):
         if self.__class__.__name__ == 'CosyVoice3' and '<|endofprompt|>' not in prompt_text + tts_text:
             logging.warning('<|endofprompt|> not found in CosyVoice3 inference, check your input text')
         prompt_text = self.frontend.text_normalize(prompt_text, split=False, text_frontend=text_frontend)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+        if zero_shot_spk_id == '':
+            prompt_wav = self.frontend.load_prompt_audio(prompt_wav)
+        texts = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend, first_max_n=first_max_n)
+        if pipeline_lookahead > 0:
+            jobs = [partial(self.frontend.frontend_zero_shot, i, prompt_text, prompt_wav, self.sample_rate, zero_shot_spk_id) for i in texts]
+            for model_output in self._inference_pipeline(jobs, pipeline_lookahead, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver, cfg_strategy=cfg_strategy):
+                yield model_output
+            return
+        for i in tqdm(texts):
             if (not isinstance(i, Generator)) and len(i) < 0.5 * len(prompt_text):
                 logging.warning('synthesis text {} too short than prompt text {}, this may lead to bad performance'.format(i, prompt_text))
             model_input = self.frontend.frontend_zero_shot(i, prompt_text, prompt_wav, self.sample_rate, zero_shot_spk_id)
             start_time = time.time()
             logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+            for model_output in self.model.tts(**model_input, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver, cfg_strategy=cfg_strategy):
                 speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
                 logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
                 yield model_output
                 start_time = time.time()
 
-    def inference_cross_lingual(self, tts_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+    def inference_cross_lingual(self, tts_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True, n_timesteps=10, solver=None, cfg_strategy=None,
+                                pipeline_lookahead=0, first_max_n=0):
+        if zero_shot_spk_id == '':
+            prompt_wav = self.frontend.load_prompt_audio(prompt_wav)
+        texts = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend, first_max_n=first_max_n)
+        if pipeline_lookahead > 0:
+            jobs = [partial(self.frontend.frontend_cross_lingual, i, prompt_wav, self.sample_rate, zero_shot_spk_id) for i in texts]
+            for model_output in self._inference_pipeline(jobs, pipeline_lookahead, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver, cfg_strategy=cfg_strategy):
+                yield model_output
+            return
+        for i in tqdm(texts):
             model_input = self.frontend.frontend_cross_lingual(i, prompt_wav, self.sample_rate, zero_shot_spk_id)
             start_time = time.time()
             logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+            for model_output in self.model.tts(**model_input, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver, cfg_strategy=cfg_strategy):
                 speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
                 logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
                 yield model_output
                 start_time = time.time()
 
-    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, text_frontend=True):
+    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, text_frontend=True, n_timesteps=10, solver=None, cfg_strategy=None,
+                           pipeline_lookahead=0, first_max_n=0):
         assert self.__class__.__name__ == 'CosyVoice', 'inference_instruct is only implemented for CosyVoice!'
         instruct_text = self.frontend.text_normalize(instruct_text, split=False, text_frontend=text_frontend)
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+        texts = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend, first_max_n=first_max_n)
+        if pipeline_lookahead > 0:
+            jobs = [partial(self.frontend.frontend_instruct, i, spk_id, instruct_text) for i in texts]
+            for model_output in self._inference_pipeline(jobs, pipeline_lookahead, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver, cfg_strategy=cfg_strategy):
+                yield model_output
+            return
+        for i in tqdm(texts):
             model_input = self.frontend.frontend_instruct(i, spk_id, instruct_text)
             start_time = time.time()
             logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+            for model_output in self.model.tts(**model_input, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver, cfg_strategy=cfg_strategy):
                 speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
                 logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
                 yield model_output
                 start_time = time.time()
 
-    def inference_vc(self, source_wav, prompt_wav, stream=False, speed=1.0):
-        model_input = self.frontend.frontend_vc(source_wav, prompt_wav, self.sample_rate)
+    def inference_vc(self, source_wav, prompt_wav, stream=False, speed=1.0, n_timesteps=10, solver=None, cfg_strategy=None, pipeline_lookahead=1):
+        # NOTE a source of any length is tokenized and converted chunk by chunk, up to pipeline_lookahead chunks ahead of the one being emitted,
+        # chunks overlap by fade_sec of source and the overlap is crossfaded, as tts does between stream chunks
+        fade_sec = 0.2
+        jobs = self.frontend.frontend_vc_chunks(source_wav, prompt_wav, self.sample_rate, fade_sec=fade_sec)
+        if len(jobs) > 1:
+            for model_output in self._inference_pipeline(jobs, pipeline_lookahead, crossfade=int(fade_sec / speed * self.sample_rate), stream=stream, speed=speed,
+                                                         n_timesteps=n_timesteps, solver=solver, cfg_strategy=cfg_strategy):
+                yield model_output
+            return
+        model_input = jobs[0]()
         start_time = time.time()
-        for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+        for model_output in self.model.tts(**model_input, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver, cfg_strategy=cfg_strategy):
             speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
             logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
             yield model_output
             start_time = time.time()
 
+    def _inference_pipeline(self, jobs, lookahead, crossfade=0, **kwargs):
+        """Overlap sentences, up to lookahead sentences run frontend and model.tts ahead of the one being emitted.
+        Each job builds the model_input of one sentence, audio chunks are yielded in sentence order. Jobs run on the shared
+        pipeline_executor, or on lookahead + 1 threads of this call without one, and buffer at most pipeline_max_chunks
+        chunks each, closing the generator stops all of them. crossfade > 0 fades the last crossfade samples of every
+        sentence into the first crossfade samples of the next one, for jobs whose audio overlaps by that much.
+        """
+        stop = threading.Event()
+        executor = self.pipeline_executor if self.pipeline_executor is not None else \
+            ThreadPoolExecutor(max_workers=lookahead + 1, thread_name_prefix='pipeline')
+
+        def put(output_queue, item):
+            # a full queue waits for the consumer, until the consumer is closed
+            while stop.is_set() is False:
+                try:
+                    output_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def run(job, output_queue):
+            try:
+                if stop.is_set() is False:
+                    model_outputs = self.model.tts(**job(), **kwargs)
+                    try:
+                        for model_output in model_outputs:
+                            if put(output_queue, model_output) is False:
+                                break
+                    finally:
+                        # frees the llm thread and session state of model.tts when the consumer went away
+                        model_outputs.close()
+            except Exception as e:
+                put(output_queue, e)
+            put(output_queue, None)
+
+        jobs, pending = iter(jobs), deque()
+
+        def submit():
+            job = next(jobs, None)
+            if job is not None:
+                output_queue = queue.Queue(maxsize=self.pipeline_max_chunks)
+                pending.append((executor.submit(run, job, output_queue), output_queue))
+
+        crossfader = Crossfader(crossfade) if crossfade > 0 else None
+        try:
+            for _ in range(lookahead + 1):
+                submit()
+            start_time = time.time()
+            while len(pending) != 0:
+                _, output_queue = pending.popleft()
+                while True:
+                    model_output = output_queue.get()
+                    if model_output is None:
+                        break
+                    if isinstance(model_output, Exception):
+                        raise model_output
+                    if crossfader is not None:
+                        model_output = crossfader.update(model_output['tts_speech'])
+                        if model_output is None:
+                            continue
+                    speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
+                    logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
+                    yield model_output
+                    start_time = time.time()
+                if crossfader is not None:
+                    model_output = crossfader.end_sentence()
+                    if model_output is not None:
+                        yield model_output
+                submit()
+            if crossfader is not None and crossfader.tail is not None:
+                # the end of the last sentence has nothing to fade into
+                yield {'tts_speech': crossfader.tail}
+        finally:
+            stop.set()
+            for future, _ in pending:
+                future.cancel()
+            if executor is not self.pipeline_executor:
+                executor.shutdown(wait=False)
+
 
 class CosyVoice2(CosyVoice):
 
-    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1, onnx_concurrent=1, onnx_num_threads=1,
+                 load_onnx_cpu=False, onnx_cpu_int8=False, load_static_decode=False, onnx_cpu_num_threads=0,
+                 pipeline_workers=0, components=None):
         self.model_dir = model_dir
         self.fp16 = fp16
         if not os.path.exists(model_dir):
@@ -153,25 +333,31 @@ class CosyVoice2(CosyVoice):
         hyper_yaml_path = '{}/cosyvoice2.yaml'.format(model_dir)
         if not os.path.exists(hyper_yaml_path):
             raise ValueError('{} not found!'.format(hyper_yaml_path))
-        with open(hyper_yaml_path, 'r') as f:
-            configs = load_hyperpyyaml(f, overrides={'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN')})
+        configs = self._load_configs(hyper_yaml_path, components, {'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN')})
         assert get_model_type(configs) == CosyVoice2Model, 'do not use {} for CosyVoice2 initialization!'.format(model_dir)
         self.frontend = CosyVoiceFrontEnd(configs['get_tokenizer'],
                                           configs['feat_extractor'],
                                           '{}/campplus.onnx'.format(model_dir),
                                           '{}/speech_tokenizer_v2.onnx'.format(model_dir),
                                           '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
+                                          configs['allowed_special'],
+                                          onnx_concurrent,
+                                          onnx_num_threads)
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_jit is True or load_trt is True or load_vllm is True or fp16 is True):
             load_jit, load_trt, load_vllm, fp16 = False, False, False, False
             logging.warning('no cuda device, set load_jit/load_trt/load_vllm/fp16 to False')
-        self.model = CosyVoice2Model(configs['llm'], configs['flow'], configs['hift'], fp16)
+        if torch.cuda.is_available() is True and load_onnx_cpu is True:
+            load_onnx_cpu = False
+            logging.warning('cuda device found, set load_onnx_cpu to False')
+        self.model = CosyVoice2Model(configs['llm'], configs['flow'], configs['hift'], fp16, preloaded=components or {})
         self.model.load('{}/llm.pt'.format(model_dir),
                         '{}/flow.pt'.format(model_dir),
                         '{}/hift.pt'.format(model_dir))
         if load_vllm:
             self.model.load_vllm('{}/vllm'.format(model_dir))
+        elif load_static_decode:
+            self.model.load_static_decode()
         if load_jit:
             self.model.load_jit('{}/flow.encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'))
         if load_trt:
@@ -179,14 +365,26 @@ class CosyVoice2(CosyVoice):
                                 '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
                                 trt_concurrent,
                                 self.fp16)
+        if load_onnx_cpu:
+            self._load_onnx_cpu(model_dir, onnx_cpu_int8, onnx_cpu_num_threads, onnx_concurrent, onnx_num_threads)
+        self._init_pipeline(pipeline_workers)
         del configs
 
-    def inference_instruct2(self, tts_text, instruct_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
-        for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+    def inference_instruct2(self, tts_text, instruct_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True, n_timesteps=10, solver=None, cfg_strategy=None,
+                            pipeline_lookahead=0, first_max_n=0):
+        if zero_shot_spk_id == '':
+            prompt_wav = self.frontend.load_prompt_audio(prompt_wav)
+        texts = self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend, first_max_n=first_max_n)
+        if pipeline_lookahead > 0:
+            jobs = [partial(self.frontend.frontend_instruct2, i, instruct_text, prompt_wav, self.sample_rate, zero_shot_spk_id) for i in texts]
+            for model_output in self._inference_pipeline(jobs, pipeline_lookahead, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver, cfg_strategy=cfg_strategy):
+                yield model_output
+            return
+        for i in tqdm(texts):
             model_input = self.frontend.frontend_instruct2(i, instruct_text, prompt_wav, self.sample_rate, zero_shot_spk_id)
             start_time = time.time()
             logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+            for model_output in self.model.tts(**model_input, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver, cfg_strategy=cfg_strategy):
                 speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
                 logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
                 yield model_output
@@ -211,7 +409,9 @@ def _ensure_ruamel_max_depth():
 
 class CosyVoice3(CosyVoice2):
 
-    def __init__(self, model_dir, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1, onnx_concurrent=1, onnx_num_threads=1,
+                 load_onnx_cpu=False, onnx_cpu_int8=False, load_static_decode=False, onnx_cpu_num_threads=0,
+                 pipeline_workers=0, components=None):
         self.model_dir = model_dir
         self.fp16 = fp16
         if not os.path.exists(model_dir):
@@ -220,25 +420,31 @@ class CosyVoice3(CosyVoice2):
         if not os.path.exists(hyper_yaml_path):
             raise ValueError('{} not found!'.format(hyper_yaml_path))
         _ensure_ruamel_max_depth()
-        with open(hyper_yaml_path, 'r') as f:
-            configs = load_hyperpyyaml(f, overrides={'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN')})
+        configs = self._load_configs(hyper_yaml_path, components, {'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN')})
         assert get_model_type(configs) == CosyVoice3Model, 'do not use {} for CosyVoice3 initialization!'.format(model_dir)
         self.frontend = CosyVoiceFrontEnd(configs['get_tokenizer'],
                                           configs['feat_extractor'],
                                           '{}/campplus.onnx'.format(model_dir),
                                           '{}/speech_tokenizer_v3.onnx'.format(model_dir),
                                           '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
+                                          configs['allowed_special'],
+                                          onnx_concurrent,
+                                          onnx_num_threads)
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_trt is True or fp16 is True):
             load_trt, fp16 = False, False
             logging.warning('no cuda device, set load_trt/fp16 to False')
-        self.model = CosyVoice3Model(configs['llm'], configs['flow'], configs['hift'], fp16)
+        if torch.cuda.is_available() is True and load_onnx_cpu is True:
+            load_onnx_cpu = False
+            logging.warning('cuda device found, set load_onnx_cpu to False')
+        self.model = CosyVoice3Model(configs['llm'], configs['flow'], configs['hift'], fp16, preloaded=components or {})
         self.model.load('{}/llm.pt'.format(model_dir),
                         '{}/flow.pt'.format(model_dir),
                         '{}/hift.pt'.format(model_dir))
         if load_vllm:
             self.model.load_vllm('{}/vllm'.format(model_dir))
+        elif load_static_decode:
+            self.model.load_static_decode()
         if load_trt:
             if self.fp16 is True:
                 logging.warning('DiT tensorRT fp16 engine have some performance issue, use at caution!')
@@ -246,6 +452,9 @@ class CosyVoice3(CosyVoice2):
                                 '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
                                 trt_concurrent,
                                 self.fp16)
+        if load_onnx_cpu:
+            self._load_onnx_cpu(model_dir, onnx_cpu_int8, onnx_cpu_num_threads, onnx_concurrent, onnx_num_threads)
+        self._init_pipeline(pipeline_workers)
         del configs
 
 
@@ -11,9 +11,13 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import partial
 from typing import Generator
 import json
+import multiprocessing
 import onnxruntime
 import torch
 import numpy as np
@@ -21,36 +25,19 @@ import whisper
 from typing import Callable
 import torchaudio.compliance.kaldi as kaldi
 import os
+import queue
 import re
+import threading
+import weakref
 import inflect
-from cosyvoice.utils.file_utils import logging, load_wav
+from cosyvoice.utils.file_utils import logging, PromptAudio, AudioReader, file_hash
 from cosyvoice.utils.frontend_utils import contains_chinese, replace_blank, replace_corner_mark, remove_bracket, spell_out_number, split_paragraph, is_only_punctuation
 
 
-class CosyVoiceFrontEnd:
+class TextFrontendEngines:
+    """The ttsfrd or wetext normalizers and inflect, independent of the tokenizer so every model of a process can share them."""
 
-    def __init__(self,
-                 get_tokenizer: Callable,
-                 feat_extractor: Callable,
-                 campplus_model: str,
-                 speech_tokenizer_model: str,
-                 spk2info: str = '',
-                 allowed_special: str = 'all'):
-        self.tokenizer = get_tokenizer()
-        self.feat_extractor = feat_extractor
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        option = onnxruntime.SessionOptions()
-        option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
-        option.intra_op_num_threads = 1
-        self.campplus_session = onnxruntime.InferenceSession(campplus_model, sess_options=option, providers=["CPUExecutionProvider"])
-        self.speech_tokenizer_session = onnxruntime.InferenceSession(speech_tokenizer_model, sess_options=option,
-                                                                     providers=["CUDAExecutionProvider" if torch.cuda.is_available() else
-                                                                                "CPUExecutionProvider"])
-        if os.path.exists(spk2info):
-            self.spk2info = torch.load(spk2info, map_location=self.device, weights_only=True)
-        else:
-            self.spk2info = {}
-        self.allowed_special = allowed_special
+    def __init__(self):
         self.inflect_parser = inflect.engine()
         # NOTE compatible when no text frontend tool is avaliable
         try:
@@ -75,6 +62,167 @@ class CosyVoiceFrontEnd:
                 logging.info('no frontend is avaliable')
 
 
+class TextNormalizer:
+    """Text normalization and sentence splitting, free of model state so that it can also live in a worker process."""
+
+    def __init__(self, tokenizer, allowed_special: str = 'all', engines: TextFrontendEngines = None):
+        self.tokenizer = tokenizer
+        self.allowed_special = allowed_special
+        self.engines = engines if engines is not None else TextFrontendEngines()
+        self.text_frontend = self.engines.text_frontend
+
+    def normalize(self, text, split=True, first_max_n=0):
+        text = text.strip()
+        if self.text_frontend == 'ttsfrd':
+            texts = [i["text"] for i in json.loads(self.engines.frd.do_voicegen_frd(text))["sentences"]]
+            text = ''.join(texts)
+        else:
+            if contains_chinese(text):
+                if self.text_frontend == 'wetext':
+                    text = self.engines.zh_tn_model.normalize(text)
+                text = text.replace("\n", "")
+                text = replace_blank(text)
+                text = replace_corner_mark(text)
+                text = text.replace(".", "。")
+                text = text.replace(" - ", "，")
+                text = remove_bracket(text)
+                text = re.sub(r'[，,、]+$', '。', text)
+                texts = list(split_paragraph(text, partial(self.tokenizer.encode, allowed_special=self.allowed_special), "zh", token_max_n=80,
+                                             token_min_n=60, merge_len=20, comma_split=False, first_max_n=first_max_n))
+            else:
+                if self.text_frontend == 'wetext':
+                    text = self.engines.en_tn_model.normalize(text)
+                text = spell_out_number(text, self.engines.inflect_parser)
+                texts = list(split_paragraph(text, partial(self.tokenizer.encode, allowed_special=self.allowed_special), "en", token_max_n=80,
+                                             token_min_n=60, merge_len=20, comma_split=False, first_max_n=first_max_n))
+        texts = [i for i in texts if not is_only_punctuation(i)]
+        return texts if split is True else text
+
+
+# NOTE components that several models of one process can use at the same time, keyed by the content hash of their files.
+# values are weak, a component is freed once the last frontend holding it is gone
+shared_components = weakref.WeakValueDictionary()
+shared_components_lock = threading.Lock()
+
+
+def get_shared_component(key, factory):
+    with shared_components_lock:
+        component = shared_components.get(key)
+        if component is None:
+            component = factory()
+            shared_components[key] = component
+        else:
+            logging.info('share {} with an already loaded model'.format(key[0]))
+        return component
+
+
+def tokenizer_key(get_tokenizer):
+    # the tokenizer is fully defined by its factory and arguments, path arguments count by their content
+    func = get_tokenizer.func if isinstance(get_tokenizer, partial) else get_tokenizer
+    kwargs = get_tokenizer.keywords if isinstance(get_tokenizer, partial) else {}
+    args = get_tokenizer.args if isinstance(get_tokenizer, partial) else ()
+    values = [file_hash(i) if isinstance(i, str) and os.path.exists(i) else repr(i) for i in args]
+    values += ['{}={}'.format(k, file_hash(v) if isinstance(v, str) and os.path.exists(v) else repr(v)) for k, v in sorted(kwargs.items())]
+    return ('tokenizer', '{}.{}'.format(func.__module__, func.__qualname__), tuple(values))
+
+
+# NOTE the per process normalizer of CosyVoiceFrontEnd.text_pool
+_text_pool_normalizer = None
+
+
+def _text_pool_init(get_tokenizer, allowed_special):
+    global _text_pool_normalizer
+    _text_pool_normalizer = TextNormalizer(get_tokenizer(), allowed_special)
+
+
+def _text_pool_normalize(text, split, first_max_n=0):
+    return _text_pool_normalizer.normalize(text, split, first_max_n)
+
+
+class OnnxSessionPool:
+    """A fixed number of onnxruntime sessions of the same model, each request borrows one session for its run."""
+
+    def __init__(self, model: str, providers: list, pool_size: int = 1, num_threads: int = 1, allow_spinning: bool = True):
+        option = onnxruntime.SessionOptions()
+        option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        option.intra_op_num_threads = num_threads
+        option.inter_op_num_threads = 1
+        # NOTE spinning intra op threads cut latency of back to back runs, but burn cores other sessions need when several run at once
+        option.add_session_config_entry('session.intra_op.allow_spinning', '1' if allow_spinning is True else '0')
+        self.sessions = [onnxruntime.InferenceSession(model, sess_options=option, providers=providers) for _ in range(pool_size)]
+        self.pool = queue.Queue()
+        for session in self.sessions:
+            self.pool.put(session)
+        self.input_names = [i.name for i in self.sessions[0].get_inputs()]
+        self.output_names = [i.name for i in self.sessions[0].get_outputs()]
+        self.io_binding = 'CUDAExecutionProvider' in self.sessions[0].get_providers()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    @contextmanager
+    def acquire(self):
+        session = self.pool.get()
+        try:
+            yield session
+        finally:
+            self.pool.put(session)
+
+    def run(self, *inputs):
+        with self.acquire() as session:
+            if self.io_binding is False:
+                return session.run(self.output_names[:1], dict(zip(self.input_names, inputs)))[0]
+            # NOTE bind inputs and output explicitly so ort does not allocate and copy intermediate host buffers on every run
+            binding = session.io_binding()
+            for name, value in zip(self.input_names, inputs):
+                binding.bind_cpu_input(name, value)
+            binding.bind_output(self.output_names[0], 'cpu')
+            session.run_with_iobinding(binding)
+            return binding.copy_outputs_to_cpu()[0]
+
+
+class CosyVoiceFrontEnd:
+
+    def __init__(self,
+                 get_tokenizer: Callable,
+                 feat_extractor: Callable,
+                 campplus_model: str,
+                 speech_tokenizer_model: str,
+                 spk2info: str = '',
+                 allowed_special: str = 'all',
+                 onnx_concurrent: int = 1,
+                 onnx_num_threads: int = 1,
+                 text_cache_chars: int = 1 << 22):
+        self.get_tokenizer = get_tokenizer
+        # NOTE models of one process with identical tokenizer files, onnx models or text frontend share a single instance
+        self.tokenizer = get_shared_component(tokenizer_key(get_tokenizer), get_tokenizer)
+        self.feat_extractor = feat_extractor
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        # NOTE every pool holds onnx_concurrent sessions, so concurrent requests extract prompt features in parallel
+        providers = ["CPUExecutionProvider"]
+        self.campplus_session = get_shared_component(('onnx', file_hash(campplus_model), tuple(providers), onnx_concurrent, onnx_num_threads),
+                                                     partial(OnnxSessionPool, campplus_model, providers, onnx_concurrent, onnx_num_threads))
+        providers = ["CUDAExecutionProvider" if torch.cuda.is_available() else "CPUExecutionProvider"]
+        self.speech_tokenizer_session = get_shared_component(('onnx', file_hash(speech_tokenizer_model), tuple(providers), onnx_concurrent, onnx_num_threads),
+                                                             partial(OnnxSessionPool, speech_tokenizer_model, providers, onnx_concurrent, onnx_num_threads))
+        if os.path.exists(spk2info):
+            self.spk2info = torch.load(spk2info, map_location=self.device, weights_only=True)
+        else:
+            self.spk2info = {}
+        self.allowed_special = allowed_special
+        self.text_normalizer = TextNormalizer(self.tokenizer, allowed_special, get_shared_component(('text_frontend',), TextFrontendEngines))
+        self.text_frontend = self.text_normalizer.text_frontend
+        # NOTE lru cache of text_normalize results, prompt text and repeated sentences are normalized only once.
+        # bounded by the characters of the cached texts and results, not by entries, as a single entry can be a whole document
+        self.text_cache = OrderedDict()
+        self.text_cache_chars = text_cache_chars
+        self.text_cache_used = 0
+        self.text_cache_lock = threading.Lock()
+        # NOTE optional process pool for text normalization, see start_text_pool
+        self.text_pool = None
+        self.text_pool_executor = None
+        self.text_pool_slots = None
+
     def _extract_text_token(self, text):
         if isinstance(text, Generator):
             logging.info('get tts_text generator, will return _extract_text_token_generator!')
@@ -92,39 +240,92 @@ class CosyVoiceFrontEnd:
             for i in range(text_token.shape[1]):
                 yield text_token[:, i: i + 1]
 
+    def load_prompt_audio(self, prompt_wav):
+        # decode the wav once, every feature below is computed from the resampled views of the same PromptAudio
+        return prompt_wav if isinstance(prompt_wav, PromptAudio) else PromptAudio(prompt_wav)
+
     def _extract_speech_token(self, prompt_wav):
-        speech = load_wav(prompt_wav, 16000)
+        speech = self.load_prompt_audio(prompt_wav).resample(16000)
         assert speech.shape[1] / 16000 <= 30, 'do not support extract speech token for audio longer than 30s'
         feat = whisper.log_mel_spectrogram(speech, n_mels=128)
-        speech_token = self.speech_tokenizer_session.run(None,
-                                                         {self.speech_tokenizer_session.get_inputs()[0].name:
-                                                          feat.detach().cpu().numpy(),
-                                                          self.speech_tokenizer_session.get_inputs()[1].name:
-                                                          np.array([feat.shape[2]], dtype=np.int32)})[0].flatten().tolist()
+        speech_token = self.speech_tokenizer_session.run(feat.detach().cpu().numpy(),
+                                                         np.array([feat.shape[2]], dtype=np.int32)).flatten().tolist()
         speech_token = torch.tensor([speech_token], dtype=torch.int32).to(self.device)
         speech_token_len = torch.tensor([speech_token.shape[1]], dtype=torch.int32).to(self.device)
         return speech_token, speech_token_len
 
+    def _extract_speech_token_batch(self, prompt_wavs):
+        # pad whisper mels to the longest prompt and tokenize them in one run, the tokenizer masks frames beyond feats_length
+        feats = []
+        for prompt_wav in prompt_wavs:
+            speech = self.load_prompt_audio(prompt_wav).resample(16000)
+            assert speech.shape[1] / 16000 <= 30, 'do not support extract speech token for audio longer than 30s'
+            feats.append(whisper.log_mel_spectrogram(speech, n_mels=128).squeeze(dim=0))
+        feat_len = np.array([i.shape[1] for i in feats], dtype=np.int32)
+        feat = torch.zeros(len(feats), feats[0].shape[0], int(feat_len.max()))
+        for i, f in enumerate(feats):
+            feat[i, :, :f.shape[1]] = f
+        speech_tokens = self.speech_tokenizer_session.run(feat.numpy(), feat_len)
+        # 2 (v1) or 4 (v2, v3) mel frames per speech token, read off the padded run as in _extract_speech_token_window
+        frames_per_token = max(int(round(int(feat_len.max()) / max(speech_tokens.shape[1], 1))), 1)
+        results = []
+        for i in range(len(feats)):
+            token_len = min((int(feat_len[i]) + frames_per_token - 1) // frames_per_token, speech_tokens.shape[1])
+            speech_token = torch.tensor(speech_tokens[i: i + 1, :token_len], dtype=torch.int32).to(self.device)
+            results.append((speech_token, torch.tensor([token_len], dtype=torch.int32).to(self.device)))
+        return results
+
+    def _extract_speech_token_window(self, reader, start, end, overlap):
+        # tokens of samples [start, end) of a long source at 16k. the window is tokenized with overlap samples of context on
+        # both sides, so tokens next to a chunk border see the same context as in one run, the context tokens are dropped
+        left, right = max(start - overlap, 0), min(end + overlap, len(reader))
+        feat = whisper.log_mel_spectrogram(reader.read(left, right), n_mels=128)
+        speech_token = self.speech_tokenizer_session.run(feat.detach().cpu().numpy(),
+                                                         np.array([feat.shape[2]], dtype=np.int32)).flatten()
+        # 160 samples per mel frame, 2 (v1) or 4 (v2, v3) mel frames per speech token
+        frames_per_token = max(int(round(feat.shape[2] / max(len(speech_token), 1))), 1)
+        first = (start - left) // 160 // frames_per_token
+        last = len(speech_token) if end >= len(reader) else (end - left) // 160 // frames_per_token
+        speech_token = torch.tensor([speech_token[first: last].tolist()], dtype=torch.int32).to(self.device)
+        speech_token_len = torch.tensor([speech_token.shape[1]], dtype=torch.int32).to(self.device)
+        return speech_token, speech_token_len
+
+    @staticmethod
+    def _chunk_border(reader, nominal, snap):
+        # the quietest 40ms frame within snap samples of nominal, so chunks converted on their own are joined in a pause
+        # where the source has one. borders stay multiples of 640 samples, whole speech tokens of every tokenizer
+        left = max(nominal - snap, 0)
+        speech = reader.read(left, min(nominal + snap, len(reader)))
+        frames = speech[0, :speech.shape[1] // 640 * 640].reshape(-1, 640)
+        if frames.shape[0] == 0:
+            return nominal
+        return left + int(frames.pow(2).mean(dim=1).argmin()) * 640
+
     def _extract_spk_embedding(self, prompt_wav):
-        speech = load_wav(prompt_wav, 16000)
+        speech = self.load_prompt_audio(prompt_wav).resample(16000)
         feat = kaldi.fbank(speech,
                            num_mel_bins=80,
                            dither=0,
                            sample_frequency=16000)
         feat = feat - feat.mean(dim=0, keepdim=True)
-        embedding = self.campplus_session.run(None,
-                                              {self.campplus_session.get_inputs()[0].name: feat.unsqueeze(dim=0).cpu().numpy()})[0].flatten().tolist()
+        embedding = self.campplus_session.run(feat.unsqueeze(dim=0).cpu().numpy()).flatten().tolist()
         embedding = torch.tensor([embedding]).to(self.device)
         return embedding
 
+    def _extract_spk_embedding_batch(self, prompt_wavs):
+        # NOTE campplus has no length input, padding would leak into its statistics pooling, run prompts concurrently on the pool instead
+        with ThreadPoolExecutor(max_workers=len(self.campplus_session)) as executor:
+            return list(executor.map(self._extract_spk_embedding, prompt_wavs))
+
     def _extract_speech_feat(self, prompt_wav):
-        speech = load_wav(prompt_wav, 24000)
+        speech = self.load_prompt_audio(prompt_wav).resample(24000)
         speech_feat = self.feat_extractor(speech).squeeze(dim=0).transpose(0, 1).to(self.device)
         speech_feat = speech_feat.unsqueeze(dim=0)
         speech_feat_len = torch.tensor([speech_feat.shape[1]], dtype=torch.int32).to(self.device)
         return speech_feat, speech_feat_len
 
-    def text_normalize(self, text, split=True, text_frontend=True):
+    def text_normalize(self, text, split=True, text_frontend=True, first_max_n=0):
+        # NOTE first_max_n > 0 cuts the first segment to about this many tokens for a faster first audio, see split_paragraph
         if isinstance(text, Generator):
             logging.info('get tts_text generator, will skip text_normalize!')
             return [text]
@@ -133,31 +334,72 @@ class CosyVoiceFrontEnd:
             text_frontend = False
         if text_frontend is False or text == '':
             return [text] if split is True else text
-        text = text.strip()
-        if self.text_frontend == 'ttsfrd':
-            texts = [i["text"] for i in json.loads(self.frd.do_voicegen_frd(text))["sentences"]]
-            text = ''.join(texts)
-        else:
-            if contains_chinese(text):
-                if self.text_frontend == 'wetext':
-                    text = self.zh_tn_model.normalize(text)
-                text = text.replace("\n", "")
-                text = replace_blank(text)
-                text = replace_corner_mark(text)
-                text = text.replace(".", "。")
-                text = text.replace(" - ", "，")
-                text = remove_bracket(text)
-                text = re.sub(r'[，,、]+$', '。', text)
-                texts = list(split_paragraph(text, partial(self.tokenizer.encode, allowed_special=self.allowed_special), "zh", token_max_n=80,
-                                             token_min_n=60, merge_len=20, comma_split=False))
-            else:
-                if self.text_frontend == 'wetext':
-                    text = self.en_tn_model.normalize(text)
-                text = spell_out_number(text, self.inflect_parser)
-                texts = list(split_paragraph(text, partial(self.tokenizer.encode, allowed_special=self.allowed_special), "en", token_max_n=80,
-                                             token_min_n=60, merge_len=20, comma_split=False))
-        texts = [i for i in texts if not is_only_punctuation(i)]
-        return texts if split is True else text
+        # language is decided by the text itself, so text, frontend, split flag and first_max_n fully determine the result
+        key = (text, self.text_frontend, split, first_max_n)
+        with self.text_cache_lock:
+            if key in self.text_cache:
+                self.text_cache.move_to_end(key)
+                texts = self.text_cache[key]
+                return list(texts) if split is True else texts
+        texts = self._text_normalize(text, split, first_max_n)
+        size = len(text) + (sum(len(i) for i in texts) if split is True else len(texts))
+        if size <= self.text_cache_chars:
+            with self.text_cache_lock:
+                if key not in self.text_cache:
+                    self.text_cache[key] = texts
+                    self.text_cache_used += size
+                while self.text_cache_used > self.text_cache_chars:
+                    old_key, old_texts = self.text_cache.popitem(last=False)
+                    self.text_cache_used -= len(old_key[0]) + (sum(len(i) for i in old_texts) if old_key[2] is True else len(old_texts))
+        return list(texts) if split is True else texts
+
+    def text_normalize_batch(self, texts, split=True, text_frontend=True, first_max_n=0):
+        """text_normalize of many texts, every distinct text is normalized once.
+        With a text pool the distinct texts are normalized in parallel worker processes, otherwise one after another in this thread.
+        """
+        futures = {}
+        for text in texts:
+            if isinstance(text, Generator) or text not in futures:
+                futures[text] = self.text_normalize_async(text, split=split, text_frontend=text_frontend, first_max_n=first_max_n) \
+                    if self.text_pool is not None else None
+        results = {text: future.result() if future is not None else self.text_normalize(text, split=split, text_frontend=text_frontend, first_max_n=first_max_n)
+                   for text, future in futures.items()}
+        return [list(results[text]) if split is True else results[text] for text in texts]
+
+    def _text_normalize(self, text, split, first_max_n=0):
+        if self.text_pool is None:
+            return self.text_normalizer.normalize(text, split, first_max_n)
+        return self.text_pool.submit(_text_pool_normalize, text, split, first_max_n).result()
+
+    def start_text_pool(self, num_workers=2, max_pending=64):
+        """Move text normalization into num_workers pre-warmed processes, so wetext/inflect never hold the GIL of the decode threads.
+        At most max_pending text_normalize_async calls are in flight, further calls return None and the text is normalized inline later.
+        """
+        if self.text_pool is not None:
+            return
+        # NOTE spawn, forking a process which already initialized cuda is not safe
+        self.text_pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'),
+                                             initializer=_text_pool_init, initargs=(self.get_tokenizer, self.allowed_special))
+        for future in [self.text_pool.submit(_text_pool_normalize, 'warm up', False) for _ in range(num_workers)]:
+            future.result()
+        self.text_pool_executor = ThreadPoolExecutor(max_workers=max_pending, thread_name_prefix='text_normalize')
+        self.text_pool_slots = threading.BoundedSemaphore(max_pending)
+        logging.info('text normalization runs in {} processes'.format(num_workers))
+
+    def text_normalize_async(self, text, split=True, text_frontend=True, first_max_n=0):
+        # returns a future of text_normalize, the result also lands in the lru cache so a later text_normalize call is free.
+        # NOTE only non blocking with a text pool, when the pool is full it returns None and the caller normalizes inline with
+        # text_normalize once it needs the result. without a text pool it normalizes right here and returns a done future, so
+        # callers on an event loop or a receive path check text_pool first
+        if self.text_pool_executor is None:
+            future = Future()
+            future.set_result(self.text_normalize(text, split=split, text_frontend=text_frontend, first_max_n=first_max_n))
+            return future
+        if not self.text_pool_slots.acquire(blocking=False):
+            return None
+        future = self.text_pool_executor.submit(self.text_normalize, text, split, text_frontend, first_max_n)
+        future.add_done_callback(lambda _: self.text_pool_slots.release())
+        return future
 
     def frontend_sft(self, tts_text, spk_id):
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
@@ -168,26 +410,38 @@ class CosyVoiceFrontEnd:
     def frontend_zero_shot(self, tts_text, prompt_text, prompt_wav, resample_rate, zero_shot_spk_id):
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
         if zero_shot_spk_id == '':
-            prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
-            speech_feat, speech_feat_len = self._extract_speech_feat(prompt_wav)
-            speech_token, speech_token_len = self._extract_speech_token(prompt_wav)
-            if resample_rate == 24000:
-                # cosyvoice2, force speech_feat % speech_token = 2
-                token_len = min(int(speech_feat.shape[1] / 2), speech_token.shape[1])
-                speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
-                speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
-            embedding = self._extract_spk_embedding(prompt_wav)
-            model_input = {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
-                           'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
-                           'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
-                           'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
-                           'llm_embedding': embedding, 'flow_embedding': embedding}
+            prompt_wav = self.load_prompt_audio(prompt_wav)
+            model_input = self._prompt_model_input(prompt_text, self._extract_speech_feat(prompt_wav), self._extract_speech_token(prompt_wav),
+                                                   self._extract_spk_embedding(prompt_wav), resample_rate)
         else:
             model_input = {**self.spk2info[zero_shot_spk_id]}
         model_input['text'] = tts_text_token
         model_input['text_len'] = tts_text_token_len
         return model_input
 
+    def _prompt_model_input(self, prompt_text, speech_feat, speech_token, embedding, resample_rate):
+        prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
+        (speech_feat, speech_feat_len), (speech_token, speech_token_len) = speech_feat, speech_token
+        if resample_rate == 24000:
+            # cosyvoice2, force speech_feat % speech_token = 2
+            token_len = min(int(speech_feat.shape[1] / 2), speech_token.shape[1])
+            speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
+            speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
+        model_input = {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
+                       'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
+                       'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
+                       'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
+                       'llm_embedding': embedding, 'flow_embedding': embedding}
+        return model_input
+
+    def frontend_prompt_batch(self, prompt_texts, prompt_wavs, resample_rate):
+        # prompt only model inputs of many speakers, speech tokens are extracted in one padded batch
+        prompt_wavs = [self.load_prompt_audio(i) for i in prompt_wavs]
+        speech_tokens = self._extract_speech_token_batch(prompt_wavs)
+        embeddings = self._extract_spk_embedding_batch(prompt_wavs)
+        return [self._prompt_model_input(prompt_text, self._extract_speech_feat(prompt_wav), speech_token, embedding, resample_rate)
+                for prompt_text, prompt_wav, speech_token, embedding in zip(prompt_texts, prompt_wavs, speech_tokens, embeddings)]
+
     def frontend_cross_lingual(self, tts_text, prompt_wav, resample_rate, zero_shot_spk_id):
         model_input = self.frontend_zero_shot(tts_text, '', prompt_wav, resample_rate, zero_shot_spk_id)
         # in cross lingual mode, we remove prompt in llm
@@ -212,13 +466,39 @@ class CosyVoiceFrontEnd:
         del model_input['llm_prompt_speech_token_len']
         return model_input
 
-    def frontend_vc(self, source_speech_16k, prompt_wav, resample_rate):
+    def _frontend_vc_prompt(self, prompt_wav):
+        prompt_wav = self.load_prompt_audio(prompt_wav)
         prompt_speech_token, prompt_speech_token_len = self._extract_speech_token(prompt_wav)
         prompt_speech_feat, prompt_speech_feat_len = self._extract_speech_feat(prompt_wav)
         embedding = self._extract_spk_embedding(prompt_wav)
+        return {'flow_prompt_speech_token': prompt_speech_token, 'flow_prompt_speech_token_len': prompt_speech_token_len,
+                'prompt_speech_feat': prompt_speech_feat, 'prompt_speech_feat_len': prompt_speech_feat_len,
+                'flow_embedding': embedding}
+
+    def frontend_vc(self, source_speech_16k, prompt_wav, resample_rate):
         source_speech_token, source_speech_token_len = self._extract_speech_token(source_speech_16k)
-        model_input = {'source_speech_token': source_speech_token, 'source_speech_token_len': source_speech_token_len,
-                       'flow_prompt_speech_token': prompt_speech_token, 'flow_prompt_speech_token_len': prompt_speech_token_len,
-                       'prompt_speech_feat': prompt_speech_feat, 'prompt_speech_feat_len': prompt_speech_feat_len,
-                       'flow_embedding': embedding}
+        model_input = {'source_speech_token': source_speech_token, 'source_speech_token_len': source_speech_token_len}
+        model_input.update(self._frontend_vc_prompt(prompt_wav))
         return model_input
+
+    def frontend_vc_chunks(self, source_wav, prompt_wav, resample_rate, chunk_sec=20, overlap_sec=2, snap_sec=1, min_last_sec=5, fade_sec=0.2):
+        """Jobs building the model_input of every chunk of a source of any length, each like frontend_vc.
+
+        A job reads and tokenizes only its own chunk with overlap_sec of context, so memory does not depend on the source
+        length and chunks can be converted while later ones are still tokenized. Chunks are about chunk_sec long, split
+        at the quietest point within snap_sec of the nominal border, the last one takes up to min_last_sec more. Every chunk
+        but the last also converts the first fade_sec of the next one, for the caller to crossfade.
+        """
+        reader = AudioReader(source_wav, 16000)
+        prompt_input = self._frontend_vc_prompt(prompt_wav)
+        chunk, overlap, snap = int(chunk_sec * 16000), int(overlap_sec * 16000), int(snap_sec * 16000)
+        # whole 40ms frames, so the faded region is whole speech tokens like the borders
+        fade = int(fade_sec * 16000) // 640 * 640
+        num_chunks = max(int(np.ceil((len(reader) - min_last_sec * 16000) / chunk)), 1)
+
+        def job(index):
+            start = self._chunk_border(reader, index * chunk, snap) if index > 0 else 0
+            end = min(self._chunk_border(reader, (index + 1) * chunk, snap) + fade, len(reader)) if index + 1 < num_chunks else len(reader)
+            source_speech_token, source_speech_token_len = self._extract_speech_token_window(reader, start, end, overlap)
+            return dict(prompt_input, source_speech_token=source_speech_token, source_speech_token_len=source_speech_token_len)
+        return [partial(job, i) for i in range(num_chunks)]
@@ -0,0 +1,150 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import base64
+import hashlib
+import json
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import soundfile
+import torch
+from cosyvoice.utils.file_utils import logging
+
+
+class LongFormSynthesizer:
+    """Synthesize a whole document sentence by sentence into one wav file.
+
+    Audio is appended to the wav as soon as a sentence is done, with a short crossfade between sentences of the same
+    paragraph and a pause between paragraphs. After every sentence a json manifest records how many sentences and
+    frames are final and the unfaded tail of the last one, so an interrupted job resumes from the last finished
+    sentence. Only lookahead + 1 sentences are held in memory at any time, whatever the length of the document.
+
+    With a vllm llm the lookahead + 1 sentences in flight are decoded in the same vllm engine steps, i.e. batched.
+    The huggingface llm path decodes one sequence per call, there the sentences in flight only overlap the llm of
+    the next sentences with flow and hift of the current one, so lookahead is capped at 1.
+    """
+
+    def __init__(self, cosyvoice, prompt_text, prompt_wav, instruct_text='', lookahead=2, crossfade=0.05, paragraph_pause=0.4, **kwargs):
+        assert hasattr(cosyvoice, 'inference_instruct2'), 'long form synthesis is only implemented for CosyVoice2/CosyVoice3!'
+        self.cosyvoice = cosyvoice
+        self.sample_rate = cosyvoice.sample_rate
+        self.prompt_text = cosyvoice.frontend.text_normalize(prompt_text, split=False)
+        self.instruct_text = instruct_text
+        if hasattr(cosyvoice.model.llm, 'vllm') is False and lookahead > 1:
+            logging.info('llm without vllm decodes one sentence per call, use lookahead 1 instead of {}'.format(lookahead))
+            lookahead = 1
+        self.lookahead = lookahead
+        self.crossfade_len = int(crossfade * self.sample_rate)
+        self.pause_len = int(paragraph_pause * self.sample_rate)
+        self.kwargs = kwargs
+        # register the prompt once, every sentence reuses its speech token, embedding and flow prompt cache
+        self.spk_id = 'longform_{}'.format(hashlib.md5('{}|{}|{}'.format(prompt_wav, self.prompt_text, instruct_text).encode()).hexdigest())
+        cosyvoice.add_zero_shot_spk(instruct_text if instruct_text != '' else self.prompt_text, prompt_wav, self.spk_id)
+
+    def split_document(self, document):
+        """Yield (paragraph index, sentence), paragraphs are separated by blank lines and normalized a few ahead on the text pool."""
+        paragraphs = (i.strip() for i in re.split(r'\n\s*\n', document))
+        paragraphs = (i for i in paragraphs if i != '')
+        pending = deque()
+        frontend = self.cosyvoice.frontend
+        for index, paragraph in enumerate(paragraphs):
+            # without a text pool every paragraph is normalized inline once its sentences are needed
+            pending.append((index, paragraph, frontend.text_normalize_async(paragraph, split=True) if frontend.text_pool is not None else None))
+            if len(pending) > self.lookahead:
+                yield from self._sentences(*pending.popleft())
+        while len(pending) != 0:
+            yield from self._sentences(*pending.popleft())
+
+    def _sentences(self, index, paragraph, future):
+        # future is None without a text pool or when it was full, the paragraph is normalized inline then
+        sentences = future.result() if future is not None else self.cosyvoice.frontend.text_normalize(paragraph, split=True)
+        for sentence in sentences:
+            yield index, sentence
+
+    def synthesize_sentence(self, sentence):
+        if self.instruct_text != '':
+            model_output = self.cosyvoice.inference_instruct2(sentence, self.instruct_text, '', zero_shot_spk_id=self.spk_id, stream=False,
+                                                              text_frontend=False, **self.kwargs)
+        else:
+            model_output = self.cosyvoice.inference_zero_shot(sentence, self.prompt_text, '', zero_shot_spk_id=self.spk_id, stream=False,
+                                                              text_frontend=False, **self.kwargs)
+        return torch.concat([i['tts_speech'] for i in model_output], dim=1).squeeze(dim=0).cpu().numpy()
+
+    def synthesize(self, document, output_path, manifest_path=None):
+        manifest_path = manifest_path if manifest_path is not None else '{}.json'.format(output_path)
+        # the checkpoint is only valid for the same document, voice and sample rate
+        key = hashlib.sha256('{}|{}|{}|{}'.format(document, self.spk_id, self.sample_rate, self.kwargs).encode()).hexdigest()
+        manifest = {'key': key, 'output': output_path, 'sample_rate': self.sample_rate, 'sentences': 0, 'frames': 0, 'paragraph': -1}
+        if os.path.exists(manifest_path) and os.path.exists(output_path):
+            with open(manifest_path, 'r') as f:
+                checkpoint = json.load(f)
+            if checkpoint['key'] == key:
+                manifest = checkpoint
+                logging.info('resume {} from sentence {}, {:.1f}s of audio done'.format(output_path, manifest['sentences'],
+                                                                                      manifest['frames'] / self.sample_rate))
+        if manifest['sentences'] != 0:
+            f = soundfile.SoundFile(output_path, mode='r+')
+            # drop audio of a sentence which was written but not checkpointed, and undo its crossfade into the last final sentence
+            f.truncate(manifest['frames'])
+            tail = np.frombuffer(base64.b64decode(manifest.get('tail', '')), dtype=np.float32)
+            f.seek(manifest['frames'] - len(tail))
+            f.write(tail)
+            f.flush()
+        else:
+            f = soundfile.SoundFile(output_path, mode='w+', samplerate=self.sample_rate, channels=1, subtype='PCM_16')
+        sentences = ((i, paragraph, sentence) for i, (paragraph, sentence) in enumerate(self.split_document(document)) if i >= manifest['sentences'])
+        start_time = time.time()
+        with f, ThreadPoolExecutor(max_workers=self.lookahead + 1) as executor:
+            pending = deque()
+            for i, paragraph, sentence in sentences:
+                pending.append((i, paragraph, executor.submit(self.synthesize_sentence, sentence)))
+                if len(pending) > self.lookahead:
+                    self._write(f, manifest, manifest_path, *pending.popleft())
+            while len(pending) != 0:
+                self._write(f, manifest, manifest_path, *pending.popleft())
+        logging.info('synthesized {} sentences, {:.1f}s of audio in {:.1f}s'.format(manifest['sentences'], manifest['frames'] / self.sample_rate,
+                                                                                   time.time() - start_time))
+        return manifest
+
+    def _write(self, f, manifest, manifest_path, i, paragraph, future):
+        speech = future.result()
+        f.seek(manifest['frames'])
+        if manifest['paragraph'] != paragraph and manifest['frames'] != 0:
+            f.write(np.zeros(self.pause_len, dtype=np.float32))
+        elif manifest['frames'] != 0:
+            n = min(self.crossfade_len, len(speech), manifest['frames'])
+            f.seek(manifest['frames'] - n)
+            tail = f.read(n, dtype='float32')
+            window = np.hamming(2 * n)
+            speech = speech.copy()
+            speech[:n] = speech[:n] * window[:n] + tail * window[n:]
+            f.seek(manifest['frames'] - n)
+        f.write(speech)
+        f.flush()
+        frames = f.tell()
+        # NOTE the next sentence fades into the last samples of this one in place, keep them unfaded in the manifest so a
+        # crash after that fade but before the next checkpoint is undone on resume instead of faded twice
+        n = min(self.crossfade_len, frames)
+        f.seek(frames - n)
+        tail = f.read(n, dtype='float32')
+        manifest.update({'sentences': i + 1, 'frames': frames, 'paragraph': paragraph,
+                         'tail': base64.b64encode(tail.astype(np.float32).tobytes()).decode()})
+        # NOTE write to a temporary file and rename, an interrupted write never leaves a broken manifest
+        with open('{}.tmp'.format(manifest_path), 'w') as fout:
+            json.dump(manifest, fout)
+        os.replace('{}.tmp'.format(manifest_path), manifest_path)
+        logging.info('sentence {} done, {:.1f}s of audio'.format(i, manifest['frames'] / self.sample_rate))
@@ -22,8 +22,10 @@ from torch.nn import functional as F
 from contextlib import nullcontext
 import uuid
 from cosyvoice.utils.common import fade_in_out
+from cosyvoice.utils.stream_utils import DegenerationDetector, StreamHopScheduler
 from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm
 from cosyvoice.utils.common import TrtContextWrapper
+from cosyvoice.utils.file_utils import logging
 
 
 class CosyVoiceModel:
@@ -32,13 +34,17 @@ class CosyVoiceModel:
                  llm: torch.nn.Module,
                  flow: torch.nn.Module,
                  hift: torch.nn.Module,
-                 fp16: bool = False):
+                 fp16: bool = False,
+                 preloaded=()):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.llm = llm
         self.flow = flow
         self.hift = hift
         self.fp16 = fp16
+        # components handed in already loaded by another model, the load functions leave them as they are
+        self.preloaded = set(preloaded)
         self.token_min_hop_len = 2 * self.flow.input_frame_rate
+        # stream hops are multiples of token_min_hop_len up to token_max_hop_len picked from the measured rtf, equal for fixed hops
         self.token_max_hop_len = 4 * self.flow.input_frame_rate
         self.token_overlap_len = 20
         # mel fade in out
@@ -50,8 +56,6 @@ class CosyVoiceModel:
         # speech fade in out
         self.speech_window = np.hamming(2 * self.source_cache_len)
         # rtf and decoding related
-        self.stream_scale_factor = 1
-        assert self.stream_scale_factor >= 1, 'stream_scale_factor should be greater than 1, change it according to your actual rtf'
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
         self.lock = threading.Lock()
         # dict used to store session related variable
@@ -61,27 +65,39 @@ class CosyVoiceModel:
         self.flow_cache_dict = {}
         self.hift_cache_dict = {}
         self.silent_tokens = []
+        # DegenerationDetector kwargs, None disables it, {} checks with the defaults. Generations cut short are counted per reason code
+        self.degeneration_kwargs = None
+        self.degeneration_count = {}
+        # uuids of sessions closed by the caller, their llm_job stops decoding
+        self.llm_stop = set()
 
     def load(self, llm_model, flow_model, hift_model):
-        self.llm.load_state_dict(torch.load(llm_model, map_location=self.device, weights_only=True), strict=True)
-        self.llm.to(self.device).eval()
-        self.flow.load_state_dict(torch.load(flow_model, map_location=self.device, weights_only=True), strict=True)
-        self.flow.to(self.device).eval()
-        # in case hift_model is a hifigan model
-        hift_state_dict = {k.replace('generator.', ''): v for k, v in torch.load(hift_model, map_location=self.device, weights_only=True).items()}
-        self.hift.load_state_dict(hift_state_dict, strict=True)
-        self.hift.to(self.device).eval()
+        if 'llm' not in self.preloaded:
+            self.llm.load_state_dict(torch.load(llm_model, map_location=self.device, weights_only=True), strict=True)
+            self.llm.to(self.device).eval()
+        if 'flow' not in self.preloaded:
+            self.flow.load_state_dict(torch.load(flow_model, map_location=self.device, weights_only=True), strict=True)
+            self.flow.to(self.device).eval()
+        if 'hift' not in self.preloaded:
+            # in case hift_model is a hifigan model
+            hift_state_dict = {k.replace('generator.', ''): v for k, v in torch.load(hift_model, map_location=self.device, weights_only=True).items()}
+            self.hift.load_state_dict(hift_state_dict, strict=True)
+            self.hift.to(self.device).eval()
 
     def load_jit(self, llm_text_encoder_model, llm_llm_model, flow_encoder_model):
-        llm_text_encoder = torch.jit.load(llm_text_encoder_model, map_location=self.device)
-        self.llm.text_encoder = llm_text_encoder
-        llm_llm = torch.jit.load(llm_llm_model, map_location=self.device)
-        self.llm.llm = llm_llm
-        flow_encoder = torch.jit.load(flow_encoder_model, map_location=self.device)
-        self.flow.encoder = flow_encoder
+        if 'llm' not in self.preloaded:
+            llm_text_encoder = torch.jit.load(llm_text_encoder_model, map_location=self.device)
+            self.llm.text_encoder = llm_text_encoder
+            llm_llm = torch.jit.load(llm_llm_model, map_location=self.device)
+            self.llm.llm = llm_llm
+        if 'flow' not in self.preloaded:
+            flow_encoder = torch.jit.load(flow_encoder_model, map_location=self.device)
+            self.flow.encoder = flow_encoder
 
     def load_trt(self, flow_decoder_estimator_model, flow_decoder_onnx_model, trt_concurrent, fp16):
         assert torch.cuda.is_available(), 'tensorrt only supports gpu!'
+        if 'flow' in self.preloaded:
+            return
         if not os.path.exists(flow_decoder_estimator_model) or os.path.getsize(flow_decoder_estimator_model) == 0:
             convert_onnx_to_trt(flow_decoder_estimator_model, self.get_trt_kwargs(), flow_decoder_onnx_model, fp16)
         del self.flow.decoder.estimator
@@ -91,6 +107,32 @@ class CosyVoiceModel:
         assert estimator_engine is not None, 'failed to load trt {}'.format(flow_decoder_estimator_model)
         self.flow.decoder.estimator = TrtContextWrapper(estimator_engine, trt_concurrent=trt_concurrent, device=self.device)
 
+    def load_onnx_cpu(self, model_dir, int8=False, num_threads=0, concurrent=1, reserved_threads=0):
+        """Run the flow decoder estimator, the flow pre lookahead layer if exported and the hift upsampling body in
+        onnxruntime on cpu, export them with cosyvoice/bin/export_onnx.py --cpu [--int8]. The f0 predictor, source,
+        stft and the flow encoder stay in torch. num_threads 0 splits the cores but reserved_threads between the
+        concurrent sessions.
+        """
+        assert torch.cuda.is_available() is False, 'the onnx cpu profile only runs on cpu!'
+        from cosyvoice.cli.frontend import OnnxSessionPool
+        from cosyvoice.transformer.upsample_encoder import OnnxPreLookaheadLayer
+        suffix = 'int8' if int8 is True else 'fp32'
+        # split the cores between concurrent sessions, spinning threads of one session would starve the others
+        num_threads = num_threads if num_threads > 0 else max(((os.cpu_count() or 1) - reserved_threads) // concurrent, 1)
+        kwargs = {'providers': ['CPUExecutionProvider'], 'pool_size': concurrent, 'num_threads': num_threads, 'allow_spinning': concurrent == 1}
+        if 'flow' not in self.preloaded:
+            estimator_model = '{}/flow.decoder.estimator.{}.onnx'.format(model_dir, suffix)
+            assert os.path.exists(estimator_model), '{} not found, export it with cosyvoice/bin/export_onnx.py --cpu'.format(estimator_model)
+            del self.flow.decoder.estimator
+            self.flow.decoder.estimator = OnnxSessionPool(estimator_model, **kwargs)
+            pre_lookahead_model = '{}/flow.pre_lookahead_layer.{}.onnx'.format(model_dir, suffix)
+            if hasattr(self.flow, 'pre_lookahead_layer') and os.path.exists(pre_lookahead_model):
+                self.flow.pre_lookahead_layer = OnnxPreLookaheadLayer(self.flow.pre_lookahead_layer, OnnxSessionPool(pre_lookahead_model, **kwargs))
+        hift_model = '{}/hift.decode_body.{}.onnx'.format(model_dir, suffix)
+        if 'hift' not in self.preloaded and os.path.exists(hift_model):
+            self.hift.body_session = OnnxSessionPool(hift_model, **kwargs)
+        logging.info('onnx cpu profile {} with {} sessions of {} threads'.format(suffix, concurrent, num_threads))
+
     def get_trt_kwargs(self):
         min_shape = [(2, 80, 4), (2, 1, 4), (2, 80, 4), (2, 80, 4)]
         opt_shape = [(2, 80, 500), (2, 1, 500), (2, 80, 500), (2, 80, 500)]
@@ -102,13 +144,14 @@ class CosyVoiceModel:
         cur_silent_token_num, max_silent_token_num = 0, 5
         with self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False):
             if isinstance(text, Generator):
-                assert (self.__class__.__name__ != 'CosyVoiceModel') and not hasattr(self.llm, 'vllm'), 'streaming input text is only implemented for CosyVoice2/3 and do not support vllm!'
+                assert self.__class__.__name__ != 'CosyVoiceModel', 'streaming input text is only implemented for CosyVoice2/3!'
                 token_generator = self.llm.inference_bistream(text=text,
                                                               prompt_text=prompt_text.to(self.device),
                                                               prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
                                                               prompt_speech_token=llm_prompt_speech_token.to(self.device),
                                                               prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                                              embedding=llm_embedding.to(self.device))
+                                                              embedding=llm_embedding.to(self.device),
+                                                              uuid=uuid)
             else:
                 token_generator = self.llm.inference(text=text.to(self.device),
                                                      text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
@@ -117,8 +160,23 @@ class CosyVoiceModel:
                                                      prompt_speech_token=llm_prompt_speech_token.to(self.device),
                                                      prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
                                                      embedding=llm_embedding.to(self.device),
-                                                     uuid=uuid)  
+                                                     uuid=uuid)
+            detector = None
+            if self.degeneration_kwargs is not None:
+                detector = DegenerationDetector(text_len=None if isinstance(text, Generator) else text.shape[1], silent_tokens=self.silent_tokens,
+                                                **dict({'token_rate': self.flow.input_frame_rate}, **self.degeneration_kwargs))
             for i in token_generator:
+                if uuid in self.llm_stop:
+                    token_generator.close()
+                    break
+                reason = detector.update(i) if detector is not None else None
+                if reason is not None:
+                    # closing the generator stops decoding, a vllm request is aborted
+                    token_generator.close()
+                    with self.lock:
+                        self.degeneration_count[reason] = self.degeneration_count.get(reason, 0) + 1
+                    logging.warning('stop degenerate generation {} after {} speech tokens, reason {}'.format(uuid, detector.num_tokens, reason))
+                    break
                 if i in self.silent_tokens:
                     cur_silent_token_num += 1
                     if cur_silent_token_num > max_silent_token_num:
@@ -128,11 +186,19 @@ class CosyVoiceModel:
                 self.tts_speech_token_dict[uuid].append(i)
         self.llm_end_dict[uuid] = True
 
+    def stop_llm_job(self, uuid, p):
+        if p.is_alive():
+            with self.lock:
+                self.llm_stop.add(uuid)
+            p.join()
+        with self.lock:
+            self.llm_stop.discard(uuid)
+
     def vc_job(self, source_speech_token, uuid):
         self.tts_speech_token_dict[uuid] = source_speech_token.flatten().tolist()
         self.llm_end_dict[uuid] = True
 
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0):
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0, n_timesteps=10, solver=None, cfg_strategy=None):
         with torch.cuda.amp.autocast(self.fp16):
             tts_mel, self.flow_cache_dict[uuid] = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
                                                                       token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
@@ -141,7 +207,9 @@ class CosyVoiceModel:
                                                                       prompt_feat=prompt_feat.to(self.device),
                                                                       prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
                                                                       embedding=embedding.to(self.device),
-                                                                      flow_cache=self.flow_cache_dict[uuid])
+                                                                      flow_cache=self.flow_cache_dict[uuid],
+                                                                      n_timesteps=n_timesteps,
+                                                                      solver=solver, cfg_strategy=cfg_strategy)
 
         # mel overlap fade in out
         if self.mel_overlap_dict[uuid].shape[2] != 0:
@@ -176,7 +244,8 @@ class CosyVoiceModel:
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
+            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0,
+            n_timesteps=10, solver=None, cfg_strategy=None, **kwargs):
         # this_uuid is used to track variables related to this inference thread
         this_uuid = str(uuid.uuid1())
         with self.lock:
@@ -189,57 +258,69 @@ class CosyVoiceModel:
         else:
             p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
         p.start()
-        if stream is True:
-            token_hop_len = self.token_min_hop_len
-            while True:
-                time.sleep(0.1)
-                if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
-                        .unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                                     prompt_token=flow_prompt_speech_token,
-                                                     prompt_feat=prompt_speech_feat,
-                                                     embedding=flow_embedding,
-                                                     uuid=this_uuid,
-                                                     finalize=False)
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                    with self.lock:
-                        self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
-                    # increase token_hop_len for better speech quality
-                    token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.mel_overlap_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
-            self.flow_cache_dict.pop(this_uuid)
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            torch.cuda.current_stream().synchronize()
+        try:
+            if stream is True:
+                scheduler = StreamHopScheduler(self.token_min_hop_len, self.token_max_hop_len // self.token_min_hop_len, self.flow.input_frame_rate)
+                token_hop_len = scheduler.hop_len()
+                while True:
+                    time.sleep(0.1)
+                    if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
+                        this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
+                            .unsqueeze(dim=0)
+                        this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                         prompt_token=flow_prompt_speech_token,
+                                                         prompt_feat=prompt_speech_feat,
+                                                         embedding=flow_embedding,
+                                                         uuid=this_uuid,
+                                                         finalize=False,
+                                                         n_timesteps=n_timesteps,
+                                                         solver=solver, cfg_strategy=cfg_strategy)
+                        scheduler.update(token_hop_len)
+                        yield {'tts_speech': this_tts_speech.cpu()}
+                        with self.lock:
+                            self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
+                        # longer hops for better speech quality and less per chunk overhead while the client has audio buffered
+                        token_hop_len = scheduler.hop_len()
+                    if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
+                        break
+                p.join()
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 uuid=this_uuid,
+                                                 finalize=True,
+                                                 n_timesteps=n_timesteps,
+                                                 solver=solver, cfg_strategy=cfg_strategy)
+                yield {'tts_speech': this_tts_speech.cpu()}
+            else:
+                # deal with all tokens
+                p.join()
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 uuid=this_uuid,
+                                                 finalize=True,
+                                                 speed=speed,
+                                                 n_timesteps=n_timesteps,
+                                                 solver=solver, cfg_strategy=cfg_strategy)
+                yield {'tts_speech': this_tts_speech.cpu()}
+        finally:
+            # also runs when the caller closes the generator early, the llm thread stops after its current token
+            self.stop_llm_job(this_uuid, p)
+            with self.lock:
+                self.tts_speech_token_dict.pop(this_uuid)
+                self.llm_end_dict.pop(this_uuid)
+                self.mel_overlap_dict.pop(this_uuid)
+                self.hift_cache_dict.pop(this_uuid)
+                self.flow_cache_dict.pop(this_uuid)
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+                torch.cuda.current_stream().synchronize()
 
 
 class CosyVoice2Model(CosyVoiceModel):
@@ -248,14 +329,19 @@ class CosyVoice2Model(CosyVoiceModel):
                  llm: torch.nn.Module,
                  flow: torch.nn.Module,
                  hift: torch.nn.Module,
-                 fp16: bool = False):
+                 fp16: bool = False,
+                 preloaded=()):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.llm = llm
         self.flow = flow
         self.hift = hift
         self.fp16 = fp16
+        # components handed in already loaded by another model, the load functions leave them as they are
+        self.preloaded = set(preloaded)
         # NOTE must matching training static_chunk_size
         self.token_hop_len = 25
+        # stream hops after the first are up to this many token_hop_len, picked from the measured rtf, 1 for fixed hops
+        self.token_max_hop_multiple = 4
         # hift cache
         self.mel_cache_len = 8
         self.source_cache_len = int(self.mel_cache_len * 480)
@@ -269,23 +355,54 @@ class CosyVoice2Model(CosyVoiceModel):
         self.llm_end_dict = {}
         self.hift_cache_dict = {}
         self.silent_tokens = []
+        # DegenerationDetector kwargs, None disables it, {} checks with the defaults. Generations cut short are counted per reason code
+        self.degeneration_kwargs = None
+        self.degeneration_count = {}
+        # uuids of sessions closed by the caller, their llm_job stops decoding
+        self.llm_stop = set()
 
     def load_jit(self, flow_encoder_model):
+        if 'flow' in self.preloaded:
+            return
         flow_encoder = torch.jit.load(flow_encoder_model, map_location=self.device)
         self.flow.encoder = flow_encoder
 
     def load_vllm(self, model_dir):
+        # NOTE a shared llm already runs its engine, a second one would reserve its own share of the gpu
+        if 'llm' in self.preloaded:
+            return
         export_cosyvoice2_vllm(self.llm, model_dir, self.device)
         from vllm import EngineArgs, LLMEngine
         engine_args = EngineArgs(model=model_dir,
                                  skip_tokenizer_init=True,
                                  enable_prompt_embeds=True,
+                                 # [sos, prompt_text] leads every lm_input, so sentences sharing a prompt hit the prefix cache
+                                 enable_prefix_caching=True,
                                  gpu_memory_utilization=0.2)
         self.llm.vllm = LLMEngine.from_engine_args(engine_args)
+        # the engine reserves this share of the gpu for llm weights and kv cache, the model registry counts it
+        self.llm.vllm_memory = int(engine_args.gpu_memory_utilization * torch.cuda.get_device_properties(self.device).total_memory)
         self.llm.lock = threading.Lock()
         del self.llm.llm.model.model.layers
 
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
+    def load_static_decode(self, compile=False):
+        assert not hasattr(self.llm, 'vllm'), 'static kv cache decode is only used by the huggingface llm path'
+        if 'llm' in self.preloaded:
+            return
+        self.llm.static_decode = True
+        if compile is True:
+            self.llm.llm.compile_static()
+
+    def prepare_flow_prompt(self, prompt_token, prompt_feat, embedding):
+        with torch.cuda.amp.autocast(self.fp16):
+            return self.flow.prepare_prompt(prompt_token=prompt_token.to(self.device),
+                                            prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                                            prompt_feat=prompt_feat.to(self.device),
+                                            prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                                            embedding=embedding.to(self.device))
+
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0, n_timesteps=10, solver=None, cfg_strategy=None,
+                  prompt_cache=None):
         with torch.cuda.amp.autocast(self.fp16):
             tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
                                              token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
@@ -295,7 +412,10 @@ class CosyVoice2Model(CosyVoiceModel):
                                              prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
                                              embedding=embedding.to(self.device),
                                              streaming=stream,
-                                             finalize=finalize)
+                                             finalize=finalize,
+                                             n_timesteps=n_timesteps,
+                                             solver=solver, cfg_strategy=cfg_strategy,
+                                             prompt_cache=prompt_cache)
         tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
         # append hift cache
         if self.hift_cache_dict[uuid] is not None:
@@ -325,9 +445,12 @@ class CosyVoice2Model(CosyVoiceModel):
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
+            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0,
+            n_timesteps=10, solver=None, cfg_strategy=None, flow_prompt_cache=None, **kwargs):
         # this_uuid is used to track variables related to this inference thread
         this_uuid = str(uuid.uuid1())
+        if flow_prompt_cache is None:
+            flow_prompt_cache = self.prepare_flow_prompt(flow_prompt_speech_token, prompt_speech_feat, flow_embedding)
         with self.lock:
             self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
             self.hift_cache_dict[this_uuid] = None
@@ -336,57 +459,74 @@ class CosyVoice2Model(CosyVoiceModel):
         else:
             p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
         p.start()
-        if stream is True:
-            token_offset = 0
-            prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
-            while True:
-                time.sleep(0.1)
-                this_token_hop_len = self.token_hop_len + prompt_token_pad if token_offset == 0 else self.token_hop_len
-                if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]).unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                                     prompt_token=flow_prompt_speech_token,
-                                                     prompt_feat=prompt_speech_feat,
-                                                     embedding=flow_embedding,
-                                                     token_offset=token_offset,
-                                                     uuid=this_uuid,
-                                                     stream=stream,
-                                                     finalize=False)
-                    token_offset += this_token_hop_len
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=token_offset,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
-            p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=0,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            torch.cuda.current_stream().synchronize()
+        try:
+            if stream is True:
+                token_offset = 0
+                prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
+                # hops stay multiples of token_hop_len, so chunks keep aligned with the chunk size of training
+                scheduler = StreamHopScheduler(self.token_hop_len, self.token_max_hop_multiple, self.flow.input_frame_rate)
+                this_token_hop_len = scheduler.hop_len() + prompt_token_pad
+                while True:
+                    time.sleep(0.1)
+                    if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
+                        this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]).unsqueeze(dim=0)
+                        this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                         prompt_token=flow_prompt_speech_token,
+                                                         prompt_feat=prompt_speech_feat,
+                                                         embedding=flow_embedding,
+                                                         token_offset=token_offset,
+                                                         uuid=this_uuid,
+                                                         stream=stream,
+                                                         finalize=False,
+                                                         n_timesteps=n_timesteps,
+                                                         solver=solver, cfg_strategy=cfg_strategy,
+                                                         prompt_cache=flow_prompt_cache)
+                        token_offset += this_token_hop_len
+                        scheduler.update(this_token_hop_len)
+                        yield {'tts_speech': this_tts_speech.cpu()}
+                        this_token_hop_len = scheduler.hop_len()
+                    if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
+                        break
+                p.join()
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 token_offset=token_offset,
+                                                 uuid=this_uuid,
+                                                 finalize=True,
+                                                 n_timesteps=n_timesteps,
+                                                 solver=solver, cfg_strategy=cfg_strategy,
+                                                 prompt_cache=flow_prompt_cache)
+                yield {'tts_speech': this_tts_speech.cpu()}
+            else:
+                # deal with all tokens
+                p.join()
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+                this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                 prompt_token=flow_prompt_speech_token,
+                                                 prompt_feat=prompt_speech_feat,
+                                                 embedding=flow_embedding,
+                                                 token_offset=0,
+                                                 uuid=this_uuid,
+                                                 finalize=True,
+                                                 speed=speed,
+                                                 n_timesteps=n_timesteps,
+                                                 solver=solver, cfg_strategy=cfg_strategy,
+                                                 prompt_cache=flow_prompt_cache)
+                yield {'tts_speech': this_tts_speech.cpu()}
+        finally:
+            # also runs when the caller closes the generator early, the llm thread stops after its current token
+            self.stop_llm_job(this_uuid, p)
+            with self.lock:
+                self.tts_speech_token_dict.pop(this_uuid)
+                self.llm_end_dict.pop(this_uuid)
+                self.hift_cache_dict.pop(this_uuid)
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+                torch.cuda.current_stream().synchronize()
 
 
 class CosyVoice3Model(CosyVoice2Model):
@@ -395,14 +535,19 @@ class CosyVoice3Model(CosyVoice2Model):
                  llm: torch.nn.Module,
                  flow: torch.nn.Module,
                  hift: torch.nn.Module,
-                 fp16: bool = False):
+                 fp16: bool = False,
+                 preloaded=()):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.llm = llm
         self.flow = flow
         self.hift = hift
         self.fp16 = fp16
+        # components handed in already loaded by another model, the load functions leave them as they are
+        self.preloaded = set(preloaded)
         # NOTE must matching training static_chunk_size
         self.token_hop_len = 25
+        # stream hops after the first are up to this many token_hop_len, picked from the measured rtf, 1 for fixed hops
+        self.token_max_hop_multiple = 4
         # rtf and decoding related
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
         self.lock = threading.Lock()
@@ -412,8 +557,14 @@ class CosyVoice3Model(CosyVoice2Model):
         self.hift_cache_dict = {}
         # FSQ silent and breath token
         self.silent_tokens = [1, 2, 28, 29, 55, 248, 494, 2241, 2242, 2322, 2323]
+        # DegenerationDetector kwargs, None disables it, {} checks with the defaults. Generations cut short are counted per reason code
+        self.degeneration_kwargs = None
+        self.degeneration_count = {}
+        # uuids of sessions closed by the caller, their llm_job stops decoding
+        self.llm_stop = set()
 
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0, n_timesteps=10, solver=None, cfg_strategy=None,
+                  prompt_cache=None):
         with torch.cuda.amp.autocast(self.fp16):
             tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
                                              token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
@@ -423,7 +574,10 @@ class CosyVoice3Model(CosyVoice2Model):
                                              prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
                                              embedding=embedding.to(self.device),
                                              streaming=stream,
-                                             finalize=finalize)
+                                             finalize=finalize,
+                                             n_timesteps=n_timesteps,
+                                             solver=solver, cfg_strategy=cfg_strategy,
+                                             prompt_cache=prompt_cache)
             tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
             # append mel cache
             if self.hift_cache_dict[uuid] is not None:
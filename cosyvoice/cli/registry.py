@@ -0,0 +1,269 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import gc
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import numpy as np
+import torch
+from modelscope import snapshot_download
+from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.utils.file_utils import logging, file_hash
+
+# NOTE llm, flow and hift modules loaded from identical checkpoints with identical load options, values are weak so a
+# module is freed with the last model using it
+shared_modules = weakref.WeakValueDictionary()
+# load options that change a component, e.g. a model with vllm and one without still share flow and hift
+COMPONENT_OPTIONS = {'llm': ('load_jit', 'load_vllm', 'load_static_decode', 'fp16'), 'flow': ('load_jit', 'load_trt', 'fp16', 'trt_concurrent', 'load_onnx_cpu', 'onnx_cpu_int8', 'onnx_cpu_num_threads'),
+                     'hift': ('load_onnx_cpu', 'onnx_cpu_int8', 'onnx_cpu_num_threads')}
+
+
+def parse_models(models):
+    """Parse 'name=model_dir,name=model_dir' into an ordered dict."""
+    result = OrderedDict()
+    for item in models.split(','):
+        if item.strip() == '':
+            continue
+        name, model_dir = item.split('=', 1)
+        result[name.strip()] = model_dir.strip()
+    return result
+
+
+def model_yaml(model_dir):
+    # the config AutoModel picks the model class by
+    for name in ['cosyvoice.yaml', 'cosyvoice2.yaml', 'cosyvoice3.yaml']:
+        if os.path.exists('{}/{}'.format(model_dir, name)):
+            return name
+    raise TypeError('No valid model type found!')
+
+
+def tensor_storages(module):
+    # storage pointer -> bytes of every parameter and buffer, a tensor shared by two modules counts once
+    storages = {}
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        storages[tensor.untyped_storage().data_ptr()] = tensor.untyped_storage().nbytes()
+    # NOTE a vllm engine holds the llm weights and its kv cache outside the module, count the memory it reserved
+    if getattr(module, 'vllm_memory', 0) > 0:
+        storages[('vllm', id(module))] = module.vllm_memory
+    return storages
+
+
+class MemoryBudget:
+    """A memory limit in bytes shared by every registry of a process that is given the same instance, e.g. the single
+    and vllm processors of the worker, so their models together stay within it. 0 means no limit.
+    """
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.registries = weakref.WeakSet()
+        self.lock = threading.Lock()
+
+    def used(self):
+        storages = {}
+        for registry in list(self.registries):
+            storages.update(registry._loaded_storages())
+        return sum(storages.values())
+
+
+class ModelEntry:
+    def __init__(self, name, kwargs):
+        self.name = name
+        self.kwargs = kwargs
+        self.model = None
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.requests = 0
+        self.last_used = 0.0
+        self.load_time = 0.0
+        self.latency = deque(maxlen=1000)
+
+
+class ModelRegistry:
+    """Several CosyVoice models in one process, loaded on first use and routed by name.
+
+    Components that are identical between models are loaded once: the frontend shares tokenizers, onnx sessions and
+    the text normalizers by content hash, and the registry shares llm, flow and hift modules whose checkpoint and
+    load options match, e.g. the hift of fine-tunes of the same base model. When memory_budget bytes is exceeded the
+    least recently used models without requests in flight are unloaded, a model is loaded again on its next request.
+    memory_budget is a byte count or a MemoryBudget shared with other registries, the memory a vllm engine reserves
+    for its weights and kv cache counts towards it.
+    """
+
+    def __init__(self, models=None, memory_budget=0, default=None, on_load=None, **kwargs):
+        self.entries = OrderedDict()
+        self.budget = memory_budget if isinstance(memory_budget, MemoryBudget) else MemoryBudget(memory_budget)
+        self.budget.registries.add(self)
+        # called with every freshly loaded model, e.g. to start its text pool
+        self.on_load = on_load
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+        for name, model_dir in (models or {}).items():
+            self.register(name, model_dir)
+        self.default = default if default is not None else next(iter(self.entries), None)
+
+    def register(self, name, model_dir, **kwargs):
+        """Make a model available under name, it is loaded on its first request. kwargs override the registry wide AutoModel kwargs."""
+        self.entries[name] = ModelEntry(name, dict(self.kwargs, model_dir=model_dir, **kwargs))
+        if getattr(self, 'default', None) is None:
+            self.default = name
+
+    def names(self):
+        return list(self.entries.keys())
+
+    def resolve(self, name):
+        name = name if name else self.default
+        if name not in self.entries:
+            raise KeyError('unknown model {}, available models {}'.format(name, self.names()))
+        return name
+
+    def get(self, name=None, load=True):
+        """Return the model, loading it if needed. With load=False return None for a model that is not loaded."""
+        entry = self.entries[self.resolve(name)]
+        if entry.model is None and load is True:
+            with entry.lock:
+                if entry.model is None:
+                    self._load(entry)
+        with self.lock:
+            self.entries.move_to_end(entry.name)
+            entry.last_used = time.time()
+        return entry.model
+
+    def acquire(self, name=None):
+        """Return the model and count a request in flight, an in flight model is never unloaded. Pair with release."""
+        name = self.resolve(name)
+        with self.lock:
+            self.entries[name].in_flight += 1
+        try:
+            return self.get(name)
+        except Exception:
+            with self.lock:
+                self.entries[name].in_flight -= 1
+            raise
+
+    def release(self, name=None, latency=None):
+        entry = self.entries[self.resolve(name)]
+        with self.lock:
+            entry.in_flight -= 1
+            entry.requests += 1
+            if latency is not None:
+                entry.latency.append(latency)
+
+    @contextmanager
+    def use(self, name=None):
+        start_time = time.time()
+        model = self.acquire(name)
+        try:
+            yield model
+        finally:
+            self.release(name, time.time() - start_time)
+
+    def _load(self, entry):
+        start_time = time.time()
+        kwargs = dict(entry.kwargs)
+        if not os.path.exists(kwargs['model_dir']):
+            kwargs['model_dir'] = snapshot_download(kwargs['model_dir'])
+        # components of an already loaded model are handed to the new one before it is built, so a shared component
+        # is never loaded twice, e.g. a second vllm engine never starts
+        keys, components = {}, {}
+        for component in ['llm', 'flow', 'hift']:
+            options = tuple((k, kwargs.get(k)) for k in COMPONENT_OPTIONS[component])
+            keys[component] = (component, model_yaml(kwargs['model_dir']), file_hash('{}/{}.pt'.format(kwargs['model_dir'], component)), options)
+            module = shared_modules.get(keys[component])
+            if module is not None:
+                components[component] = module
+                logging.info('model {} shares {} with an already loaded model'.format(entry.name, component))
+        model = AutoModel(**kwargs, components=components)
+        for component, key in keys.items():
+            if component not in components:
+                shared_modules[key] = getattr(model.model, component)
+        if self.on_load is not None:
+            self.on_load(model)
+        entry.model = model
+        entry.load_time = time.time() - start_time
+        logging.info('loaded model {} in {:.1f}s, {:.1f}MB'.format(entry.name, entry.load_time, self.model_memory(entry.name)[0] / 2 ** 20))
+        self._evict(keep=entry.name)
+
+    def _storages(self, model):
+        storages = {}
+        for component in ['llm', 'flow', 'hift']:
+            storages.update(tensor_storages(getattr(model.model, component)))
+        return storages
+
+    def model_memory(self, name):
+        """Return (bytes of the model's weights, bytes of them shared with other loaded models)."""
+        entry = self.entries[self.resolve(name)]
+        if entry.model is None:
+            return 0, 0
+        storages = self._storages(entry.model)
+        others = {}
+        for other in self.entries.values():
+            if other is not entry and other.model is not None:
+                others.update(self._storages(other.model))
+        return sum(storages.values()), sum(v for k, v in storages.items() if k in others)
+
+    def _loaded_storages(self):
+        storages = {}
+        for entry in list(self.entries.values()):
+            model = entry.model
+            if model is not None:
+                storages.update(self._storages(model))
+        return storages
+
+    def total_memory(self):
+        return sum(self._loaded_storages().values())
+
+    def _unload(self, entry):
+        with self.lock:
+            if entry.in_flight != 0 or entry.model is None:
+                return
+            model, entry.model = entry.model, None
+        logging.info('unload idle model {} to stay within the memory budget'.format(entry.name))
+        del model
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _evict(self, keep=None):
+        if self.budget.limit <= 0:
+            return
+        with self.budget.lock:
+            # least recently used first, over the models of every registry sharing the budget
+            candidates = [(entry.last_used, registry, entry) for registry in list(self.budget.registries) for entry in list(registry.entries.values())
+                          if entry.model is not None and not (registry is self and entry.name == keep)]
+            for _, registry, entry in sorted(candidates, key=lambda i: i[0]):
+                if self.budget.used() <= self.budget.limit:
+                    return
+                registry._unload(entry)
+            if self.budget.used() > self.budget.limit:
+                logging.warning('loaded models use {:.1f}MB, above the {:.1f}MB budget, every other model is busy'.format(
+                    self.budget.used() / 2 ** 20, self.budget.limit / 2 ** 20))
+
+    def stats(self):
+        """Per model memory, request count, latency percentiles, degenerate generations by reason and prompt prefix kv cache
+        hits, for logging or a metrics endpoint.
+        """
+        stats = {}
+        for name, entry in list(self.entries.items()):
+            memory, shared = self.model_memory(name)
+            latency = list(entry.latency)
+            stats[name] = {'model_dir': entry.kwargs['model_dir'], 'loaded': entry.model is not None, 'load_time': entry.load_time,
+                           'memory_mb': memory / 2 ** 20, 'shared_mb': shared / 2 ** 20, 'in_flight': entry.in_flight, 'requests': entry.requests,
+                           'latency_p50': float(np.percentile(latency, 50)) if len(latency) != 0 else None,
+                           'latency_p90': float(np.percentile(latency, 90)) if len(latency) != 0 else None,
+                           'degenerate': dict(entry.model.model.degeneration_count) if entry.model is not None else {},
+                           'prefix_cache': dict(getattr(entry.model.model.llm, 'prefix_cache_stats', {})) if entry.model is not None else {}}
+        return stats
@@ -107,7 +107,10 @@ class MaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  flow_cache):
+                  flow_cache,
+                  n_timesteps=10,
+                  solver=None,
+                  cfg_strategy=None):
         assert token.shape[0] == 1
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
@@ -136,9 +139,11 @@ class MaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
+            n_timesteps=n_timesteps,
             prompt_len=mel_len1,
-            cache=flow_cache
+            cache=flow_cache,
+            solver=solver,
+            cfg_strategy=cfg_strategy
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
@@ -226,6 +231,19 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         )
         return {'loss': loss}
 
+    @torch.inference_mode()
+    def prepare_prompt(self, prompt_token, prompt_token_len, prompt_feat, prompt_feat_len, embedding):
+        """Speaker constant inputs of inference, pass the result as prompt_cache to reuse it across chunks and sentences.
+        NOTE the encoder attends across the prompt and target tokens, so the encoded prompt can not be cached here.
+        """
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+
+        mask = (~make_pad_mask(prompt_token_len)).unsqueeze(-1).to(embedding)
+        prompt_token = self.input_embedding(torch.clamp(prompt_token, min=0)) * mask
+        return {'spks': embedding, 'prompt_token': prompt_token, 'prompt_conds': prompt_feat.transpose(1, 2)}
+
     @torch.inference_mode()
     def inference(self,
                   token,
@@ -236,16 +254,20 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat_len,
                   embedding,
                   streaming,
-                  finalize):
+                  finalize,
+                  n_timesteps=10,
+                  solver=None,
+                  cfg_strategy=None,
+                  prompt_cache=None):
         assert token.shape[0] == 1
-        # xvec projection
-        embedding = F.normalize(embedding, dim=1)
-        embedding = self.spk_embed_affine_layer(embedding)
+        if prompt_cache is None:
+            prompt_cache = self.prepare_prompt(prompt_token, prompt_token_len, prompt_feat, prompt_feat_len, embedding)
+        embedding = prompt_cache['spks']
 
         # concat text and prompt_text
-        token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
+        token_len = prompt_token_len + token_len
         mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
-        token = self.input_embedding(torch.clamp(token, min=0)) * mask
+        token = torch.concat([prompt_cache['prompt_token'], self.input_embedding(torch.clamp(token, min=0))], dim=1) * mask
 
         # text encode
         if finalize is True:
@@ -257,9 +279,8 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         h = self.encoder_proj(h)
 
         # get conditions
-        conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
-        conds[:, :mel_len1] = prompt_feat
-        conds = conds.transpose(1, 2)
+        conds = torch.zeros([1, self.output_size, mel_len1 + mel_len2], device=token.device).to(h.dtype)
+        conds[:, :, :mel_len1] = prompt_cache['prompt_conds']
 
         mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
         feat, _ = self.decoder(
@@ -267,8 +288,10 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
-            streaming=streaming
+            n_timesteps=n_timesteps,
+            streaming=streaming,
+            solver=solver,
+            cfg_strategy=cfg_strategy
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
@@ -355,6 +378,20 @@ class CausalMaskedDiffWithDiT(torch.nn.Module):
         )
         return {'loss': loss}
 
+    @torch.inference_mode()
+    def prepare_prompt(self, prompt_token, prompt_token_len, prompt_feat, prompt_feat_len, embedding):
+        """Speaker constant inputs of inference, pass the result as prompt_cache to reuse it across chunks and sentences.
+        prompt_h keeps the pre lookahead output of the prompt positions that do not look ahead into the target tokens.
+        """
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+
+        mask = (~make_pad_mask(prompt_token_len)).unsqueeze(-1).to(embedding)
+        prompt_token = self.input_embedding(torch.clamp(prompt_token, min=0)) * mask
+        prompt_h = self.pre_lookahead_layer(prompt_token)[:, :max(prompt_token.shape[1] - self.pre_lookahead_len, 0)]
+        return {'spks': embedding, 'prompt_token': prompt_token, 'prompt_conds': prompt_feat.transpose(1, 2), 'prompt_h': prompt_h}
+
     @torch.inference_mode()
     def inference(self,
                   token,
@@ -365,29 +402,36 @@ class CausalMaskedDiffWithDiT(torch.nn.Module):
                   prompt_feat_len,
                   embedding,
                   streaming,
-                  finalize):
+                  finalize,
+                  n_timesteps=10,
+                  solver=None,
+                  cfg_strategy=None,
+                  prompt_cache=None):
         assert token.shape[0] == 1
-        # xvec projection
-        embedding = F.normalize(embedding, dim=1)
-        embedding = self.spk_embed_affine_layer(embedding)
+        if prompt_cache is None:
+            prompt_cache = self.prepare_prompt(prompt_token, prompt_token_len, prompt_feat, prompt_feat_len, embedding)
+        embedding = prompt_cache['spks']
 
         # concat text and prompt_text
-        token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
+        token_len = prompt_token_len + token_len
         mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
-        token = self.input_embedding(torch.clamp(token, min=0)) * mask
+        token = torch.concat([prompt_cache['prompt_token'], self.input_embedding(torch.clamp(token, min=0))], dim=1) * mask
 
-        # text encode
+        # text encode, only recompute from the first prompt position that sees the target tokens,
+        # plus the left receptive field of the causal conv
+        stable_len = prompt_cache['prompt_h'].shape[1]
+        start = max(stable_len - (self.pre_lookahead_layer.conv2.kernel_size[0] - 1), 0)
         if finalize is True:
-            h = self.pre_lookahead_layer(token)
+            h = self.pre_lookahead_layer(token[:, start:])
         else:
-            h = self.pre_lookahead_layer(token[:, :-self.pre_lookahead_len], context=token[:, -self.pre_lookahead_len:])
+            h = self.pre_lookahead_layer(token[:, start:-self.pre_lookahead_len], context=token[:, -self.pre_lookahead_len:])
+        h = torch.concat([prompt_cache['prompt_h'], h[:, stable_len - start:]], dim=1)
         h = h.repeat_interleave(self.token_mel_ratio, dim=1)
         mel_len1, mel_len2 = prompt_feat.shape[1], h.shape[1] - prompt_feat.shape[1]
 
         # get conditions
-        conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
-        conds[:, :mel_len1] = prompt_feat
-        conds = conds.transpose(1, 2)
+        conds = torch.zeros([1, self.output_size, mel_len1 + mel_len2], device=token.device).to(h.dtype)
+        conds[:, :, :mel_len1] = prompt_cache['prompt_conds']
 
         mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
         feat, _ = self.decoder(
@@ -395,8 +439,10 @@ class CausalMaskedDiffWithDiT(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
-            streaming=streaming
+            n_timesteps=n_timesteps,
+            streaming=streaming,
+            solver=solver,
+            cfg_strategy=cfg_strategy
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
@@ -15,7 +15,7 @@
 import torch
 import torch.nn.functional as F
 from matcha.models.components.flow_matching import BASECFM
-from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils.common import set_all_random_seed, TrtContextWrapper
 
 
 class ConditionalCFM(BASECFM):
@@ -34,7 +34,7 @@ class ConditionalCFM(BASECFM):
         self.estimator = estimator
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, cache=torch.zeros(1, 80, 0, 2)):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, cache=torch.zeros(1, 80, 0, 2), solver=None, cfg_strategy=None):
         """Forward diffusion
 
         Args:
@@ -47,6 +47,8 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): ODE solver, see solve. Defaults to cfm_params.solver.
+            cfg_strategy (str, optional): classifier-free guidance schedule, see cfg_schedule. Defaults to full.
 
         Returns:
             sample: generated mel-spectrogram
@@ -66,9 +68,29 @@ class ConditionalCFM(BASECFM):
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), cache
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, solver=solver, cfg_strategy=cfg_strategy), cache
 
-    def solve_euler(self, x, t_span, mu, mask, spks, cond, streaming=False):
+    def solve(self, x, t_span, mu, mask, spks, cond, streaming=False, solver=None, cfg_strategy=None):
+        """
+        Dispatch to the ODE solver, fall back to the solver configured in cfm_params.
+        Args:
+            solver (str, optional): one of euler/midpoint/heun/multistep.
+                euler and multistep cost one estimator call per step, midpoint and heun cost two.
+            cfg_strategy (str, optional): classifier-free guidance schedule, see cfg_schedule.
+        """
+        solver = self.solver if solver is None else solver
+        if solver == 'euler':
+            return self.solve_euler(x, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming, cfg_strategy=cfg_strategy)
+        elif solver == 'midpoint':
+            return self.solve_midpoint(x, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming, cfg_strategy=cfg_strategy)
+        elif solver == 'heun':
+            return self.solve_heun(x, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming, cfg_strategy=cfg_strategy)
+        elif solver == 'multistep':
+            return self.solve_multistep(x, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming, cfg_strategy=cfg_strategy)
+        else:
+            raise ValueError('unsupported flow solver {}'.format(solver))
+
+    def solve_euler(self, x, t_span, mu, mask, spks, cond, streaming=False, cfg_strategy=None):
         """
         Fixed euler solver for ODEs.
         Args:
@@ -82,6 +104,7 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            cfg_strategy (str, optional): classifier-free guidance schedule, see cfg_schedule.
         """
         t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
         t = t.unsqueeze(dim=0)
@@ -90,6 +113,92 @@ class ConditionalCFM(BASECFM):
         # Or in future might add like a return_all_steps flag
         sol = []
 
+        cfg_inputs = self.prepare_cfg_inputs(x, spks, len(t_span) - 1, cfg_strategy)
+        for step in range(1, len(t_span)):
+            dphi_dt = self.cfg_velocity(x, t, mu, mask, spks, cond, cfg_inputs, step - 1, streaming)
+            x = x + dt * dphi_dt
+            t = t + dt
+            sol.append(x)
+            if step < len(t_span) - 1:
+                dt = t_span[step + 1] - t
+
+        return sol[-1].float()
+
+    def solve_midpoint(self, x, t_span, mu, mask, spks, cond, streaming=False, cfg_strategy=None):
+        """
+        Explicit midpoint solver, second order with two estimator calls per step.
+        Args are the same as solve_euler.
+        """
+        cfg_inputs = self.prepare_cfg_inputs(x, spks, len(t_span) - 1, cfg_strategy)
+        for step in range(len(t_span) - 1):
+            t, dt = t_span[step].unsqueeze(dim=0), t_span[step + 1] - t_span[step]
+            k1 = self.cfg_velocity(x, t, mu, mask, spks, cond, cfg_inputs, step, streaming)
+            k2 = self.cfg_velocity(x + 0.5 * dt * k1, t + 0.5 * dt, mu, mask, spks, cond, cfg_inputs, step, streaming)
+            x = x + dt * k2
+        return x.float()
+
+    def solve_heun(self, x, t_span, mu, mask, spks, cond, streaming=False, cfg_strategy=None):
+        """
+        Heun (explicit trapezoidal) solver, second order with two estimator calls per step.
+        Args are the same as solve_euler.
+        """
+        cfg_inputs = self.prepare_cfg_inputs(x, spks, len(t_span) - 1, cfg_strategy)
+        for step in range(len(t_span) - 1):
+            t, dt = t_span[step].unsqueeze(dim=0), t_span[step + 1] - t_span[step]
+            k1 = self.cfg_velocity(x, t, mu, mask, spks, cond, cfg_inputs, step, streaming)
+            k2 = self.cfg_velocity(x + dt * k1, t + dt, mu, mask, spks, cond, cfg_inputs, step, streaming)
+            x = x + 0.5 * dt * (k1 + k2)
+        return x.float()
+
+    def solve_multistep(self, x, t_span, mu, mask, spks, cond, streaming=False, cfg_strategy=None):
+        """
+        Variable step second order Adams-Bashforth solver, reuses the previous velocity
+        so it keeps one estimator call per step. The first step falls back to euler.
+        Args are the same as solve_euler.
+        """
+        cfg_inputs = self.prepare_cfg_inputs(x, spks, len(t_span) - 1, cfg_strategy)
+        prev_dphi_dt, prev_dt = None, None
+        for step in range(len(t_span) - 1):
+            t, dt = t_span[step].unsqueeze(dim=0), t_span[step + 1] - t_span[step]
+            dphi_dt = self.cfg_velocity(x, t, mu, mask, spks, cond, cfg_inputs, step, streaming)
+            if prev_dphi_dt is None:
+                x = x + dt * dphi_dt
+            else:
+                ratio = dt / prev_dt
+                x = x + dt * ((1.0 + 0.5 * ratio) * dphi_dt - 0.5 * ratio * prev_dphi_dt)
+            prev_dphi_dt, prev_dt = dphi_dt, dt
+        return x.float()
+
+    def cfg_schedule(self, n_timesteps, cfg_strategy=None):
+        """
+        Per step classifier-free guidance mode, the unconditional branch doubles estimator cost.
+        Args:
+            cfg_strategy (str, optional): one of
+                full: guidance on every step, the default.
+                none: never run the unconditional branch.
+                early[:k]: guidance on the first k steps only, k defaults to half of n_timesteps.
+                reuse[:k]: run the unconditional branch every k steps and reuse it in between, k defaults to 2.
+        Returns:
+            list of full/none/reuse, one per step
+        """
+        cfg_strategy = 'full' if cfg_strategy is None else cfg_strategy
+        name, _, k = cfg_strategy.partition(':')
+        if k != '' and (not k.isdigit() or name not in ('early', 'reuse')):
+            raise ValueError('unsupported cfg strategy {}'.format(cfg_strategy))
+        if name == 'full':
+            return ['full'] * n_timesteps
+        elif name == 'none':
+            return ['none'] * n_timesteps
+        elif name == 'early':
+            k = int(k) if k != '' else (n_timesteps + 1) // 2
+            return ['full' if i < k else 'none' for i in range(n_timesteps)]
+        elif name == 'reuse':
+            k = max(int(k), 1) if k != '' else 2
+            return ['full' if i % k == 0 else 'reuse' for i in range(n_timesteps)]
+        else:
+            raise ValueError('unsupported cfg strategy {}'.format(cfg_strategy))
+
+    def prepare_cfg_inputs(self, x, spks, n_timesteps, cfg_strategy=None):
         # Do not use concat, it may cause memory format changed and trt infer with wrong results!
         # NOTE when flow run in amp mode, x.dtype is float32, which cause nan in trt fp16 inference, so set dtype=spks.dtype
         x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
@@ -98,8 +207,18 @@ class ConditionalCFM(BASECFM):
         t_in = torch.zeros([2], device=x.device, dtype=spks.dtype)
         spks_in = torch.zeros([2, 80], device=x.device, dtype=spks.dtype)
         cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
-        for step in range(1, len(t_span)):
-            # Classifier-Free Guidance inference introduced in VoiceBox
+        return {'inputs': (x_in, mask_in, mu_in, t_in, spks_in, cond_in),
+                'schedule': self.cfg_schedule(n_timesteps, cfg_strategy),
+                'uncond_dphi_dt': None}
+
+    def cfg_velocity(self, x, t, mu, mask, spks, cond, cfg_inputs, step, streaming=False):
+        # Classifier-Free Guidance inference introduced in VoiceBox
+        x_in, mask_in, mu_in, t_in, spks_in, cond_in = cfg_inputs['inputs']
+        mode = cfg_inputs['schedule'][step]
+        if mode == 'reuse' and cfg_inputs['uncond_dphi_dt'] is None:
+            mode = 'full'
+        # NOTE exported onnx/trt estimator has a fixed batch of 2, so only torch estimator skips the unconditional half
+        if mode == 'full' or not isinstance(self.estimator, torch.nn.Module):
             x_in[:] = x
             mask_in[:] = mask
             mu_in[0] = mu
@@ -114,18 +233,25 @@ class ConditionalCFM(BASECFM):
                 streaming
             )
             dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
-            x = x + dt * dphi_dt
-            t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
-
-        return sol[-1].float()
+            if mode == 'none':
+                return dphi_dt.clone()
+            if mode == 'full' and 'reuse' in cfg_inputs['schedule']:
+                # trt writes its output into x_in, keep a copy for the following steps
+                cfg_inputs['uncond_dphi_dt'] = cfg_dphi_dt.clone()
+        else:
+            dphi_dt = self.forward_estimator(x, mask, mu, t, spks, cond, streaming)
+            if mode == 'none':
+                return dphi_dt
+            cfg_dphi_dt = cfg_inputs['uncond_dphi_dt']
+        return (1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt
 
     def forward_estimator(self, x, mask, mu, t, spks, cond, streaming=False):
         if isinstance(self.estimator, torch.nn.Module):
             return self.estimator(x, mask, mu, t, spks, cond, streaming=streaming)
+        elif not isinstance(self.estimator, TrtContextWrapper):
+            # NOTE onnxruntime session pool of the cpu profile, like trt the exported estimator has no streaming chunk mask
+            inputs = [i.contiguous().numpy() for i in [x, mask, mu, t, spks, cond]]
+            return torch.from_numpy(self.estimator.run(*inputs)).to(x)
         else:
             [estimator, stream], trt_engine = self.estimator.acquire_estimator()
             # NOTE need to synchronize when switching stream
@@ -201,7 +327,7 @@ class CausalConditionalCFM(ConditionalCFM):
         self.rand_noise = torch.randn([1, 80, 50 * 300])
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, streaming=False):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, streaming=False, solver=None, cfg_strategy=None):
         """Forward diffusion
 
         Args:
@@ -214,6 +340,8 @@ class CausalConditionalCFM(ConditionalCFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): ODE solver, see solve. Defaults to cfm_params.solver.
+            cfg_strategy (str, optional): classifier-free guidance schedule, see cfg_schedule. Defaults to full.
 
         Returns:
             sample: generated mel-spectrogram
@@ -225,4 +353,4 @@ class CausalConditionalCFM(ConditionalCFM):
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming), None
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming, solver=solver, cfg_strategy=cfg_strategy), None
@@ -12,18 +12,20 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import copy
 import queue
 import random
 import time
 import threading
+from collections import OrderedDict
 from typing import Dict, Optional, Callable, List, Generator
 import numpy as np
 import torch
 from torch import nn
 import torch.nn.functional as F
-from transformers import Qwen2ForCausalLM
+from transformers import Qwen2ForCausalLM, StaticCache
 from torch.nn.utils.rnn import pad_sequence, unpad_sequence
-from cosyvoice.utils.common import IGNORE_ID
+from cosyvoice.utils.common import IGNORE_ID, ras_sampling, batch_ras_sampling, SamplingWindow
 from cosyvoice.transformer.label_smoothing_loss import LabelSmoothingLoss
 from cosyvoice.utils.common import th_accuracy
 from cosyvoice.utils.file_utils import logging
@@ -146,13 +148,22 @@ class TransformerLM(torch.nn.Module):
         acc = th_accuracy(logits.view(-1, self.speech_token_size + 1), lm_target, ignore_label=IGNORE_ID)
         return {'loss': loss, 'acc': acc}
 
+    def sampling_window(self, device):
+        return SamplingWindow(1, getattr(self.sampling, 'keywords', {}).get('win_size', 10), device)
+
     def sampling_ids(
             self,
             weighted_scores: torch.Tensor,
             decoded_tokens: List,
             sampling: int,
             ignore_eos: bool = True,
+            window: Optional[SamplingWindow] = None,
     ):
+        if getattr(self.sampling, 'func', None) is ras_sampling and window is not None:
+            # single tensorized pass, non speech ids are masked out instead of resampled
+            top_ids = batch_ras_sampling(weighted_scores.unsqueeze(dim=0), window.tokens, **self.sampling.keywords,
+                                         ignore_eos=torch.tensor([ignore_eos]), eos_start=self.speech_token_size)
+            return top_ids.item()
         num_trials, max_trials = 0, 100
         while True:
             top_ids = self.sampling(weighted_scores, decoded_tokens, sampling)
@@ -209,6 +220,7 @@ class TransformerLM(torch.nn.Module):
 
         # 5. step by step decode
         out_tokens = []
+        window = self.sampling_window(lm_input.device)
         offset = 0
         att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
         for i in range(max_len):
@@ -217,12 +229,13 @@ class TransformerLM(torch.nn.Module):
                                                                   att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
                                                                                                  device=lm_input.device)).to(torch.bool))
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False)
+            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False, window=window)
             if top_ids == self.eos_token:
                 break
             # in stream mode, yield token one by one
             yield top_ids
             out_tokens.append(top_ids)
+            window.append(top_ids)
             offset += lm_input.size(1)
             lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
 
@@ -231,6 +244,7 @@ class Qwen2Encoder(torch.nn.Module):
     def __init__(self, pretrain_path):
         super().__init__()
         self.model = Qwen2ForCausalLM.from_pretrained(pretrain_path)
+        self.decode_one_step = self.forward_static
 
     def forward(self, xs: torch.Tensor, xs_lens: torch.Tensor):
         T = xs.size(1)
@@ -257,6 +271,32 @@ class Qwen2Encoder(torch.nn.Module):
         new_cache = outs.past_key_values
         return xs, new_cache
 
+    def init_static_cache(self, max_cache_len, device, dtype):
+        # round up so that torch.compile only sees a few distinct cache shapes
+        max_cache_len = int(np.ceil(max_cache_len / 256) * 256)
+        return StaticCache(config=self.model.config, max_batch_size=1, max_cache_len=max_cache_len, device=device, dtype=dtype)
+
+    def forward_static(self, xs, cache, cache_position):
+        """Run the decoder stack on a preallocated cache, without lm_head, per layer hidden states or caller built masks.
+
+        Args:
+            xs (torch.Tensor): (1, T, D) input embeddings
+            cache (StaticCache): see init_static_cache
+            cache_position (torch.Tensor): (T,) positions of xs in cache, a tensor so that torch.compile does not specialize on it
+        """
+        outs = self.model.model(
+            inputs_embeds=xs,
+            past_key_values=cache,
+            cache_position=cache_position,
+            use_cache=True,
+            return_dict=True,
+        )
+        return outs.last_hidden_state
+
+    def compile_static(self):
+        # only the single token decode step is compiled, prefill length changes every sentence
+        self.decode_one_step = torch.compile(self.forward_static, dynamic=False, fullgraph=False)
+
 
 class Qwen2LM(TransformerLM):
     def __init__(
@@ -269,6 +309,7 @@ class Qwen2LM(TransformerLM):
             length_normalized_loss: bool = True,
             lsm_weight: float = 0.0,
             mix_ratio: List[int] = [5, 15],
+            prefix_cache_size: int = 16,
     ):
         torch.nn.Module.__init__(self)
         self.llm_input_size = llm_input_size
@@ -301,6 +342,17 @@ class Qwen2LM(TransformerLM):
         self.stop_token_ids = [speech_token_size + i for i in range(3)]
         self.vllm_output_queue = {}
 
+        # 6. prompt prefix kv cache, keyed by prompt_text token ids, only used by the huggingface path, 0 size disables it
+        self.prefix_cache = OrderedDict()
+        self.prefix_cache_size = prefix_cache_size
+        # prefixes shorter than this are prefilled, raised when copying a cached prefix is slower than its prefill
+        self.prefix_cache_min_len = 0
+        self.prefix_cache_stats = {'hits': 0, 'misses': 0, 'saved_tokens': 0, 'saved_sec': 0.0}
+        self.prefix_cache_lock = threading.Lock()
+
+        # 7. preallocated static kv cache decode, see Qwen2Encoder.forward_static
+        self.static_decode = False
+
     def prepare_lm_input_target(self, sos_emb, text_token, text_token_emb, text_token_len, task_id_emb, speech_token, speech_token_emb, speech_token_len, instruct_token=None, instruct_token_emb=None, instruct_token_len=None):
         lm_target, lm_input = [], []
         text_token = unpad_sequence(text_token, text_token_len.cpu(), batch_first=True)
@@ -473,22 +525,64 @@ class Qwen2LM(TransformerLM):
         min_len = int((text_len - prompt_text_len) * min_token_text_ratio)
         max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
 
-        # 5. step by step decode
-        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid):
+        # 5. step by step decode, [sos, prompt_text] is shared by every sentence of the same prompt
+        prefix_len = 1 + int(prompt_text_len) if prompt_text_len != 0 else 0
+        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid,
+                                            prefix_len=prefix_len, prefix_key=tuple(prompt_text.view(-1).tolist())):
             yield token
 
     @torch.inference_mode()
-    def inference_wrapper(self, lm_input, sampling, min_len, max_len, uuid):
-        if hasattr(self, 'vllm'):
-            from vllm import SamplingParams, RequestOutput
-            sampling_params = SamplingParams(top_k=sampling,
-                                             stop_token_ids=self.stop_token_ids,
-                                             min_tokens=min_len,
-                                             max_tokens=max_len)
-            with self.lock:
-                self.vllm.add_request(uuid, {"prompt_embeds": lm_input.squeeze(0).to(torch.bfloat16).to(lm_input.device)}, sampling_params)
-                self.vllm_output_queue[uuid] = queue.Queue()
-            out_tokens = []
+    def prefill_prefix(self, prefix, prefix_key):
+        """Kv cache of prefix, from prefix_cache if possible. Every cached entry keeps its prefill time, a hit counts that
+        time minus the time of the copy as saved.
+        """
+        with self.prefix_cache_lock:
+            entry = self.prefix_cache.get(prefix_key)
+            if entry is not None:
+                self.prefix_cache.move_to_end(prefix_key)
+        if entry is None:
+            start_time = time.time()
+            _, cache = self.llm.forward_one_step(prefix,
+                                                 masks=torch.tril(torch.ones((1, prefix.shape[1], prefix.shape[1]), device=prefix.device)).to(torch.bool),
+                                                 cache=None)
+            if prefix.device.type == 'cuda':
+                torch.cuda.synchronize(prefix.device)
+            with self.prefix_cache_lock:
+                self.prefix_cache_stats['misses'] += 1
+                self.prefix_cache[prefix_key] = (cache, time.time() - start_time)
+                while len(self.prefix_cache) > self.prefix_cache_size:
+                    self.prefix_cache.popitem(last=False)
+            # NOTE huggingface cache is updated in place by forward, never hand out the stored one
+            return copy.deepcopy(cache)
+        cache, prefill_sec = entry
+        start_time = time.time()
+        cache = copy.deepcopy(cache)
+        if prefix.device.type == 'cuda':
+            torch.cuda.synchronize(prefix.device)
+        copy_sec = time.time() - start_time
+        with self.prefix_cache_lock:
+            self.prefix_cache_stats['hits'] += 1
+            self.prefix_cache_stats['saved_tokens'] += prefix.shape[1]
+            self.prefix_cache_stats['saved_sec'] += prefill_sec - copy_sec
+            if copy_sec > prefill_sec and prefix.shape[1] >= self.prefix_cache_min_len:
+                # short prefixes are cheaper to prefill than to copy, stop caching them
+                self.prefix_cache_min_len = prefix.shape[1] + 1
+                self.prefix_cache.pop(prefix_key, None)
+                logging.info('prompt prefix kv cache copy {:.1f}ms is slower than prefill {:.1f}ms, only cache prefixes of at least {} tokens'.format(
+                    copy_sec * 1000, prefill_sec * 1000, self.prefix_cache_min_len))
+        return cache
+
+    def use_prefix_cache(self, prefix_len):
+        return prefix_len > 0 and self.prefix_cache_size > 0 and prefix_len >= self.prefix_cache_min_len
+
+    def vllm_generate(self, lm_input, sampling_params, uuid):
+        from vllm import RequestOutput
+        with self.lock:
+            self.vllm.add_request(uuid, {"prompt_embeds": lm_input.squeeze(0).to(torch.bfloat16).to(lm_input.device)}, sampling_params)
+            self.vllm_output_queue[uuid] = queue.Queue()
+        out_tokens = []
+        finished = False
+        try:
             while True:
                 with self.lock:
                     if self.vllm_output_queue[uuid].empty() is True:
@@ -499,31 +593,88 @@ class Qwen2LM(TransformerLM):
                 if self.vllm_output_queue[uuid].empty() is False:
                     top_ids = self.vllm_output_queue[uuid].get()
                     if top_ids in self.stop_token_ids:
+                        finished = True
                         break
                     # in stream mode, yield token one by one
                     yield top_ids
                     out_tokens.append(top_ids)
-                    if len(out_tokens) == max_len:
+                    if len(out_tokens) == sampling_params.max_tokens:
+                        finished = True
                         break
                 time.sleep(0.001)
+        finally:
             with self.lock:
+                # the generator was closed early, e.g. a degenerate generation, free its slot in the vllm batch
+                if finished is False:
+                    self.vllm.abort_request(uuid)
                 self.vllm_output_queue.pop(uuid)
+
+    @torch.inference_mode()
+    def inference_wrapper(self, lm_input, sampling, min_len, max_len, uuid, prefix_len=0, prefix_key=None):
+        if hasattr(self, 'vllm'):
+            from vllm import SamplingParams
+            sampling_params = SamplingParams(top_k=sampling,
+                                             stop_token_ids=self.stop_token_ids,
+                                             min_tokens=min_len,
+                                             max_tokens=max_len)
+            for top_ids in self.vllm_generate(lm_input, sampling_params, uuid):
+                yield top_ids
+        elif self.static_decode is True:
+            for token in self.inference_static(lm_input, sampling, min_len, max_len, prefix_len, prefix_key):
+                yield token
         else:
             out_tokens = []
+            window = self.sampling_window(lm_input.device)
             cache = None
+            if self.use_prefix_cache(prefix_len):
+                cache = self.prefill_prefix(lm_input[:, :prefix_len], prefix_key)
+                lm_input = lm_input[:, prefix_len:]
             for i in range(max_len):
                 y_pred, cache = self.llm.forward_one_step(lm_input,
                                                           masks=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool),
                                                           cache=cache)
                 logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-                top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False)
+                top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False, window=window)
                 if top_ids in self.stop_token_ids:
                     break
                 # in stream mode, yield token one by one
                 yield top_ids
                 out_tokens.append(top_ids)
+                window.append(top_ids)
                 lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
 
+    @torch.inference_mode()
+    def inference_static(self, lm_input, sampling, min_len, max_len, prefix_len=0, prefix_key=None):
+        # NOTE amp writes half precision key/value, cache dtype must follow
+        dtype = torch.get_autocast_gpu_dtype() if torch.is_autocast_enabled() else lm_input.dtype
+        cache = self.llm.init_static_cache(lm_input.shape[1] + max_len, lm_input.device, dtype)
+        offset = 0
+        if self.use_prefix_cache(prefix_len):
+            prefix_cache = self.prefill_prefix(lm_input[:, :prefix_len], prefix_key)
+            prefix_position = torch.arange(prefix_len, device=lm_input.device)
+            for i in range(len(prefix_cache)):
+                cache.update(prefix_cache[i][0], prefix_cache[i][1], i, {'cache_position': prefix_position})
+            lm_input, offset = lm_input[:, prefix_len:], prefix_len
+        # prefill runs eager, its length changes every sentence
+        y_pred = self.llm.forward_static(lm_input, cache, torch.arange(offset, offset + lm_input.shape[1], device=lm_input.device))
+        cache_position = torch.tensor([offset + lm_input.shape[1]], device=lm_input.device)
+        out_tokens = []
+        window = self.sampling_window(lm_input.device)
+        for i in range(max_len):
+            logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False, window=window)
+            if top_ids in self.stop_token_ids:
+                break
+            # in stream mode, yield token one by one
+            yield top_ids
+            out_tokens.append(top_ids)
+            window.append(top_ids)
+            if i == max_len - 1:
+                break
+            lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
+            y_pred = self.llm.decode_one_step(lm_input, cache, cache_position)
+            cache_position += 1
+
     @torch.inference_mode()
     def inference_bistream(
             self,
@@ -536,7 +687,12 @@ class Qwen2LM(TransformerLM):
             sampling: int = 25,
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
+            uuid: str = '',
     ) -> Generator[torch.Tensor, None, None]:
+        if hasattr(self, 'vllm'):
+            for top_ids in self.inference_bistream_vllm(text, prompt_text, prompt_speech_token, prompt_speech_token_len, sampling, max_token_text_ratio, uuid):
+                yield top_ids
+            return
 
         device = prompt_text.device
         # 1. prepare input
@@ -550,6 +706,7 @@ class Qwen2LM(TransformerLM):
 
         # 2. iterate text
         out_tokens = []
+        window = self.sampling_window(device)
         cache = None
         # NOTE init prompt_text as text_cache as it is basically impossible prompt_speech_token/prompt_text < 15/5
         text_cache = self.llm.model.model.embed_tokens(prompt_text)
@@ -591,11 +748,12 @@ class Qwen2LM(TransformerLM):
                         top_ids = self.fill_token
                         next_fill_index += (self.mix_ratio[1] + 1)
                     else:
-                        top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True)
+                        top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True, window=window)
                     if top_ids == self.fill_token:
                         next_fill_index = len(out_tokens) + self.mix_ratio[1] + 1
                         logging.info('fill_token index {} next fill_token index {}'.format(len(out_tokens), next_fill_index))
                     out_tokens.append(top_ids)
+                    window.append(top_ids)
                     if top_ids >= self.speech_token_size:
                         if top_ids == self.fill_token:
                             break
@@ -613,8 +771,9 @@ class Qwen2LM(TransformerLM):
                                                       masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
                                                       cache=cache)
             logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=False)
+            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=False, window=window)
             out_tokens.append(top_ids)
+            window.append(top_ids)
             if top_ids >= self.speech_token_size:
                 if top_ids == self.eos_token:
                     break
@@ -624,6 +783,89 @@ class Qwen2LM(TransformerLM):
             yield top_ids
             lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
 
+    @torch.inference_mode()
+    def inference_bistream_vllm(self, text, prompt_text, prompt_speech_token, prompt_speech_token_len, sampling, max_token_text_ratio, uuid):
+        """Same text/speech interleave as inference_bistream on top of vllm prompt_embeds.
+        vllm requests can not be extended, so every segment between fill tokens is a new request over all inputs fed so far,
+        the shared prefix is served by vllm prefix caching.
+        """
+        from vllm import SamplingParams
+        device = prompt_text.device
+        # 1. prepare input
+        sos_emb = self.llm_embedding.weight[self.sos].reshape(1, 1, -1)
+        task_id_emb = self.llm_embedding.weight[self.task_id].reshape(1, 1, -1)
+        if prompt_speech_token_len != 0:
+            prompt_speech_token_emb = self.speech_embedding(prompt_speech_token)
+        else:
+            prompt_speech_token_emb = torch.zeros(1, 0, self.llm_input_size, dtype=prompt_text.dtype).to(device)
+        lm_input = torch.concat([sos_emb], dim=1)
+        # inputs already consumed by previous requests, plays the role of the huggingface kv cache
+        history = torch.zeros(1, 0, self.llm_input_size, dtype=lm_input.dtype).to(device)
+
+        # 2. iterate text
+        out_tokens, segment, text_len = [], 0, 0
+        text_cache = self.llm.model.model.embed_tokens(prompt_text)
+        next_fill_index = (int(prompt_speech_token.shape[1] / self.mix_ratio[1]) + 1) * self.mix_ratio[1] - prompt_speech_token.shape[1]
+        for this_text in text:
+            text_len += this_text.shape[1]
+            text_cache = torch.concat([text_cache, self.llm.model.model.embed_tokens(this_text)], dim=1)
+            # prompt_speech_token_emb not empty, try append to lm_input
+            while prompt_speech_token_emb.size(1) != 0:
+                if text_cache.size(1) >= self.mix_ratio[0]:
+                    lm_input_text, lm_input_speech = text_cache[:, :self.mix_ratio[0]], prompt_speech_token_emb[:, :self.mix_ratio[1]]
+                    logging.info('append {} text token {} speech token'.format(lm_input_text.size(1), lm_input_speech.size(1)))
+                    lm_input = torch.concat([lm_input, lm_input_text, lm_input_speech], dim=1)
+                    text_cache, prompt_speech_token_emb = text_cache[:, self.mix_ratio[0]:], prompt_speech_token_emb[:, self.mix_ratio[1]:]
+                else:
+                    logging.info('not enough text token to decode, wait for more')
+                    break
+            # no prompt_speech_token_emb remain, can decode some speech token
+            if prompt_speech_token_emb.size(1) == 0:
+                if (len(out_tokens) != 0 and out_tokens[-1] == self.fill_token) or (len(out_tokens) == 0 and lm_input.size(1) == 1):
+                    logging.info('get fill token, need to append more text token')
+                    if text_cache.size(1) >= self.mix_ratio[0]:
+                        lm_input_text = text_cache[:, :self.mix_ratio[0]]
+                        logging.info('append {} text token'.format(lm_input_text.size(1)))
+                        if len(out_tokens) != 0 and out_tokens[-1] == self.fill_token:
+                            lm_input = lm_input_text
+                        else:
+                            lm_input = torch.concat([lm_input, lm_input_text], dim=1)
+                        text_cache = text_cache[:, self.mix_ratio[0]:]
+                    else:
+                        logging.info('not enough text token to decode, wait for more')
+                        continue
+                # speech tokens are masked to speech ids until the forced fill token, same as ignore_eos=True
+                num_tokens = next_fill_index - len(out_tokens)
+                segment_tokens = []
+                if num_tokens > 0:
+                    sampling_params = SamplingParams(top_k=sampling,
+                                                     allowed_token_ids=list(range(self.speech_token_size)),
+                                                     min_tokens=num_tokens,
+                                                     max_tokens=num_tokens)
+                    for top_ids in self.vllm_generate(torch.concat([history, lm_input], dim=1), sampling_params, '{}_{}'.format(uuid, segment)):
+                        segment_tokens.append(top_ids)
+                        out_tokens.append(top_ids)
+                        yield top_ids
+                    segment += 1
+                history = torch.concat([history, lm_input], dim=1)
+                if len(segment_tokens) != 0:
+                    lm_input = self.speech_embedding.weight[segment_tokens].unsqueeze(dim=0)
+                    history = torch.concat([history, lm_input], dim=1)
+                    # NOTE keep the last speech token as pending input, inference_bistream feeds it again in final decode
+                    lm_input = lm_input[:, -1:]
+                logging.info('fill_token index {} next fill_token index {}'.format(len(out_tokens), next_fill_index + self.mix_ratio[1] + 1))
+                out_tokens.append(self.fill_token)
+                next_fill_index += (self.mix_ratio[1] + 1)
+
+        # 3. final decode
+        lm_input = torch.concat([lm_input, text_cache, task_id_emb], dim=1)
+        logging.info('no more text token, decode until met eos')
+        sampling_params = SamplingParams(top_k=sampling,
+                                         stop_token_ids=self.stop_token_ids,
+                                         max_tokens=max(int(text_len * max_token_text_ratio), 1))
+        for top_ids in self.vllm_generate(torch.concat([history, lm_input], dim=1), sampling_params, '{}_{}'.format(uuid, segment)):
+            yield top_ids
+
 
 class CosyVoice3LM(Qwen2LM):
     def __init__(
@@ -636,6 +878,7 @@ class CosyVoice3LM(Qwen2LM):
             length_normalized_loss: bool = True,
             lsm_weight: float = 0.0,
             mix_ratio: List[int] = [5, 15],
+            prefix_cache_size: int = 16,
     ):
         torch.nn.Module.__init__(self)
         self.llm_input_size = llm_input_size
@@ -667,6 +910,17 @@ class CosyVoice3LM(Qwen2LM):
         self.stop_token_ids = [speech_token_size + i for i in range(200)]
         self.vllm_output_queue = {}
 
+        # 6. prompt prefix kv cache, keyed by prompt_text token ids, only used by the huggingface path, 0 size disables it
+        self.prefix_cache = OrderedDict()
+        self.prefix_cache_size = prefix_cache_size
+        # prefixes shorter than this are prefilled, raised when copying a cached prefix is slower than its prefill
+        self.prefix_cache_min_len = 0
+        self.prefix_cache_stats = {'hits': 0, 'misses': 0, 'saved_tokens': 0, 'saved_sec': 0.0}
+        self.prefix_cache_lock = threading.Lock()
+
+        # 7. preallocated static kv cache decode, see Qwen2Encoder.forward_static
+        self.static_decode = False
+
     def forward(
             self,
             batch: dict,
@@ -743,6 +997,8 @@ class CosyVoice3LM(Qwen2LM):
         min_len = int((text_len - prompt_text_len) * min_token_text_ratio)
         max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
 
-        # 5. step by step decode
-        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid):
+        # 5. step by step decode, [sos, prompt_text] is shared by every sentence of the same prompt
+        prefix_len = 1 + int(prompt_text_len) if prompt_text_len != 0 else 0
+        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid,
+                                            prefix_len=prefix_len, prefix_key=tuple(prompt_text.view(-1).tolist())):
             yield token
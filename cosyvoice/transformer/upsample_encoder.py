@@ -103,6 +103,26 @@ class PreLookaheadLayer(nn.Module):
         return outputs
 
 
+class OnnxPreLookaheadLayer(nn.Module):
+    """PreLookaheadLayer run by an onnxruntime session, see CosyVoice2Model.load_onnx_cpu.
+    The exported graph always takes a context, a missing context is the same as zero context since forward pads with zeros.
+    conv2 is kept for the receptive field lookups of the flow.
+    """
+
+    def __init__(self, layer: PreLookaheadLayer, session):
+        super().__init__()
+        self.in_channels = layer.in_channels
+        self.channels = layer.channels
+        self.pre_lookahead_len = layer.pre_lookahead_len
+        self.conv2 = layer.conv2
+        self.session = session
+
+    def forward(self, inputs: torch.Tensor, context: torch.Tensor = torch.zeros(0, 0, 0)) -> torch.Tensor:
+        if context.size(1) == 0:
+            context = torch.zeros(inputs.size(0), self.pre_lookahead_len, inputs.size(2)).to(inputs)
+        return torch.from_numpy(self.session.run(inputs.contiguous().numpy(), context.contiguous().numpy())).to(inputs)
+
+
 class UpsampleConformerEncoder(torch.nn.Module):
 
     def __init__(
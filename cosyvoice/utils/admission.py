@@ -0,0 +1,107 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import time
+import logging
+
+# relative cost per character of normalized text, prompt based modes also run the prompt through the llm
+MODE_COST = {'sft': 1.0, 'zero_shot': 1.3, 'cross_lingual': 1.2, 'instruct': 1.2, 'instruct2': 1.3, 'vc': 0.6, 'bistream': 1.3}
+# streaming runs token2wav once per hop instead of once per sentence
+STREAM_COST = 1.25
+
+
+def estimate_cost(text_len, mode='zero_shot', stream=False):
+    """Cost of a request in units of normalized characters of sft synthesis."""
+    return max(text_len, 1) * MODE_COST.get(mode, 1.3) * (STREAM_COST if stream else 1.0)
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request would miss the latency slo, retry_after is a hint in seconds for the client."""
+
+    def __init__(self, predicted_latency, retry_after):
+        super().__init__('server overloaded, predicted latency {:.1f}s, retry after {:.1f}s'.format(predicted_latency, retry_after))
+        self.predicted_latency = predicted_latency
+        self.retry_after = retry_after
+
+
+class Ticket:
+    def __init__(self, cost):
+        self.cost = cost
+        self.start_time = time.time()
+
+
+class AdmissionController:
+    """Admit a request only if the work in flight plus its own cost can be done within slo seconds.
+
+    capacity is the cost served per second with the server busy. It starts at the configured value and follows the
+    throughput measured over windows of window seconds of busy time: it rises whenever more is served, and falls only
+    after a window in which at least saturation requests were in flight on average, since a lightly loaded server
+    serves less than it could. A request that does not fit waits up to queue_timeout seconds for earlier work to
+    finish, then AdmissionRejected is raised. A request is always admitted on an idle server, however long it is.
+    """
+
+    def __init__(self, capacity, slo=10.0, queue_timeout=0.0, saturation=1, window=10.0):
+        assert capacity > 0, 'capacity should be positive'
+        self.capacity = float(capacity)
+        self.slo = slo
+        self.queue_timeout = queue_timeout
+        self.saturation = saturation
+        self.window = window
+        self.outstanding_cost, self.outstanding_num = 0.0, 0
+        self.condition = threading.Condition()
+        # accumulated over the current measurement window
+        self.served_cost, self.busy_time, self.num_time, self.last_time = 0.0, 0.0, 0.0, time.time()
+
+    def predicted_latency(self, cost):
+        return (self.outstanding_cost + cost) / self.capacity
+
+    def _tick(self):
+        now = time.time()
+        if self.outstanding_num > 0:
+            self.busy_time += now - self.last_time
+            self.num_time += (now - self.last_time) * self.outstanding_num
+        self.last_time = now
+
+    def _measure(self):
+        if self.busy_time < self.window:
+            return
+        throughput, concurrency = self.served_cost / self.busy_time, self.num_time / self.busy_time
+        if throughput > self.capacity or concurrency >= self.saturation:
+            self.capacity = 0.7 * self.capacity + 0.3 * throughput
+            logging.debug('admission capacity {:.1f}/s, mean concurrency {:.1f}'.format(self.capacity, concurrency))
+        self.served_cost, self.busy_time, self.num_time = 0.0, 0.0, 0.0
+
+    def _fits(self, cost):
+        return self.outstanding_num == 0 or self.predicted_latency(cost) <= self.slo
+
+    def acquire(self, cost, timeout=None):
+        """Return a Ticket to release once the request is done, or raise AdmissionRejected."""
+        timeout = self.queue_timeout if timeout is None else timeout
+        with self.condition:
+            if not self.condition.wait_for(lambda: self._fits(cost), timeout=timeout):
+                predicted_latency = self.predicted_latency(cost)
+                raise AdmissionRejected(predicted_latency, predicted_latency - self.slo)
+            self._tick()
+            self.outstanding_cost += cost
+            self.outstanding_num += 1
+        return Ticket(cost)
+
+    def release(self, ticket):
+        with self.condition:
+            self._tick()
+            self.outstanding_cost -= ticket.cost
+            self.outstanding_num -= 1
+            self.served_cost += ticket.cost
+            self._measure()
+            self.condition.notify_all()
@@ -0,0 +1,207 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import queue
+import struct
+import threading
+import numpy as np
+import torch
+
+AUDIO_FORMATS = ['pcm', 'wav', 'opus', 'mp3', 'aac']
+MEDIA_TYPES = {'pcm': 'audio/L16', 'wav': 'audio/wav', 'opus': 'audio/ogg', 'mp3': 'audio/mpeg', 'aac': 'audio/aac'}
+EXTENSIONS = {'.pcm': 'pcm', '.raw': 'pcm', '.wav': 'wav', '.ogg': 'opus', '.opus': 'opus', '.mp3': 'mp3', '.aac': 'aac'}
+
+
+def to_int16(speech, clip=True):
+    # NOTE clip=False keeps the speech * 2 ** 15 scaling the pcm wire format always had, clients may depend on it
+    if isinstance(speech, torch.Tensor):
+        speech = speech.detach().cpu().numpy()
+    if clip is False:
+        return (speech.reshape(-1) * (2 ** 15)).astype(np.int16)
+    return (np.clip(speech.reshape(-1), -1.0, 1.0) * (2 ** 15 - 1)).astype(np.int16)
+
+
+def format_from_path(path, default='wav'):
+    return EXTENSIONS.get(os.path.splitext(path)[1].lower(), default)
+
+
+class PcmEncoder:
+    """Raw little endian int16 mono, what the servers have always sent."""
+
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.media_type = MEDIA_TYPES['pcm']
+        self.num_samples = 0
+
+    def encode(self, speech):
+        speech = to_int16(speech, clip=False)
+        self.num_samples += len(speech)
+        return speech.tobytes()
+
+    def flush(self):
+        return b''
+
+
+class WavEncoder(PcmEncoder):
+    """Int16 wav, the header goes out with the first chunk and declares an unknown length so players can start right away."""
+
+    def __init__(self, sample_rate):
+        super().__init__(sample_rate)
+        self.media_type = MEDIA_TYPES['wav']
+        self.header_sent = False
+
+    def header(self, num_samples=None):
+        # NOTE 0xFFFFFFFF data size is the de facto marker of a streamed wav of unknown length
+        data_size = 0xFFFFFFFF if num_samples is None else num_samples * 2
+        riff_size = 0xFFFFFFFF if num_samples is None else data_size + 36
+        return b'RIFF' + struct.pack('<I', riff_size) + b'WAVE' + \
+            b'fmt ' + struct.pack('<IHHIIHH', 16, 1, 1, self.sample_rate, self.sample_rate * 2, 2, 16) + \
+            b'data' + struct.pack('<I', data_size)
+
+    def encode(self, speech):
+        data = super().encode(speech)
+        if self.header_sent is False:
+            self.header_sent = True
+            return self.header() + data
+        return data
+
+
+class ByteSink:
+    """Write only, non seekable file object for the muxer, so it never seeks back into bytes that were already sent."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+class ContainerEncoder:
+    """Opus/Ogg, MP3 and AAC/ADTS through PyAV, packets are drained after every chunk so each chunk is emitted without waiting for the end."""
+
+    CODECS = {'opus': ('ogg', 'libopus', 48000), 'mp3': ('mp3', 'libmp3lame', None), 'aac': ('adts', 'aac', None)}
+
+    def __init__(self, sample_rate, audio_format, bit_rate=64000):
+        try:
+            import av
+        except ImportError:
+            raise ImportError('{} output needs PyAV, pip install av'.format(audio_format))
+        self.av = av
+        self.sample_rate = sample_rate
+        self.media_type = MEDIA_TYPES[audio_format]
+        self.num_samples = 0
+        self.sink = ByteSink()
+        container_format, codec, codec_rate = self.CODECS[audio_format]
+        self.container = av.open(self.sink, mode='w', format=container_format)
+        # NOTE libopus only accepts 8/12/16/24/48k, the codec context resamples frames to the stream rate
+        self.stream = self.container.add_stream(codec, rate=codec_rate if codec_rate is not None else sample_rate)
+        self.stream.bit_rate = bit_rate
+        self.stream.layout = 'mono'
+        self.pts = 0
+
+    def encode(self, speech):
+        speech = to_int16(speech)
+        self.num_samples += len(speech)
+        frame = self.av.AudioFrame.from_ndarray(speech.reshape(1, -1), format='s16', layout='mono')
+        frame.sample_rate = self.sample_rate
+        frame.pts = self.pts
+        self.pts += len(speech)
+        for packet in self.stream.encode(frame):
+            self.container.mux(packet)
+        return self.sink.drain()
+
+    def flush(self):
+        for packet in self.stream.encode(None):
+            self.container.mux(packet)
+        self.container.close()
+        return self.sink.drain()
+
+
+def get_audio_encoder(audio_format, sample_rate, bit_rate=64000):
+    assert audio_format in AUDIO_FORMATS, 'unsupported audio format {}, use one of {}'.format(audio_format, AUDIO_FORMATS)
+    if audio_format == 'pcm':
+        return PcmEncoder(sample_rate)
+    if audio_format == 'wav':
+        return WavEncoder(sample_rate)
+    return ContainerEncoder(sample_rate, audio_format, bit_rate)
+
+
+def encode_stream(model_output, encoder, max_pending=4):
+    """Yield encoded bytes of every tts_speech chunk of model_output.
+
+    Synthesis runs on its own thread and hands chunks over a queue of max_pending entries, so encoding never stalls
+    the model and a chunk waits behind at most max_pending others before it is encoded and emitted.
+    """
+    chunks = queue.Queue(maxsize=max(max_pending, 2))
+    stop = threading.Event()
+
+    def put(item):
+        # a full queue waits for the consumer, until the consumer is closed
+        while stop.is_set() is False:
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for i in model_output:
+                if put(i['tts_speech']) is False:
+                    break
+        except Exception as e:
+            put(e)
+        finally:
+            # frees the llm thread and session state of the synthesis when the client went away
+            if hasattr(model_output, 'close'):
+                model_output.close()
+        put(None)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            speech = chunks.get()
+            if speech is None:
+                break
+            if isinstance(speech, Exception):
+                raise speech
+            data = encoder.encode(speech)
+            if len(data) != 0:
+                yield data
+        data = encoder.flush()
+        if len(data) != 0:
+            yield data
+    finally:
+        # client went away, the producer stops at its next chunk and closes the synthesis
+        stop.set()
+
+
+def save_audio(model_output, path, sample_rate, audio_format=None, bit_rate=64000):
+    """Encode model_output into path chunk by chunk, a wav header is patched with the final length at the end."""
+    audio_format = audio_format if audio_format is not None else format_from_path(path)
+    encoder = get_audio_encoder(audio_format, sample_rate, bit_rate)
+    with open(path, 'wb') as f:
+        for data in encode_stream(model_output, encoder):
+            f.write(data)
+        if audio_format == 'wav':
+            f.seek(0)
+            f.write(encoder.header(encoder.num_samples))
+    return encoder.num_samples
@@ -144,20 +144,10 @@ def ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25,
 
 
 def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
-    prob, indices = [], []
-    cum_prob = 0.0
     sorted_value, sorted_idx = weighted_scores.softmax(dim=0).sort(descending=True, stable=True)
-    for i in range(len(sorted_idx)):
-        # sampling both top-p and numbers.
-        if cum_prob < top_p and len(prob) < top_k:
-            cum_prob += sorted_value[i]
-            prob.append(sorted_value[i])
-            indices.append(sorted_idx[i])
-        else:
-            break
-    prob = torch.tensor(prob).to(weighted_scores)
-    indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
-    top_ids = indices[prob.multinomial(1, replacement=True)].item()
+    # sampling both top-p and numbers.
+    keep = (sorted_value.cumsum(dim=0) - sorted_value < top_p) & (torch.arange(len(sorted_idx), device=sorted_idx.device) < top_k)
+    top_ids = sorted_idx[(sorted_value * keep).multinomial(1, replacement=True)].item()
     return top_ids
 
 
@@ -166,6 +156,56 @@ def random_sampling(weighted_scores, decoded_tokens, sampling):
     return top_ids
 
 
+def batch_ras_sampling(weighted_scores, window, top_p=0.8, top_k=25, win_size=10, tau_r=0.1, ignore_eos=None, eos_start=None):
+    """Tensorized ras_sampling for a batch of sessions in a single pass.
+
+    Args:
+        weighted_scores (torch.Tensor): (batch, vocab) scores of every session
+        window (torch.Tensor): (batch, W) last decoded tokens, -1 for empty slots, see SamplingWindow
+        top_p, top_k, win_size, tau_r: shared by all rows, or (batch,) tensors for per row params
+        ignore_eos (torch.Tensor, optional): (batch,) bool, these rows never sample ids >= eos_start
+        eos_start (int, optional): first non speech token id
+
+    Returns:
+        torch.Tensor: (batch,) sampled token ids
+    """
+    batch_size, vocab_size = weighted_scores.shape
+    device = weighted_scores.device
+    top_p, top_k, win_size, tau_r = [torch.as_tensor(i, device=device).expand(batch_size).unsqueeze(1) for i in [top_p, top_k, win_size, tau_r]]
+    prob = weighted_scores.float().softmax(dim=-1)
+    # nucleus is chosen on the full distribution as in nucleus_sampling, masked ids are removed afterwards
+    sorted_value, sorted_idx = prob.sort(dim=-1, descending=True, stable=True)
+    keep = (sorted_value.cumsum(dim=-1) - sorted_value < top_p) & (torch.arange(vocab_size, device=device).unsqueeze(0) < top_k)
+    nucleus_prob = torch.zeros_like(prob).scatter_(1, sorted_idx, sorted_value * keep)
+    random_prob = prob
+    if ignore_eos is not None:
+        eos_mask = ignore_eos.view(-1, 1).to(device) & (torch.arange(vocab_size, device=device).unsqueeze(0) >= eos_start)
+        nucleus_prob = nucleus_prob.masked_fill(eos_mask, 0)
+        random_prob = random_prob.masked_fill(eos_mask, 0)
+    # a nucleus made of masked ids only falls back to random sampling
+    empty = nucleus_prob.sum(dim=-1, keepdim=True) == 0
+    nucleus_prob = torch.where(empty, random_prob, nucleus_prob)
+    top_ids = nucleus_prob.multinomial(1, replacement=True)
+    random_ids = random_prob.multinomial(1, replacement=True)
+    # repetition aware, sample from the full distribution when top_ids repeats too often in the window
+    valid = torch.arange(window.size(1), device=device).unsqueeze(0) >= window.size(1) - win_size
+    rep_num = ((window.to(device) == top_ids) & valid).sum(dim=1, keepdim=True)
+    return torch.where(rep_num >= win_size * tau_r, random_ids, top_ids).squeeze(1)
+
+
+class SamplingWindow:
+    """Rolling window of the last decoded tokens of a batch of sessions, empty slots are -1.
+    Created once per generation and updated with every decoded token, so a decode step never rebuilds it.
+    """
+
+    def __init__(self, batch_size, win_size, device='cpu'):
+        self.tokens = torch.full((batch_size, win_size), -1, dtype=torch.long, device=device)
+
+    def append(self, top_ids):
+        self.tokens = self.tokens.roll(-1, dims=1)
+        self.tokens[:, -1] = top_ids
+
+
 def fade_in_out(fade_in_mel, fade_out_mel, window):
     device = fade_in_mel.device
     fade_in_mel, fade_out_mel = fade_in_mel.cpu(), fade_out_mel.cpu()
@@ -177,6 +217,45 @@ def fade_in_out(fade_in_mel, fade_out_mel, window):
     return fade_in_mel.to(device)
 
 
+class Crossfader:
+    """Joins the audio of consecutive sentences whose ends overlap by overlap samples, like tts joins stream chunks.
+
+    The last overlap samples of a sentence are held back until the next sentence has as many, the two are then joined
+    with fade_in_out and a hamming window.
+    """
+
+    def __init__(self, overlap):
+        self.overlap = overlap
+        self.window = np.hamming(2 * overlap)
+        # the held back end of the previous sentence, and the samples of the current sentence not emitted yet
+        self.tail, self.speech = None, None
+
+    def update(self, speech):
+        # returns the model_output to emit for this chunk of the current sentence, or None while it is held back
+        self.speech = speech if self.speech is None else torch.concat([self.speech, speech], dim=1)
+        if self.tail is not None:
+            if self.speech.shape[1] < self.overlap:
+                return None
+            self.speech, self.tail = fade_in_out(self.speech, self.tail, self.window), None
+        if self.speech.shape[1] <= self.overlap:
+            return None
+        speech, self.speech = self.speech[:, :-self.overlap], self.speech[:, -self.overlap:]
+        return {'tts_speech': speech}
+
+    def end_sentence(self):
+        # returns what is left to emit of the sentence, its last overlap samples become the tail the next sentence fades in on
+        held = [i for i in (self.tail, self.speech) if i is not None]
+        self.tail, self.speech = None, None
+        if len(held) == 0:
+            return None
+        speech = torch.concat(held, dim=1)
+        if speech.shape[1] < self.overlap:
+            # too short to fade, joined as it is
+            return {'tts_speech': speech}
+        self.tail = speech[:, -self.overlap:]
+        return {'tts_speech': speech[:, :-self.overlap]} if speech.shape[1] > self.overlap else None
+
+
 def set_all_random_seed(seed):
     random.seed(seed)
     np.random.seed(seed)
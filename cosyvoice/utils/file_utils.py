@@ -15,7 +15,9 @@
 # limitations under the License.
 
 import os
+import hashlib
 import json
+import threading
 import torch
 import torchaudio
 import logging
@@ -41,15 +43,108 @@ def read_json_lists(list_file):
     return results
 
 
+resampler_cache = {}
+resampler_lock = threading.Lock()
+
+
+def get_resampler(orig_freq, new_freq):
+    # NOTE Resample builds its sinc kernel in __init__, share one instance per rate pair
+    with resampler_lock:
+        if (orig_freq, new_freq) not in resampler_cache:
+            resampler_cache[(orig_freq, new_freq)] = torchaudio.transforms.Resample(orig_freq=orig_freq, new_freq=new_freq)
+        return resampler_cache[(orig_freq, new_freq)]
+
+
 def load_wav(wav, target_sr, min_sr=16000):
     speech, sample_rate = torchaudio.load(wav, backend='soundfile')
     speech = speech.mean(dim=0, keepdim=True)
     if sample_rate != target_sr:
         assert sample_rate >= min_sr, 'wav sample rate {} must be greater than {}'.format(sample_rate, target_sr)
-        speech = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=target_sr)(speech)
+        speech = get_resampler(sample_rate, target_sr)(speech)
     return speech
 
 
+class PromptAudio:
+    """Prompt wav decoded once, resampled views are computed on first use and reused afterwards."""
+
+    def __init__(self, wav, min_sr=16000, sample_rate=None):
+        # wav is a path or file object, or an already decoded (channel, time) tensor sampled at sample_rate
+        if isinstance(wav, torch.Tensor):
+            speech, self.sample_rate = wav, sample_rate
+        else:
+            speech, self.sample_rate = torchaudio.load(wav, backend='soundfile')
+        self.views = {self.sample_rate: speech.mean(dim=0, keepdim=True)}
+        self.min_sr = min_sr
+        self.lock = threading.Lock()
+
+    def resample(self, target_sr):
+        with self.lock:
+            if target_sr not in self.views:
+                assert self.sample_rate >= self.min_sr, 'wav sample rate {} must be greater than {}'.format(self.sample_rate, target_sr)
+                self.views[target_sr] = get_resampler(self.sample_rate, target_sr)(self.views[self.sample_rate])
+            return self.views[target_sr]
+
+
+class AudioReader:
+    """Windows of a wav of any length at sample_rate, only the window asked for is decoded and resampled.
+
+    wav is a path, a file object or a PromptAudio. Windows are resampled on their own, callers keep some context
+    around a window and drop the edges if the resampling edge effects matter.
+    """
+
+    def __init__(self, wav, sample_rate=16000, min_sr=16000):
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+        if isinstance(wav, PromptAudio):
+            self.audio, self.file = wav.resample(sample_rate), None
+            self.num_samples = self.audio.shape[1]
+        else:
+            import soundfile
+            self.audio, self.file = None, soundfile.SoundFile(wav)
+            assert self.file.samplerate >= min_sr, 'wav sample rate {} must be greater than {}'.format(self.file.samplerate, sample_rate)
+            self.num_samples = int(self.file.frames * sample_rate / self.file.samplerate)
+
+    def __len__(self):
+        return self.num_samples
+
+    def read(self, start, end):
+        """Mono samples [start, end) at sample_rate as a (1, time) tensor."""
+        start, end = max(start, 0), min(end, self.num_samples)
+        if self.audio is not None:
+            return self.audio[:, start: end]
+        ratio = self.file.samplerate / self.sample_rate
+        with self.lock:
+            self.file.seek(int(start * ratio))
+            data = self.file.read(int(end * ratio) - int(start * ratio), dtype='float32', always_2d=True)
+        speech = torch.from_numpy(data).transpose(0, 1).mean(dim=0, keepdim=True)
+        if self.file.samplerate != self.sample_rate:
+            speech = get_resampler(self.file.samplerate, self.sample_rate)(speech)
+        return speech[:, :end - start]
+
+
+file_hash_cache = {}
+file_hash_lock = threading.Lock()
+
+
+def file_hash(path):
+    """Sha1 of a file, or of every file below a directory, cached until the file changes."""
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, f) for root, _, names in os.walk(path) for f in names)
+        return hashlib.sha1(''.join('{}:{}'.format(os.path.relpath(f, path), file_hash(f)) for f in files).encode()).hexdigest()
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    with file_hash_lock:
+        if key in file_hash_cache:
+            return file_hash_cache[key]
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    with file_hash_lock:
+        file_hash_cache[key] = sha1.hexdigest()
+    return file_hash_cache[key]
+
+
 def convert_onnx_to_trt(trt_model, trt_kwargs, onnx_model, fp16):
     import tensorrt as trt
     logging.info("Converting onnx to trt...")
@@ -88,7 +183,7 @@ def convert_onnx_to_trt(trt_model, trt_kwargs, onnx_model, fp16):
     logging.info("Succesfully convert onnx to trt...")
 
 
-# NOTE do not support bistream inference as only speech token embedding/head is kept
+# NOTE only speech token embedding/head is kept, text token embedding stays in the local model and reaches vllm as prompt_embeds
 def export_cosyvoice2_vllm(model, model_path, device):
     if os.path.exists(model_path):
         return
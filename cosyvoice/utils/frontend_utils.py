@@ -13,7 +13,6 @@
 # limitations under the License.
 
 import re
-import regex
 chinese_char_pattern = re.compile(r'[\u4e00-\u9fff]+')
 
 
@@ -62,18 +61,27 @@ def spell_out_number(text: str, inflect_parser):
 # 1. per sentence max len token_max_n, min len token_min_n, merge if last sentence len less than merge_len
 # 2. cal sentence len according to lang
 # 3. split sentence according to puncatation
-def split_paragraph(text: str, tokenize, lang="zh", token_max_n=80, token_min_n=60, merge_len=20, comma_split=False):
+# 4. first_max_n > 0 favours first audio latency: the first segment has at most first_max_n tokens, a longer first sentence
+#    is cut at its last clause break within that budget, later segment budgets double up to token_max_n. Cuts only use pauses
+#    the text already has and leave at least first_min_n tokens on both sides, so the joined audio keeps its prosody
+def split_paragraph(text: str, tokenize, lang="zh", token_max_n=80, token_min_n=60, merge_len=20, comma_split=False, first_max_n=0, first_min_n=5):
     def calc_utt_length(_text: str):
         if lang == "zh":
             return len(_text)
         else:
             return len(tokenize(_text))
 
-    def should_merge(_text: str):
-        if lang == "zh":
-            return len(_text) < merge_len
-        else:
-            return len(tokenize(_text)) < merge_len
+    def split_first_clause(utt: str):
+        clause_pounc = ['，', ',', '、', '；', ';', '：', ':']
+        cut = None
+        for i, c in enumerate(utt[:-1]):
+            if c in clause_pounc:
+                head_len = calc_utt_length(utt[:i + 1])
+                if head_len > first_max_n:
+                    break
+                if head_len >= first_min_n and calc_utt_length(utt[i + 1:]) >= first_min_n:
+                    cut = i
+        return [utt] if cut is None else [utt[:cut + 1], utt[cut + 1:].lstrip()]
 
     if lang == "zh":
         pounc = ['。', '？', '！', '；', '：', '、', '.', '?', '!', ';']
@@ -101,15 +109,25 @@ def split_paragraph(text: str, tokenize, lang="zh", token_max_n=80, token_min_n=
             else:
                 st = i + 1
 
+    if first_max_n > 0 and len(utts) != 0 and calc_utt_length(utts[0]) > first_max_n:
+        utts = split_first_clause(utts[0]) + utts[1:]
+
+    # NOTE keep the running length of cur_utt, so every utt is tokenized once instead of re-tokenizing cur_utt + utt at every step
     final_utts = []
-    cur_utt = ""
+    cur_utt, cur_len = "", 0
     for utt in utts:
-        if calc_utt_length(cur_utt + utt) > token_max_n and calc_utt_length(cur_utt) > token_min_n:
+        utt_len = calc_utt_length(utt)
+        max_n, min_n = token_max_n, token_min_n
+        if first_max_n > 0:
+            max_n = min(token_max_n, first_max_n * 2 ** len(final_utts))
+            min_n = 0 if len(final_utts) == 0 else min(token_min_n, max_n // 2)
+        if cur_len + utt_len > max_n and cur_len > min_n:
             final_utts.append(cur_utt)
-            cur_utt = ""
-        cur_utt = cur_utt + utt
+            cur_utt, cur_len = "", 0
+        cur_utt, cur_len = cur_utt + utt, cur_len + utt_len
     if len(cur_utt) > 0:
-        if should_merge(cur_utt) and len(final_utts) != 0:
+        # the short first segment is never merged into
+        if cur_len < merge_len and len(final_utts) != 0 and (first_max_n == 0 or len(final_utts) > 1):
             final_utts[-1] = final_utts[-1] + cur_utt
         else:
             final_utts.append(cur_utt)
@@ -131,6 +149,8 @@ def replace_blank(text: str):
 
 
 def is_only_punctuation(text):
+    # NOTE imported here, the rest of this module is plain python and split_paragraph works without regex
+    import regex
     # Regular expression: Match strings that consist only of punctuation marks or are empty.
     punctuation_pattern = r'^[\p{P}\p{S}]*$'
     return bool(regex.fullmatch(punctuation_pattern, text))
@@ -0,0 +1,106 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Bookkeeping of a decoded speech token stream, plain python so it runs next to the llm loop without touching tensors."""
+
+import itertools
+import time
+from collections import Counter, deque
+
+
+class DegenerationDetector:
+    """Online check of a decoded speech token stream for generations that will never end well.
+
+    Limits are in seconds of speech, turned into tokens with token_rate, the speech tokens per second of the model.
+    update returns a reason code once the stream degenerates, otherwise None:
+    repetition, fewer than min_unique_ratio of the ngrams in the last window_sec of tokens are distinct, a loop;
+    silence, more than max_silent_sec of silent tokens in a row;
+    token_rate, more than max_sec_per_text_token seconds per text token plus slack_sec, far above any real speech rate
+    and well below the max_token_text_ratio cap of the llm. Skipped when text_len is None, e.g. bistream.
+    """
+
+    def __init__(self, text_len=None, silent_tokens=(), token_rate=25, ngram=4, window_sec=8, min_unique_ratio=0.3, max_silent_sec=5,
+                 max_sec_per_text_token=0.6, slack_sec=4):
+        self.max_len = None if text_len is None else int((text_len * max_sec_per_text_token + slack_sec) * token_rate)
+        self.silent_tokens = set(silent_tokens)
+        self.ngram = ngram
+        self.window = int(window_sec * token_rate)
+        self.min_unique_ratio = min_unique_ratio
+        self.max_silent_run = int(max_silent_sec * token_rate)
+        self.tokens = deque(maxlen=self.window)
+        self.ngrams = Counter()
+        self.num_tokens, self.silent_run = 0, 0
+
+    def update(self, token):
+        self.num_tokens += 1
+        self.silent_run = self.silent_run + 1 if token in self.silent_tokens else 0
+        if self.silent_run > self.max_silent_run:
+            return 'silence'
+        # ngrams of the window are counted incrementally, the one leaving the window is dropped
+        if len(self.tokens) == self.window:
+            first = tuple(itertools.islice(self.tokens, self.ngram))
+            self.ngrams[first] -= 1
+            if self.ngrams[first] == 0:
+                del self.ngrams[first]
+        self.tokens.append(token)
+        if len(self.tokens) >= self.ngram:
+            self.ngrams[tuple(self.tokens[i] for i in range(-self.ngram, 0))] += 1
+        if len(self.tokens) == self.window and len(self.ngrams) < self.min_unique_ratio * (self.window - self.ngram + 1):
+            return 'repetition'
+        if self.max_len is not None and self.num_tokens > self.max_len:
+            return 'token_rate'
+        return None
+
+
+class StreamHopScheduler:
+    """Token hop of each streaming chunk, a multiple of unit between 1 and max_multiple units.
+
+    The first hops are one unit so the first audio comes fast. After that the hop grows while producing it, at the
+    measured rtf (wall time between chunks per second of chunk audio, so llm speed and load are included), takes less
+    than safety of the audio buffered on the client, assumed to play from the first chunk on. Under load the rtf
+    rises and the buffer drains, and the hop shrinks back to one unit.
+    """
+
+    def __init__(self, unit, max_multiple, token_rate, safety=0.5, smoothing=0.5):
+        self.unit = unit
+        self.max_multiple = max(max_multiple, 1)
+        self.token_rate = token_rate
+        self.safety = safety
+        self.smoothing = smoothing
+        self.rtf = None
+        self.audio_sec, self.start_time, self.last_time = 0.0, None, None
+
+    def buffered_sec(self):
+        return 0.0 if self.start_time is None else self.audio_sec - (time.time() - self.start_time)
+
+    def hop_len(self):
+        if self.rtf is None:
+            return self.unit
+        budget = self.safety * self.buffered_sec()
+        multiple = 1
+        while multiple < self.max_multiple and (multiple + 1) * self.unit / self.token_rate * self.rtf <= budget:
+            multiple += 1
+        return multiple * self.unit
+
+    def update(self, num_tokens):
+        """Call when a chunk of num_tokens tokens is ready to be sent."""
+        now = time.time()
+        chunk_sec = num_tokens / self.token_rate
+        # the first chunk also waited for llm prefill, measuring starts from it
+        if self.last_time is not None:
+            rtf = (now - self.last_time) / chunk_sec
+            self.rtf = rtf if self.rtf is None else self.smoothing * self.rtf + (1 - self.smoothing) * rtf
+        if self.start_time is None:
+            self.start_time = now
+        self.audio_sec += chunk_sec
+        self.last_time = now
@@ -12,23 +12,70 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
+import json
 import logging
+import time
 import requests
 import torch
 import torchaudio
 import numpy as np
 
 
+def bistream():
+    # feed tts_text a few characters at a time over the websocket, like a streaming llm would, and report time to first audio
+    from websockets.sync.client import connect
+    with connect("ws://{}:{}/inference_bistream".format(args.host, args.port)) as websocket:
+        websocket.send(json.dumps({'prompt_text': args.prompt_text, 'audio_format': args.audio_format, 'model': args.model}))
+        with open(args.prompt_wav, 'rb') as f:
+            websocket.send(f.read())
+        start_time = time.time()
+        for i in range(0, len(args.tts_text), 4):
+            websocket.send(json.dumps({'type': 'text', 'text': args.tts_text[i: i + 4]}))
+        websocket.send(json.dumps({'type': 'end'}))
+        tts_audio = b''
+        while True:
+            message = websocket.recv()
+            if isinstance(message, str):
+                break
+            if tts_audio == b'':
+                logging.info('time to first audio {:.3f}s'.format(time.time() - start_time))
+            tts_audio += message
+    return tts_audio
+
+
 def main():
+    if args.mode == 'bistream':
+        tts_audio = bistream()
+    else:
+        tts_audio = request()
+    if args.audio_format != 'pcm':
+        # encoded responses are complete files already
+        with open(args.tts_wav, 'wb') as f:
+            f.write(tts_audio)
+        logging.info('save {} response to {}'.format(args.audio_format, args.tts_wav))
+        return
+    tts_speech = torch.from_numpy(np.array(np.frombuffer(tts_audio, dtype=np.int16))).unsqueeze(dim=0)
+    logging.info('save response to {}'.format(args.tts_wav))
+    torchaudio.save(args.tts_wav, tts_speech, target_sr)
+    logging.info('get response')
+
+
+def request():
     url = "http://{}:{}/inference_{}".format(args.host, args.port, args.mode)
     if args.mode == 'sft':
         payload = {
+            'audio_format': args.audio_format,
+            'model': args.model,
+            'first_max_n': args.first_max_n,
             'tts_text': args.tts_text,
             'spk_id': args.spk_id
         }
         response = requests.request("GET", url, data=payload, stream=True)
     elif args.mode == 'zero_shot':
         payload = {
+            'audio_format': args.audio_format,
+            'model': args.model,
+            'first_max_n': args.first_max_n,
             'tts_text': args.tts_text,
             'prompt_text': args.prompt_text
         }
@@ -36,12 +83,18 @@ def main():
         response = requests.request("GET", url, data=payload, files=files, stream=True)
     elif args.mode == 'cross_lingual':
         payload = {
+            'audio_format': args.audio_format,
+            'model': args.model,
+            'first_max_n': args.first_max_n,
             'tts_text': args.tts_text,
         }
         files = [('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))]
         response = requests.request("GET", url, data=payload, files=files, stream=True)
     else:
         payload = {
+            'audio_format': args.audio_format,
+            'model': args.model,
+            'first_max_n': args.first_max_n,
             'tts_text': args.tts_text,
             'spk_id': args.spk_id,
             'instruct_text': args.instruct_text
@@ -50,10 +103,7 @@ def main():
     tts_audio = b''
     for r in response.iter_content(chunk_size=16000):
         tts_audio += r
-    tts_speech = torch.from_numpy(np.array(np.frombuffer(tts_audio, dtype=np.int16))).unsqueeze(dim=0)
-    logging.info('save response to {}'.format(args.tts_wav))
-    torchaudio.save(args.tts_wav, tts_speech, target_sr)
-    logging.info('get response')
+    return tts_audio
 
 
 if __name__ == "__main__":
@@ -66,7 +116,7 @@ if __name__ == "__main__":
                         default='50000')
     parser.add_argument('--mode',
                         default='sft',
-                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct'],
+                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct', 'bistream'],
                         help='request mode')
     parser.add_argument('--tts_text',
                         type=str,
@@ -87,6 +137,18 @@ if __name__ == "__main__":
     parser.add_argument('--tts_wav',
                         type=str,
                         default='demo.wav')
+    parser.add_argument('--first_max_n',
+                        type=int,
+                        default=0,
+                        help='> 0 cuts the first sentence to about this many tokens for a faster first audio')
+    parser.add_argument('--audio_format',
+                        default='pcm',
+                        choices=['pcm', 'wav', 'opus', 'mp3', 'aac'],
+                        help='response audio format')
+    parser.add_argument('--model',
+                        type=str,
+                        default='',
+                        help='model name on a server hosting several models, empty for its default model')
     args = parser.parse_args()
     prompt_sr, target_sr = 16000, 22050
     main()
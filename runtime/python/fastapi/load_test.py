@@ -0,0 +1,106 @@
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Time to first byte under concurrent load
+    python3 load_test.py --mode zero_shot --concurrency 1,2,4,8 --num_requests 32
+    every level keeps `concurrency` requests in flight until num_requests are done, and reports ttfb and total latency
+    percentiles in ms of the served requests, plus requests that failed and requests the server rejected with 429.
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+
+
+def send():
+    url = "http://{}:{}/inference_{}".format(args.host, args.port, args.mode)
+    payload = {'tts_text': args.tts_text, 'audio_format': args.audio_format}
+    files = None
+    if args.mode == 'sft':
+        payload['spk_id'] = args.spk_id
+    elif args.mode == 'zero_shot':
+        payload['prompt_text'] = args.prompt_text
+    elif args.mode == 'instruct2':
+        payload['instruct_text'] = args.instruct_text
+    if args.mode in ['zero_shot', 'cross_lingual', 'instruct2']:
+        files = [('prompt_wav', ('prompt_wav', open(args.prompt_wav, 'rb'), 'application/octet-stream'))]
+    start_time = time.time()
+    response = requests.request("POST", url, data=payload, files=files, stream=True)
+    if response.status_code == 429:
+        return 'rejected'
+    if response.status_code != 200:
+        return None
+    ttfb = None
+    for chunk in response.iter_content(chunk_size=None):
+        if ttfb is None and len(chunk) != 0:
+            ttfb = time.time() - start_time
+    return ttfb, time.time() - start_time
+
+
+def percentiles(values):
+    return ' '.join('{:>8.0f}'.format(np.percentile(values, i) * 1000) for i in [50, 90, 99])
+
+
+def main():
+    print('{:>6} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}'.format('conc', 'ttfb_p50', 'ttfb_p90', 'ttfb_p99', 'tot_p50', 'tot_p90', 'tot_p99', 'failed', 'rejected'))
+    for concurrency in [int(i) for i in args.concurrency.split(',')]:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(lambda _: send(), range(args.num_requests)))
+        rejected = len([i for i in results if i == 'rejected'])
+        done = [i for i in results if isinstance(i, tuple) and i[0] is not None]
+        if len(done) == 0:
+            print('{:>6} all {} requests failed'.format(concurrency, len(results)))
+            continue
+        print('{:>6} {} {} {:>8} {:>8}'.format(concurrency, percentiles([i[0] for i in done]), percentiles([i[1] for i in done]),
+                                               len(results) - len(done) - rejected, rejected))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host',
+                        type=str,
+                        default='0.0.0.0')
+    parser.add_argument('--port',
+                        type=int,
+                        default='50000')
+    parser.add_argument('--mode',
+                        default='zero_shot',
+                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct2'],
+                        help='request mode')
+    parser.add_argument('--tts_text',
+                        type=str,
+                        default='你好，我是通义千问语音合成大模型，请问有什么可以帮您的吗？')
+    parser.add_argument('--spk_id',
+                        type=str,
+                        default='中文女')
+    parser.add_argument('--prompt_text',
+                        type=str,
+                        default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--prompt_wav',
+                        type=str,
+                        default='../../../asset/zero_shot_prompt.wav')
+    parser.add_argument('--instruct_text',
+                        type=str,
+                        default='用四川话说这句话<|endofprompt|>')
+    parser.add_argument('--audio_format',
+                        default='pcm',
+                        choices=['pcm', 'wav', 'opus', 'mp3', 'aac'])
+    parser.add_argument('--concurrency',
+                        type=str,
+                        default='1,2,4,8')
+    parser.add_argument('--num_requests',
+                        type=int,
+                        default=32)
+    args = parser.parse_args()
+    main()
@@ -14,18 +14,27 @@
 import os
 import sys
 import argparse
+import asyncio
+import io
 import logging
+import math
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
-from fastapi import FastAPI, UploadFile, Form, File
+from fastapi import FastAPI, UploadFile, Form, File, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
-import numpy as np
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append('{}/../../..'.format(ROOT_DIR))
 sys.path.append('{}/../../../third_party/Matcha-TTS'.format(ROOT_DIR))
-from cosyvoice.cli.cosyvoice import AutoModel
-from cosyvoice.utils.file_utils import load_wav
+from cosyvoice.cli.registry import ModelRegistry, parse_models
+from cosyvoice.utils.admission import AdmissionController, AdmissionRejected, estimate_cost
+from cosyvoice.utils.audio_utils import encode_stream, get_audio_encoder
+from cosyvoice.utils.file_utils import PromptAudio
 
 app = FastAPI()
 # set cross region allowance
@@ -37,48 +46,314 @@ app.add_middleware(
     allow_headers=["*"])
 
 
-def generate_data(model_output):
-    for i in model_output:
-        tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
-        yield tts_audio
+def prenormalize(cosyvoice, tts_text, prompt_text='', first_max_n=0):
+    # start normalization on the text pool as soon as the request arrives, the streaming generator then hits the frontend cache
+    if cosyvoice.frontend.text_pool is not None:
+        cosyvoice.frontend.text_normalize_async(tts_text, first_max_n=first_max_n)
+        if prompt_text != '':
+            cosyvoice.frontend.text_normalize_async(prompt_text, split=False)
+
+
+async def acquire_model(model):
+    # resolve the model of the request and load it off the event loop if it is not loaded, unknown models are a 404
+    try:
+        return await asyncio.get_running_loop().run_in_executor(None, registry.acquire, model)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+def request_done(model, ticket):
+    # called once synthesis of the request ends, frees its admission cost and lets the registry unload its model again.
+    # safe to call more than once, synthesis calls it when it ends and the response calls it again in case synthesis never started
+    start_time, lock, released = time.time(), threading.Lock(), []
+
+    def done():
+        with lock:
+            if released:
+                return
+            released.append(True)
+        if ticket is not None:
+            admission.release(ticket)
+        registry.release(model, time.time() - start_time)
+    return done
+
+
+async def admit(cosyvoice, model, tts_text, mode, stream=False, text_len=None):
+    # returns the done callback of the request, raises AdmissionRejected after releasing the model
+    if admission is None:
+        return request_done(model, None)
+    loop = asyncio.get_running_loop()
+    try:
+        if text_len is None:
+            # the cost follows the normalized text, numbers and symbols expand a lot, the result is cached for inference
+            texts = await loop.run_in_executor(None, cosyvoice.frontend.text_normalize, tts_text, True)
+            text_len = sum(len(i) for i in texts)
+        cost = estimate_cost(text_len, mode, stream)
+        if admission.queue_timeout > 0:
+            return request_done(model, await loop.run_in_executor(None, admission.acquire, cost))
+        return request_done(model, admission.acquire(cost))
+    except Exception:
+        registry.release(model)
+        raise
+
+
+def too_busy(e):
+    return HTTPException(status_code=429, detail=str(e), headers={'Retry-After': str(math.ceil(e.retry_after))})
+
+
+def put_chunk(data, loop, chunks, cancel):
+    # block while the request queue is full, give up once the client is gone
+    future = asyncio.run_coroutine_threadsafe(chunks.put(data), loop)
+    while not cancel.is_set():
+        try:
+            future.result(timeout=1.0)
+            return True
+        except TimeoutError:
+            continue
+    future.cancel()
+    return False
+
+
+def synthesize(model_output, encoder, loop, chunks, cancel, done=None):
+    # runs on the synthesis executor, hands every encoded chunk to the event loop through the request's asyncio queue
+    stream = encode_stream(model_output, encoder)
+    try:
+        for data in stream:
+            if put_chunk(data, loop, chunks, cancel) is False:
+                return
+    except Exception as e:
+        logging.error('synthesis failed: {}'.format(e))
+    finally:
+        stream.close()
+        if done is not None:
+            done()
+    put_chunk(None, loop, chunks, cancel)
+
+
+async def stream_chunks(model_output, encoder, cancel=None, done=None):
+    loop = asyncio.get_running_loop()
+    chunks, cancel = asyncio.Queue(maxsize=args.max_pending), cancel if cancel is not None else threading.Event()
+    loop.run_in_executor(executor, synthesize, model_output, encoder, loop, chunks, cancel, done)
+    try:
+        while True:
+            data = await chunks.get()
+            if data is None:
+                break
+            yield data
+    finally:
+        # client went away, stop synthesis after its current chunk
+        cancel.set()
+
+
+def generate_data(cosyvoice, model_output, audio_format='pcm', done=None):
+    # synthesis never runs on the event loop, at most max_conc requests synthesize at once and the rest wait in the executor
+    try:
+        encoder = get_audio_encoder(audio_format, cosyvoice.sample_rate)
+    except Exception:
+        if done is not None:
+            done()
+        raise
+    # NOTE the body only starts synthesis once it is iterated, a client that disconnects before that never runs it, the background
+    # task runs after the response either way and releases the request
+    return StreamingResponse(stream_chunks(model_output, encoder, done=done), media_type=encoder.media_type,
+                             background=BackgroundTask(done) if done is not None else None)
+
+
+async def load_prompt(prompt_wav):
+    # decode the upload off the event loop
+    return await asyncio.get_running_loop().run_in_executor(None, PromptAudio, prompt_wav.file)
+
+
+@app.get("/models")
+def models():
+    # per model memory, shared memory, requests and latency
+    return registry.stats()
 
 
 @app.get("/inference_sft")
 @app.post("/inference_sft")
-async def inference_sft(tts_text: str = Form(), spk_id: str = Form()):
-    model_output = cosyvoice.inference_sft(tts_text, spk_id)
-    return StreamingResponse(generate_data(model_output))
+async def inference_sft(tts_text: str = Form(), spk_id: str = Form(), audio_format: str = Form('pcm'), model: str = Form(''),
+                        first_max_n: int = Form(0)):
+    cosyvoice = await acquire_model(model)
+    prenormalize(cosyvoice, tts_text, first_max_n=first_max_n)
+    try:
+        done = await admit(cosyvoice, model, tts_text, 'sft')
+    except AdmissionRejected as e:
+        raise too_busy(e)
+    model_output = cosyvoice.inference_sft(tts_text, spk_id, pipeline_lookahead=args.pipeline_lookahead, first_max_n=first_max_n)
+    return generate_data(cosyvoice, model_output, audio_format, done)
 
 
 @app.get("/inference_zero_shot")
 @app.post("/inference_zero_shot")
-async def inference_zero_shot(tts_text: str = Form(), prompt_text: str = Form(), prompt_wav: UploadFile = File()):
-    prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+async def inference_zero_shot(tts_text: str = Form(), prompt_text: str = Form(), prompt_wav: UploadFile = File(), audio_format: str = Form('pcm'),
+                              model: str = Form(''), first_max_n: int = Form(0)):
+    prompt_audio = await load_prompt(prompt_wav)
+    cosyvoice = await acquire_model(model)
+    prenormalize(cosyvoice, tts_text, prompt_text, first_max_n=first_max_n)
+    try:
+        done = await admit(cosyvoice, model, tts_text, 'zero_shot')
+    except AdmissionRejected as e:
+        raise too_busy(e)
+    model_output = cosyvoice.inference_zero_shot(tts_text, prompt_text, prompt_audio, pipeline_lookahead=args.pipeline_lookahead, first_max_n=first_max_n)
+    return generate_data(cosyvoice, model_output, audio_format, done)
 
 
 @app.get("/inference_cross_lingual")
 @app.post("/inference_cross_lingual")
-async def inference_cross_lingual(tts_text: str = Form(), prompt_wav: UploadFile = File()):
-    prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_cross_lingual(tts_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+async def inference_cross_lingual(tts_text: str = Form(), prompt_wav: UploadFile = File(), audio_format: str = Form('pcm'), model: str = Form(''),
+                                  first_max_n: int = Form(0)):
+    prompt_audio = await load_prompt(prompt_wav)
+    cosyvoice = await acquire_model(model)
+    prenormalize(cosyvoice, tts_text, first_max_n=first_max_n)
+    try:
+        done = await admit(cosyvoice, model, tts_text, 'cross_lingual')
+    except AdmissionRejected as e:
+        raise too_busy(e)
+    model_output = cosyvoice.inference_cross_lingual(tts_text, prompt_audio, pipeline_lookahead=args.pipeline_lookahead, first_max_n=first_max_n)
+    return generate_data(cosyvoice, model_output, audio_format, done)
 
 
 @app.get("/inference_instruct")
 @app.post("/inference_instruct")
-async def inference_instruct(tts_text: str = Form(), spk_id: str = Form(), instruct_text: str = Form()):
-    model_output = cosyvoice.inference_instruct(tts_text, spk_id, instruct_text)
-    return StreamingResponse(generate_data(model_output))
+async def inference_instruct(tts_text: str = Form(), spk_id: str = Form(), instruct_text: str = Form(), audio_format: str = Form('pcm'),
+                             model: str = Form(''), first_max_n: int = Form(0)):
+    cosyvoice = await acquire_model(model)
+    prenormalize(cosyvoice, tts_text, instruct_text, first_max_n=first_max_n)
+    try:
+        done = await admit(cosyvoice, model, tts_text, 'instruct')
+    except AdmissionRejected as e:
+        raise too_busy(e)
+    model_output = cosyvoice.inference_instruct(tts_text, spk_id, instruct_text, pipeline_lookahead=args.pipeline_lookahead, first_max_n=first_max_n)
+    return generate_data(cosyvoice, model_output, audio_format, done)
 
 
 @app.get("/inference_instruct2")
 @app.post("/inference_instruct2")
-async def inference_instruct2(tts_text: str = Form(), instruct_text: str = Form(), prompt_wav: UploadFile = File()):
-    prompt_speech_16k = load_wav(prompt_wav.file, 16000)
-    model_output = cosyvoice.inference_instruct2(tts_text, instruct_text, prompt_speech_16k)
-    return StreamingResponse(generate_data(model_output))
+async def inference_instruct2(tts_text: str = Form(), instruct_text: str = Form(), prompt_wav: UploadFile = File(), audio_format: str = Form('pcm'),
+                              model: str = Form(''), first_max_n: int = Form(0)):
+    prompt_audio = await load_prompt(prompt_wav)
+    cosyvoice = await acquire_model(model)
+    prenormalize(cosyvoice, tts_text, first_max_n=first_max_n)
+    try:
+        done = await admit(cosyvoice, model, tts_text, 'instruct2')
+    except AdmissionRejected as e:
+        raise too_busy(e)
+    model_output = cosyvoice.inference_instruct2(tts_text, instruct_text, prompt_audio, pipeline_lookahead=args.pipeline_lookahead, first_max_n=first_max_n)
+    return generate_data(cosyvoice, model_output, audio_format, done)
+
+
+@app.websocket("/inference_bistream")
+async def inference_bistream(websocket: WebSocket):
+    """Zero shot synthesis of text that arrives piece by piece, e.g. from a streaming llm.
+
+    client -> server: a json start frame {"prompt_text", "zero_shot_spk_id", "audio_format", "speed", "text_len", "model"}, then the prompt wav
+    as one binary frame unless zero_shot_spk_id is given, then any number of {"type": "text", "text": ...} frames and
+    finally {"type": "end"}, or {"type": "cancel"} to abort.
+    server -> client: binary audio frames as soon as every token2wav hop is done, then {"type": "end"}. An overloaded
+    server sends {"type": "error", "code": 429} instead of any audio and closes with 1013, a malformed client frame is
+    answered with {"type": "error", "code": 400} and ends the request.
+    """
+    await websocket.accept()
+    start = await websocket.receive_json()
+    zero_shot_spk_id = start.get('zero_shot_spk_id', '')
+    prompt_audio = None
+    if zero_shot_spk_id == '':
+        prompt_audio = await asyncio.get_running_loop().run_in_executor(None, PromptAudio, io.BytesIO(await websocket.receive_bytes()))
+    model = start.get('model', '')
+    try:
+        cosyvoice = await acquire_model(model)
+    except HTTPException as e:
+        await websocket.send_json({'type': 'error', 'code': e.status_code, 'message': e.detail})
+        # 1008 policy violation
+        await websocket.close(code=1008)
+        return
+    try:
+        # the text is not known yet, the client may announce its length, otherwise a typical reply length is assumed
+        done = await admit(cosyvoice, model, '', 'bistream', stream=True, text_len=int(start.get('text_len', 200)))
+    except AdmissionRejected as e:
+        await websocket.send_json({'type': 'error', 'code': 429, 'message': str(e), 'retry_after': e.retry_after})
+        # 1013 try again later
+        await websocket.close(code=1013)
+        return
+    texts, cancel, first_text_time = queue.Queue(), threading.Event(), []
+
+    def text_generator():
+        # consumed by the llm thread, blocks until the client sends the next piece
+        while True:
+            text = texts.get()
+            if text is None or cancel.is_set():
+                return
+            yield text
+
+    model_output = cosyvoice.inference_zero_shot(text_generator(), start.get('prompt_text', ''), prompt_audio, zero_shot_spk_id=zero_shot_spk_id,
+                                                 stream=True, speed=float(start.get('speed', 1.0)))
+    try:
+        encoder = get_audio_encoder(start.get('audio_format', 'pcm'), cosyvoice.sample_rate)
+    except Exception:
+        done()
+        raise
+
+    async def send():
+        chunks = stream_chunks(model_output, encoder, cancel, done)
+        try:
+            async for data in chunks:
+                if len(first_text_time) == 1:
+                    first_text_time.append(time.time())
+                    logging.info('time to first audio {:.3f}s since first text frame'.format(first_text_time[1] - first_text_time[0]))
+                # NOTE awaiting the send is the flow control, a slow client fills the chunk queue and pauses synthesis
+                await websocket.send_bytes(data)
+            await websocket.send_json({'type': 'end'})
+        finally:
+            await chunks.aclose()
+
+    async def receive():
+        try:
+            while True:
+                message = await websocket.receive_json()
+                message_type = message.get('type') if isinstance(message, dict) else None
+                if message_type == 'text':
+                    if not isinstance(message.get('text'), str):
+                        raise ValueError('text frame without a text string')
+                    if len(first_text_time) == 0:
+                        first_text_time.append(time.time())
+                    texts.put(message['text'])
+                elif message_type == 'end':
+                    texts.put(None)
+                    return
+                elif message_type == 'cancel':
+                    sender.cancel()
+                    return
+                else:
+                    raise ValueError('unknown frame type {}'.format(message_type))
+        except WebSocketDisconnect:
+            sender.cancel()
+        except Exception as e:
+            # a malformed frame ends the request, otherwise the llm thread would wait for text forever
+            logging.warning('bad bistream frame: {}'.format(e))
+            texts.put(None)
+            try:
+                await websocket.send_json({'type': 'error', 'code': 400, 'message': str(e)})
+            except Exception:
+                pass
+            sender.cancel()
+
+    sender = asyncio.create_task(send())
+    receiver = asyncio.create_task(receive())
+    try:
+        await asyncio.wait([sender])
+    finally:
+        # end the text generator, so the llm thread finishes instead of waiting for text forever
+        cancel.set()
+        texts.put(None)
+        receiver.cancel()
+        # a sender cancelled before its first chunk never started synthesis
+        done()
+    try:
+        await websocket.close()
+    except RuntimeError:
+        # the client already closed the connection
+        pass
 
 
 if __name__ == '__main__':
@@ -90,6 +365,65 @@ if __name__ == '__main__':
                         type=str,
                         default='iic/CosyVoice2-0.5B',
                         help='local path or modelscope repo id')
+    parser.add_argument('--models',
+                        type=str,
+                        default='',
+                        help='more models to host besides model_dir, name=model_dir,name=model_dir, requests choose one with the model field')
+    parser.add_argument('--memory_budget_gb',
+                        type=float,
+                        default=0,
+                        help='unload least recently used idle models beyond this many GB of weights, 0 means no limit')
+    parser.add_argument('--load_static_decode',
+                        action='store_true',
+                        help='decode the CosyVoice2/3 llm with a preallocated static kv cache')
+    parser.add_argument('--max_conc',
+                        type=int,
+                        default=4,
+                        help='requests synthesizing at the same time, later requests wait for a free slot')
+    parser.add_argument('--pipeline_lookahead',
+                        type=int,
+                        default=0,
+                        help='sentences of a request synthesized ahead of the one being sent, 0 synthesizes them one by one')
+    parser.add_argument('--max_pending',
+                        type=int,
+                        default=8,
+                        help='encoded chunks buffered per request before synthesis waits for the client')
+    parser.add_argument('--admission_capacity',
+                        type=float,
+                        default=0,
+                        help='initial normalized characters synthesized per second, refined by measurement, 0 disables admission control')
+    parser.add_argument('--admission_slo',
+                        type=float,
+                        default=10.0,
+                        help='requests predicted to finish later than this many seconds are rejected with 429')
+    parser.add_argument('--admission_queue_sec',
+                        type=float,
+                        default=0.0,
+                        help='how long a request that does not fit may wait for capacity before it is rejected')
+    parser.add_argument('--text_pool_workers',
+                        type=int,
+                        default=0,
+                        help='text normalization processes, 0 means normalize inline')
+    parser.add_argument('--degeneration_check',
+                        action='store_true',
+                        help='stop looping, silent or far too long llm generations early and count them per reason at GET /models')
     args = parser.parse_args()
-    cosyvoice = AutoModel(model_dir=args.model_dir)
+
+    def on_load(model):
+        if args.text_pool_workers > 0:
+            model.frontend.start_text_pool(num_workers=args.text_pool_workers)
+        if args.degeneration_check:
+            model.model.degeneration_kwargs = {}
+    # every synthesis slot runs its sentence and pipeline_lookahead more, one pool per model so no request waits on another
+    pipeline_workers = args.max_conc * (args.pipeline_lookahead + 1) if args.pipeline_lookahead > 0 else 0
+    registry = ModelRegistry(memory_budget=int(args.memory_budget_gb * 2 ** 30), load_static_decode=args.load_static_decode, pipeline_workers=pipeline_workers,
+                             on_load=on_load)
+    # model_dir is the default model of requests without a model field
+    registry.register('default', args.model_dir)
+    for name, model_dir in parse_models(args.models).items():
+        registry.register(name, model_dir)
+    registry.get()
+    executor = ThreadPoolExecutor(max_workers=args.max_conc, thread_name_prefix='synthesis')
+    admission = AdmissionController(args.admission_capacity, slo=args.admission_slo, queue_timeout=args.admission_queue_sec,
+                                    saturation=args.max_conc) if args.admission_capacity > 0 else None
     uvicorn.run(app, host="0.0.0.0", port=args.port)
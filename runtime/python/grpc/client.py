@@ -18,6 +18,8 @@ sys.path.append('{}/../../..'.format(ROOT_DIR))
 sys.path.append('{}/../../../third_party/Matcha-TTS'.format(ROOT_DIR))
 import logging
 import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
 import torchaudio
 import cosyvoice_pb2
 import cosyvoice_pb2_grpc
@@ -27,47 +29,124 @@ import numpy as np
 from cosyvoice.utils.file_utils import load_wav
 
 
+def prompt_audio():
+    prompt_speech = load_wav(args.prompt_wav, 16000)
+    return (prompt_speech.numpy() * (2**15)).astype(np.int16).tobytes()
+
+
+def build_request():
+    request = cosyvoice_pb2.Request()
+    if args.mode == 'sft':
+        logging.info('send sft request')
+        sft_request = cosyvoice_pb2.sftRequest()
+        sft_request.spk_id = args.spk_id
+        sft_request.tts_text = args.tts_text
+        request.sft_request.CopyFrom(sft_request)
+    elif args.mode == 'zero_shot':
+        logging.info('send zero_shot request')
+        zero_shot_request = cosyvoice_pb2.zeroshotRequest()
+        zero_shot_request.tts_text = args.tts_text
+        zero_shot_request.prompt_text = args.prompt_text
+        if args.zero_shot_spk_id != '':
+            zero_shot_request.zero_shot_spk_id = args.zero_shot_spk_id
+        else:
+            zero_shot_request.prompt_audio = prompt_audio()
+        request.zero_shot_request.CopyFrom(zero_shot_request)
+    elif args.mode == 'cross_lingual':
+        logging.info('send cross_lingual request')
+        cross_lingual_request = cosyvoice_pb2.crosslingualRequest()
+        cross_lingual_request.tts_text = args.tts_text
+        if args.zero_shot_spk_id != '':
+            cross_lingual_request.zero_shot_spk_id = args.zero_shot_spk_id
+        else:
+            cross_lingual_request.prompt_audio = prompt_audio()
+        request.cross_lingual_request.CopyFrom(cross_lingual_request)
+    else:
+        logging.info('send instruct request')
+        instruct_request = cosyvoice_pb2.instructRequest()
+        instruct_request.tts_text = args.tts_text
+        instruct_request.spk_id = args.spk_id
+        instruct_request.instruct_text = args.instruct_text
+        request.instruct_request.CopyFrom(instruct_request)
+    request.audio_format = args.audio_format
+    request.first_max_n = args.first_max_n
+    return request
+
+
+def stream_requests():
+    # the text goes out piece by piece, as a streaming llm would produce it
+    start = cosyvoice_pb2.StreamStart(zero_shot_spk_id=args.zero_shot_spk_id, prompt_text=args.prompt_text, audio_format=args.audio_format,
+                                       text_len=len(args.tts_text))
+    if args.zero_shot_spk_id == '':
+        start.prompt_audio = prompt_audio()
+    yield cosyvoice_pb2.StreamRequest(start=start)
+    for i in range(0, len(args.tts_text), args.text_chunk):
+        yield cosyvoice_pb2.StreamRequest(tts_text=args.tts_text[i: i + args.text_chunk])
+
+
+def synthesize(stub, request):
+    """Return (time to first byte, total time, audio bytes) of one request."""
+    start_time, first_time, tts_audio = time.time(), None, b''
+    response = stub.StreamInference(stream_requests()) if args.mode == 'stream' else stub.Inference(request)
+    for r in response:
+        if first_time is None:
+            first_time = time.time()
+        tts_audio += r.tts_audio
+    return first_time - start_time, time.time() - start_time, tts_audio
+
+
+def try_synthesize(stub, request):
+    # None when the server sheds the request
+    try:
+        return synthesize(stub, request)
+    except grpc.RpcError as e:
+        if e.code() == grpc.StatusCode.RESOURCE_EXHAUSTED:
+            return None
+        raise
+
+
+def benchmark(stub, request):
+    for concurrency in [int(i) for i in args.concurrency.split(',')]:
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(lambda _: try_synthesize(stub, request), range(args.num_requests)))
+        rejected = len([i for i in results if i is None])
+        results = [i for i in results if i is not None]
+        if len(results) == 0:
+            logging.info('concurrency {} all {} requests rejected'.format(concurrency, args.num_requests))
+            continue
+        ttfb = np.array([i[0] for i in results])
+        total = np.array([i[1] for i in results])
+        logging.info('concurrency {} requests {} rejected {} throughput {:.2f} req/s'.format(concurrency, args.num_requests, rejected,
+                                                                                             len(results) / (time.time() - start_time)))
+        for name, values in (('ttfb', ttfb), ('total', total)):
+            logging.info('  {:<5} p50 {:.3f}s p90 {:.3f}s p99 {:.3f}s'.format(name, *np.percentile(values, [50, 90, 99])))
+
+
 def main():
     with grpc.insecure_channel("{}:{}".format(args.host, args.port)) as channel:
         stub = cosyvoice_pb2_grpc.CosyVoiceStub(channel)
-        request = cosyvoice_pb2.Request()
-        if args.mode == 'sft':
-            logging.info('send sft request')
-            sft_request = cosyvoice_pb2.sftRequest()
-            sft_request.spk_id = args.spk_id
-            sft_request.tts_text = args.tts_text
-            request.sft_request.CopyFrom(sft_request)
-        elif args.mode == 'zero_shot':
-            logging.info('send zero_shot request')
-            zero_shot_request = cosyvoice_pb2.zeroshotRequest()
-            zero_shot_request.tts_text = args.tts_text
-            zero_shot_request.prompt_text = args.prompt_text
-            prompt_speech = load_wav(args.prompt_wav, 16000)
-            zero_shot_request.prompt_audio = (prompt_speech.numpy() * (2**15)).astype(np.int16).tobytes()
-            request.zero_shot_request.CopyFrom(zero_shot_request)
-        elif args.mode == 'cross_lingual':
-            logging.info('send cross_lingual request')
-            cross_lingual_request = cosyvoice_pb2.crosslingualRequest()
-            cross_lingual_request.tts_text = args.tts_text
-            prompt_speech = load_wav(args.prompt_wav, 16000)
-            cross_lingual_request.prompt_audio = (prompt_speech.numpy() * (2**15)).astype(np.int16).tobytes()
-            request.cross_lingual_request.CopyFrom(cross_lingual_request)
-        else:
-            logging.info('send instruct request')
-            instruct_request = cosyvoice_pb2.instructRequest()
-            instruct_request.tts_text = args.tts_text
-            instruct_request.spk_id = args.spk_id
-            instruct_request.instruct_text = args.instruct_text
-            request.instruct_request.CopyFrom(instruct_request)
-
-        response = stub.Inference(request)
-        tts_audio = b''
-        for r in response:
-            tts_audio += r.tts_audio
+        if args.mode == 'register':
+            logging.info('register speaker {}'.format(args.zero_shot_spk_id))
+            response = stub.RegisterSpeaker(cosyvoice_pb2.RegisterSpeakerRequest(zero_shot_spk_id=args.zero_shot_spk_id,
+                                                                                   prompt_text=args.prompt_text, prompt_audio=prompt_audio()))
+            logging.info('register speaker success {}'.format(response.success))
+            return
+        request = build_request() if args.mode != 'stream' else None
+        if args.concurrency != '':
+            benchmark(stub, request)
+            return
+        ttfb, total, tts_audio = synthesize(stub, request)
+        logging.info('get response, first byte after {:.3f}s, last after {:.3f}s'.format(ttfb, total))
+        if args.audio_format != 'pcm':
+            # encoded responses are complete files already
+            with open(args.tts_wav, 'wb') as f:
+                f.write(tts_audio)
+            logging.info('save {} response to {}'.format(args.audio_format, args.tts_wav))
+            return
         tts_speech = torch.from_numpy(np.array(np.frombuffer(tts_audio, dtype=np.int16))).unsqueeze(dim=0)
         logging.info('save response to {}'.format(args.tts_wav))
         torchaudio.save(args.tts_wav, tts_speech, target_sr)
-        logging.info('get response')
 
 
 if __name__ == "__main__":
@@ -80,8 +159,8 @@ if __name__ == "__main__":
                         default='50000')
     parser.add_argument('--mode',
                         default='sft',
-                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct'],
-                        help='request mode')
+                        choices=['sft', 'zero_shot', 'cross_lingual', 'instruct', 'stream', 'register'],
+                        help='request mode, stream sends tts_text in pieces over StreamInference, register adds zero_shot_spk_id to the server')
     parser.add_argument('--tts_text',
                         type=str,
                         default='你好，我是通义千问语音合成大模型，请问有什么可以帮您的吗？')
@@ -101,6 +180,30 @@ if __name__ == "__main__":
     parser.add_argument('--tts_wav',
                         type=str,
                         default='demo.wav')
+    parser.add_argument('--first_max_n',
+                        type=int,
+                        default=0,
+                        help='> 0 cuts the first sentence to about this many tokens for a faster first audio')
+    parser.add_argument('--audio_format',
+                        default='pcm',
+                        choices=['pcm', 'wav', 'opus', 'mp3', 'aac'],
+                        help='response audio format')
+    parser.add_argument('--zero_shot_spk_id',
+                        type=str,
+                        default='',
+                        help='speaker registered on the server, the prompt audio is not sent then')
+    parser.add_argument('--text_chunk',
+                        type=int,
+                        default=8,
+                        help='characters per text message in stream mode')
+    parser.add_argument('--concurrency',
+                        type=str,
+                        default='',
+                        help='benchmark mode, comma separated concurrency levels, e.g. 1,2,4,8')
+    parser.add_argument('--num_requests',
+                        type=int,
+                        default=16,
+                        help='requests per concurrency level in benchmark mode')
     args = parser.parse_args()
     prompt_sr, target_sr = 16000, 22050
     main()
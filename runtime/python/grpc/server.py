@@ -13,8 +13,13 @@
 # limitations under the License.
 import os
 import sys
-from concurrent import futures
 import argparse
+import asyncio
+import hashlib
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import cosyvoice_pb2
 import cosyvoice_pb2_grpc
 import logging
@@ -26,52 +31,373 @@ ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append('{}/../../..'.format(ROOT_DIR))
 sys.path.append('{}/../../../third_party/Matcha-TTS'.format(ROOT_DIR))
 from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.utils.admission import AdmissionController, AdmissionRejected, estimate_cost
+from cosyvoice.utils.audio_utils import encode_stream, get_audio_encoder
+from cosyvoice.utils.file_utils import PromptAudio
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s %(levelname)s %(message)s')
 
 
+def pcm_to_prompt(prompt_audio):
+    # prompt audio travels as raw int16 pcm at 16k
+    prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
+    return PromptAudio(prompt_speech_16k.float() / (2**15), sample_rate=16000)
+
+
+class Broadcast:
+    """Encoded chunks of one synthesis, shared by every rpc that asked for byte identical audio.
+
+    This only de-duplicates identical requests, distinct requests are separate syntheses whose llm steps are batched
+    by vllm with --load_vllm. Late subscribers replay the chunks sent so far, once more than max_replay chunks were
+    sent the broadcast stops taking subscribers and only keeps the chunks its slowest subscriber has not read yet.
+    """
+
+    def __init__(self, max_replay=64):
+        self.chunks, self.done, self.error = [], False, None
+        self.condition = asyncio.Condition()
+        self.subscribers = 0
+        self.cancel = threading.Event()
+        self.max_replay = max_replay
+        self.joinable = True
+        # chunks dropped from the front of self.chunks, and the next chunk index of every subscriber
+        self.offset = 0
+        self.positions = {}
+
+    async def publish(self, data):
+        async with self.condition:
+            self.chunks.append(data)
+            if self.offset + len(self.chunks) > self.max_replay:
+                self.joinable = False
+                self.trim()
+            self.condition.notify_all()
+
+    def trim(self):
+        if self.joinable is False:
+            drop = min(self.positions.values(), default=self.offset + len(self.chunks)) - self.offset
+            del self.chunks[:drop]
+            self.offset += drop
+
+    async def finish(self, error=None):
+        async with self.condition:
+            self.done, self.error = True, error
+            self.condition.notify_all()
+
+    async def subscribe(self):
+        # a late subscriber first replays the chunks sent so far, so it also gets the container header
+        assert self.joinable, 'the replay buffer of this broadcast was already trimmed'
+        token = object()
+        self.subscribers += 1
+        self.positions[token] = 0
+        try:
+            i = 0
+            while True:
+                async with self.condition:
+                    await self.condition.wait_for(lambda: self.offset + len(self.chunks) > i or self.done)
+                    chunks, done, error = self.chunks[i - self.offset:], self.done, self.error
+                for data in chunks:
+                    yield data
+                i += len(chunks)
+                self.positions[token] = i
+                self.trim()
+                if done and i == self.offset + len(self.chunks):
+                    if error is not None:
+                        raise error
+                    return
+        finally:
+            self.subscribers -= 1
+            del self.positions[token]
+            self.trim()
+            if self.subscribers == 0:
+                # nobody listens any more, stop synthesis after its current chunk
+                self.cancel.set()
+
+
 class CosyVoiceServiceImpl(cosyvoice_pb2_grpc.CosyVoiceServicer):
     def __init__(self, args):
-        self.cosyvoice = AutoModel(model_dir=args.model_dir)
+        # every synthesis slot runs its sentence and pipeline_lookahead more, one pool for all so no request waits on another
+        pipeline_workers = args.max_conc * (args.pipeline_lookahead + 1) if args.pipeline_lookahead > 0 else 0
+        self.cosyvoice = AutoModel(model_dir=args.model_dir, load_vllm=args.load_vllm, load_static_decode=args.load_static_decode,
+                                   pipeline_workers=pipeline_workers)
+        if args.text_pool_workers > 0:
+            self.cosyvoice.frontend.start_text_pool(num_workers=args.text_pool_workers)
+        if args.degeneration_check:
+            self.cosyvoice.model.degeneration_kwargs = {}
+        # NOTE synthesis runs on max_conc threads, rpcs themselves only await, so a waiting rpc holds no thread
+        self.executor = ThreadPoolExecutor(max_workers=args.max_conc, thread_name_prefix='synthesis')
+        # prompt hash -> future of the zero_shot_spk_id it was registered as, concurrent requests with the same prompt extract it once.
+        # prompt hash -> syntheses using it, only prompts no synthesis uses are evicted beyond max_prompts
+        self.prompts = OrderedDict()
+        self.prompt_refs = {}
+        self.max_prompts = args.max_prompts
+        self.pipeline_lookahead = args.pipeline_lookahead
+        # request key -> Broadcast, byte identical requests in flight share one synthesis
+        self.inflight = {}
+        self.max_replay_chunks = args.max_replay_chunks
+        self.admission = AdmissionController(args.admission_capacity, slo=args.admission_slo, queue_timeout=args.admission_queue_sec,
+                                             saturation=args.max_conc) if args.admission_capacity > 0 else None
         logging.info('grpc service initialized')
 
-    def Inference(self, request, context):
+    def prenormalize(self, request):
+        # start normalization on the text pool as soon as the request arrives, inference then hits the frontend cache
+        if self.cosyvoice.frontend.text_pool is None:
+            return
+        payload = getattr(request, request.WhichOneof('RequestPayload'))
+        self.cosyvoice.frontend.text_normalize_async(payload.tts_text, first_max_n=request.first_max_n)
+        for key in ('prompt_text', 'instruct_text'):
+            if getattr(payload, key, '') != '':
+                self.cosyvoice.frontend.text_normalize_async(getattr(payload, key), split=False)
+
+    async def admit(self, tts_text, mode, stream=False, text_len=None):
+        # returns the admission ticket of the request, or None when admission control is off
+        if self.admission is None:
+            return None
+        loop = asyncio.get_running_loop()
+        if text_len is None:
+            # the cost follows the normalized text, the result is cached for inference
+            texts = await loop.run_in_executor(None, self.cosyvoice.frontend.text_normalize, tts_text, True)
+            text_len = sum(len(i) for i in texts)
+        cost = estimate_cost(text_len, mode, stream)
+        if self.admission.queue_timeout > 0:
+            return await loop.run_in_executor(None, self.admission.acquire, cost)
+        return self.admission.acquire(cost)
+
+    def add_speaker(self, prompt_text, prompt_audio, zero_shot_spk_id):
+        prompt_text = self.cosyvoice.frontend.text_normalize(prompt_text, split=False)
+        return self.cosyvoice.add_zero_shot_spk(prompt_text, pcm_to_prompt(prompt_audio), zero_shot_spk_id)
+
+    async def register_prompt(self, prompt_text, prompt_audio):
+        # returns the zero_shot_spk_id of the prompt and holds a reference on it, release_prompt drops it once synthesis is done
+        key = hashlib.sha1(prompt_text.encode('utf8') + prompt_audio).hexdigest()
+        self.prompt_refs[key] = self.prompt_refs.get(key, 0) + 1
+        try:
+            if key not in self.prompts:
+                future = asyncio.get_running_loop().create_future()
+                self.prompts[key] = future
+                try:
+                    await asyncio.get_running_loop().run_in_executor(None, self.add_speaker, prompt_text, prompt_audio, 'prompt_{}'.format(key))
+                    future.set_result('prompt_{}'.format(key))
+                except BaseException as e:
+                    del self.prompts[key]
+                    future.set_exception(e if isinstance(e, Exception) else RuntimeError('prompt registration was cancelled'))
+                    raise
+                self.evict_prompts()
+            self.prompts.move_to_end(key)
+            return await asyncio.shield(self.prompts[key])
+        except BaseException:
+            self.release_prompt('prompt_{}'.format(key))
+            raise
+
+    def release_prompt(self, spk_id):
+        key = spk_id[len('prompt_'):]
+        self.prompt_refs[key] -= 1
+        if self.prompt_refs[key] == 0:
+            del self.prompt_refs[key]
+        self.evict_prompts()
+
+    def evict_prompts(self):
+        # least recently used first, a prompt an in flight synthesis still reads from spk2info is skipped
+        unused = [key for key, future in self.prompts.items() if future.done() and key not in self.prompt_refs]
+        for key in unused[:max(len(self.prompts) - self.max_prompts, 0)]:
+            del self.prompts[key]
+            self.cosyvoice.frontend.spk2info.pop('prompt_{}'.format(key), None)
+
+    def run(self, model_output, encoder, broadcast, loop, ticket=None, prompt_spk_id=None):
+        stream = encode_stream(model_output, encoder)
+        error = None
+        try:
+            for data in stream:
+                if broadcast.cancel.is_set():
+                    break
+                asyncio.run_coroutine_threadsafe(broadcast.publish(data), loop).result()
+        except Exception as e:
+            error = e
+        finally:
+            stream.close()
+            if ticket is not None:
+                self.admission.release(ticket)
+            if prompt_spk_id is not None:
+                loop.call_soon_threadsafe(self.release_prompt, prompt_spk_id)
+            asyncio.run_coroutine_threadsafe(broadcast.finish(error), loop).result()
+
+    def start(self, model_output, audio_format, ticket=None, prompt_spk_id=None):
+        # prompt_spk_id is a reference of register_prompt, released by the synthesis once it is done
+        broadcast = Broadcast(self.max_replay_chunks)
+        try:
+            encoder = get_audio_encoder(audio_format, self.cosyvoice.sample_rate)
+        except Exception:
+            if ticket is not None:
+                self.admission.release(ticket)
+            raise
+        loop = asyncio.get_running_loop()
+        loop.run_in_executor(self.executor, self.run, model_output, encoder, broadcast, loop, ticket, prompt_spk_id)
+        return broadcast
+
+    async def Inference(self, request, context):
+        self.prenormalize(request)
+        audio_format = request.audio_format if request.audio_format != '' else 'pcm'
+        first_max_n = request.first_max_n
+        # the prompt reference of register_prompt, handed over to the synthesis once it starts
+        prompt_spk_id = None
         if request.HasField('sft_request'):
             logging.info('get sft inference request')
-            model_output = self.cosyvoice.inference_sft(request.sft_request.tts_text, request.sft_request.spk_id)
+            mode, tts_text = 'sft', request.sft_request.tts_text
+            key = ('sft', request.sft_request.tts_text, request.sft_request.spk_id)
+            make_output = lambda: self.cosyvoice.inference_sft(request.sft_request.tts_text, request.sft_request.spk_id, pipeline_lookahead=self.pipeline_lookahead,
+                                                               first_max_n=first_max_n)
         elif request.HasField('zero_shot_request'):
             logging.info('get zero_shot inference request')
-            prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(request.zero_shot_request.prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
-            prompt_speech_16k = prompt_speech_16k.float() / (2**15)
-            model_output = self.cosyvoice.inference_zero_shot(request.zero_shot_request.tts_text,
-                                                              request.zero_shot_request.prompt_text,
-                                                              prompt_speech_16k)
+            payload = request.zero_shot_request
+            if payload.zero_shot_spk_id == '':
+                prompt_spk_id = await self.register_prompt(payload.prompt_text, payload.prompt_audio)
+            spk_id = payload.zero_shot_spk_id if payload.zero_shot_spk_id != '' else prompt_spk_id
+            mode, tts_text = 'zero_shot', payload.tts_text
+            key = ('zero_shot', payload.tts_text, spk_id)
+            make_output = lambda: self.cosyvoice.inference_zero_shot(payload.tts_text, payload.prompt_text, '', zero_shot_spk_id=spk_id,
+                                                                     pipeline_lookahead=self.pipeline_lookahead, first_max_n=first_max_n)
         elif request.HasField('cross_lingual_request'):
             logging.info('get cross_lingual inference request')
-            prompt_speech_16k = torch.from_numpy(np.array(np.frombuffer(request.cross_lingual_request.prompt_audio, dtype=np.int16))).unsqueeze(dim=0)
-            prompt_speech_16k = prompt_speech_16k.float() / (2**15)
-            model_output = self.cosyvoice.inference_cross_lingual(request.cross_lingual_request.tts_text, prompt_speech_16k)
+            payload = request.cross_lingual_request
+            if payload.zero_shot_spk_id == '':
+                prompt_spk_id = await self.register_prompt('', payload.prompt_audio)
+            spk_id = payload.zero_shot_spk_id if payload.zero_shot_spk_id != '' else prompt_spk_id
+            mode, tts_text = 'cross_lingual', payload.tts_text
+            key = ('cross_lingual', payload.tts_text, spk_id)
+            make_output = lambda: self.cosyvoice.inference_cross_lingual(payload.tts_text, '', zero_shot_spk_id=spk_id, pipeline_lookahead=self.pipeline_lookahead,
+                                                                         first_max_n=first_max_n)
         else:
             logging.info('get instruct inference request')
-            model_output = self.cosyvoice.inference_instruct(request.instruct_request.tts_text,
-                                                             request.instruct_request.spk_id,
-                                                             request.instruct_request.instruct_text)
+            payload = request.instruct_request
+            mode, tts_text = 'instruct', payload.tts_text
+            key = ('instruct', payload.tts_text, payload.spk_id, payload.instruct_text)
+            make_output = lambda: self.cosyvoice.inference_instruct(payload.tts_text, payload.spk_id, payload.instruct_text, pipeline_lookahead=self.pipeline_lookahead,
+                                                                    first_max_n=first_max_n)
+        key = key + (audio_format, first_max_n)
+        ticket = None
+        try:
+            if key not in self.inflight or not self.inflight[key].joinable:
+                # only a new synthesis is admitted, joining an identical request in flight costs nothing
+                try:
+                    ticket = await self.admit(tts_text, mode)
+                except AdmissionRejected as e:
+                    await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e))
+            if key not in self.inflight or not self.inflight[key].joinable:
+                broadcast = self.start(make_output(), audio_format, ticket, prompt_spk_id)
+                prompt_spk_id = None
+                self.inflight[key] = broadcast
+            else:
+                logging.info('share the audio of a byte identical request in flight')
+                broadcast = self.inflight[key]
+                if ticket is not None:
+                    # an identical request started while this one was admitted
+                    self.admission.release(ticket)
+        finally:
+            # the synthesis did not start or an identical one in flight holds its own reference
+            if prompt_spk_id is not None:
+                self.release_prompt(prompt_spk_id)
 
         logging.info('send inference response')
-        for i in model_output:
-            response = cosyvoice_pb2.Response()
-            response.tts_audio = (i['tts_speech'].numpy() * (2 ** 15)).astype(np.int16).tobytes()
-            yield response
+        chunks = broadcast.subscribe()
+        try:
+            async for data in chunks:
+                response = cosyvoice_pb2.Response()
+                response.tts_audio = data
+                yield response
+        except Exception as e:
+            await context.abort(grpc.StatusCode.INTERNAL, str(e))
+        finally:
+            # close explicitly, a cancelled rpc has to unsubscribe now and not when the generator is collected
+            await chunks.aclose()
+            if self.inflight.get(key) is broadcast and (broadcast.done or broadcast.subscribers == 0):
+                del self.inflight[key]
 
+    async def StreamInference(self, request_iterator, context):
+        try:
+            request = await request_iterator.__anext__()
+        except StopAsyncIteration:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, 'StreamInference got no StreamStart')
+        if not request.HasField('start'):
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, 'the first message of StreamInference must be a StreamStart')
+        start = request.start
+        # normalized as register_prompt normalizes it, which then hits the frontend cache. the text chunks of a stream are never
+        # normalized, so text_frontend=False below only skips normalizing the prompt text again
+        prompt_text = await asyncio.get_running_loop().run_in_executor(None, self.cosyvoice.frontend.text_normalize, start.prompt_text, False)
+        prompt_spk_id = None
+        if start.zero_shot_spk_id == '':
+            prompt_spk_id = await self.register_prompt(start.prompt_text, start.prompt_audio)
+        spk_id = start.zero_shot_spk_id if start.zero_shot_spk_id != '' else prompt_spk_id
+        try:
+            # the text is not known yet, the client may announce its length, otherwise a typical reply length is assumed
+            ticket = await self.admit('', 'bistream', stream=True, text_len=start.text_len if start.text_len > 0 else 200)
+        except AdmissionRejected as e:
+            if prompt_spk_id is not None:
+                self.release_prompt(prompt_spk_id)
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e))
+        texts, cancel, errors = queue.Queue(), threading.Event(), []
 
-def main():
-    grpcServer = grpc.server(futures.ThreadPoolExecutor(max_workers=args.max_conc), maximum_concurrent_rpcs=args.max_conc)
+        def text_generator():
+            # consumed by the llm thread, blocks until the client sends the next chunk
+            while True:
+                text = texts.get()
+                if text is None or cancel.is_set():
+                    return
+                yield text
+
+        async def receive():
+            try:
+                async for request in request_iterator:
+                    if request.HasField('start'):
+                        # a second StreamStart would otherwise reach the llm as empty text, stop synthesis and fail the rpc
+                        errors.append('only the first message of StreamInference may be a StreamStart')
+                        broadcast.cancel.set()
+                        return
+                    texts.put(request.tts_text)
+            finally:
+                texts.put(None)
+
+        model_output = self.cosyvoice.inference_zero_shot(text_generator(), prompt_text, '', zero_shot_spk_id=spk_id, stream=True,
+                                                          speed=start.speed if start.speed > 0 else 1.0, text_frontend=False)
+        try:
+            broadcast = self.start(model_output, start.audio_format if start.audio_format != '' else 'pcm', ticket, prompt_spk_id)
+        except Exception:
+            if prompt_spk_id is not None:
+                self.release_prompt(prompt_spk_id)
+            raise
+        receiver = asyncio.create_task(receive())
+        chunks = broadcast.subscribe()
+        try:
+            async for data in chunks:
+                response = cosyvoice_pb2.Response()
+                response.tts_audio = data
+                yield response
+        except Exception as e:
+            await context.abort(grpc.StatusCode.INTERNAL, str(e))
+        finally:
+            await chunks.aclose()
+            # end the text generator, so the llm thread finishes instead of waiting for text forever
+            cancel.set()
+            texts.put(None)
+            receiver.cancel()
+        if len(errors) != 0:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, errors[0])
+
+    async def RegisterSpeaker(self, request, context):
+        success = await asyncio.get_running_loop().run_in_executor(None, self.add_speaker, request.prompt_text, request.prompt_audio,
+                                                                   request.zero_shot_spk_id)
+        return cosyvoice_pb2.RegisterSpeakerResponse(success=success)
+
+
+async def serve():
+    grpcServer = grpc.aio.server()
     cosyvoice_pb2_grpc.add_CosyVoiceServicer_to_server(CosyVoiceServiceImpl(args), grpcServer)
     grpcServer.add_insecure_port('0.0.0.0:{}'.format(args.port))
-    grpcServer.start()
+    await grpcServer.start()
     logging.info("server listening on 0.0.0.0:{}".format(args.port))
-    grpcServer.wait_for_termination()
+    await grpcServer.wait_for_termination()
+
+
+def main():
+    asyncio.run(serve())
 
 
 if __name__ == '__main__':
@@ -81,10 +407,48 @@ if __name__ == '__main__':
                         default=50000)
     parser.add_argument('--max_conc',
                         type=int,
-                        default=4)
+                        default=4,
+                        help='requests synthesizing at the same time, later requests wait for a free slot')
+    parser.add_argument('--pipeline_lookahead',
+                        type=int,
+                        default=0,
+                        help='sentences of a request synthesized ahead of the one being sent, 0 synthesizes them one by one')
+    parser.add_argument('--max_prompts',
+                        type=int,
+                        default=256,
+                        help='prompts kept registered by hash, the least recently used one no request uses is dropped beyond this')
+    parser.add_argument('--max_replay_chunks',
+                        type=int,
+                        default=64,
+                        help='chunks an identical request arriving late can replay, later ones start their own synthesis')
     parser.add_argument('--model_dir',
                         type=str,
                         default='iic/CosyVoice2-0.5B',
                         help='local path or modelscope repo id')
+    parser.add_argument('--load_vllm',
+                        action='store_true',
+                        help='decode with vllm, which batches the llm steps of concurrent requests')
+    parser.add_argument('--load_static_decode',
+                        action='store_true',
+                        help='decode the CosyVoice2/3 llm with a preallocated static kv cache, ignored with --load_vllm')
+    parser.add_argument('--admission_capacity',
+                        type=float,
+                        default=0,
+                        help='initial normalized characters synthesized per second, refined by measurement, 0 disables admission control')
+    parser.add_argument('--admission_slo',
+                        type=float,
+                        default=10.0,
+                        help='requests predicted to finish later than this many seconds are rejected with RESOURCE_EXHAUSTED')
+    parser.add_argument('--admission_queue_sec',
+                        type=float,
+                        default=0.0,
+                        help='how long a request that does not fit may wait for capacity before it is rejected')
+    parser.add_argument('--text_pool_workers',
+                        type=int,
+                        default=0,
+                        help='text normalization processes, 0 means normalize inline')
+    parser.add_argument('--degeneration_check',
+                        action='store_true',
+                        help='stop looping, silent or far too long llm generations early')
     args = parser.parse_args()
     main()
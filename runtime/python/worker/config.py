@@ -57,6 +57,17 @@ class WorkerConfig(BaseSettings):
         4, validation_alias=AliasChoices('VLLM_BATCH_THRESHOLD', 'vllm_batch_threshold')
     )
 
+    # Admission control, 0 capacity disables it
+    admission_capacity: float = Field(
+        0.0, validation_alias=AliasChoices('ADMISSION_CAPACITY', 'admission_capacity')
+    )
+    admission_slo_sec: float = Field(
+        60.0, validation_alias=AliasChoices('ADMISSION_SLO_SEC', 'admission_slo_sec')
+    )
+    admission_queue_sec: float = Field(
+        5.0, validation_alias=AliasChoices('ADMISSION_QUEUE_SEC', 'admission_queue_sec')
+    )
+
     # CosyVoice model
     model_dir: str = Field(
         'pretrained_models/Fun-CosyVoice3-0.5B',
@@ -64,9 +75,48 @@ class WorkerConfig(BaseSettings):
     )
     fp16: bool = Field(False, validation_alias=AliasChoices('FP16', 'fp16'))
     load_trt: bool = Field(False, validation_alias=AliasChoices('LOAD_TRT', 'load_trt'))
+    # Static kv cache llm decode of the single (non vLLM) processor
+    load_static_decode: bool = Field(
+        False, validation_alias=AliasChoices('LOAD_STATIC_DECODE', 'load_static_decode')
+    )
     trt_concurrent: int = Field(
         1, validation_alias=AliasChoices('TRT_CONCURRENT', 'trt_concurrent')
     )
+    onnx_concurrent: int = Field(
+        1, validation_alias=AliasChoices('ONNX_CONCURRENT', 'onnx_concurrent')
+    )
+    onnx_num_threads: int = Field(
+        1, validation_alias=AliasChoices('ONNX_NUM_THREADS', 'onnx_num_threads')
+    )
+    text_pool_workers: int = Field(
+        0, validation_alias=AliasChoices('TEXT_POOL_WORKERS', 'text_pool_workers')
+    )
+    # Stop looping, silent or far too long llm generations early
+    degeneration_check: bool = Field(
+        False, validation_alias=AliasChoices('DEGENERATION_CHECK', 'degeneration_check')
+    )
+
+    # Extra models routed by the payload `model` field, "name=model_dir,name=model_dir"
+    models: Optional[str] = Field(
+        None, validation_alias=AliasChoices('MODELS', 'models')
+    )
+    memory_budget_gb: float = Field(
+        0.0, validation_alias=AliasChoices('MEMORY_BUDGET_GB', 'memory_budget_gb')
+    )
+    stats_interval_sec: float = Field(
+        300.0, validation_alias=AliasChoices('STATS_INTERVAL_SEC', 'stats_interval_sec')
+    )
+
+    # Flow matching decoding, payloads may override per request
+    flow_n_timesteps: int = Field(
+        10, validation_alias=AliasChoices('FLOW_N_TIMESTEPS', 'flow_n_timesteps')
+    )
+    flow_solver: Optional[str] = Field(
+        None, validation_alias=AliasChoices('FLOW_SOLVER', 'flow_solver')
+    )
+    flow_cfg_strategy: Optional[str] = Field(
+        None, validation_alias=AliasChoices('FLOW_CFG_STRATEGY', 'flow_cfg_strategy')
+    )
 
     @staticmethod
     def from_env() -> "WorkerConfig":
@@ -20,11 +20,15 @@ class WorkItem:
         SQS receipt handle to acknowledge (delete) after successful processing.
     message_id: str
         SQS message ID for logging/diagnostics.
+    ticket: Optional[Any]
+        Admission ticket held while the item is queued and processed, released
+        once it is done. None when admission control is off.
     """
 
     payload: Dict[str, Any]
     receipt_handle: str
     message_id: str
+    ticket: Optional[Any] = None
 
 
 class InternalQueue:
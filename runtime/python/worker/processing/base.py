@@ -3,6 +3,8 @@ from __future__ import annotations
 from abc import ABC, abstractmethod
 from typing import Any, Dict, Iterable, List
 
+from cosyvoice.utils.admission import estimate_cost
+
 
 class Processor(ABC):
     """Abstract processing backend.
@@ -12,6 +14,26 @@ class Processor(ABC):
     deliver messages at-least-once.
     """
 
+    def prepare(self, payload: Dict[str, Any]) -> None:
+        """Start cheap, asynchronous preprocessing of a payload that will be processed soon.
+
+        Called for every gathered payload before the first one is processed, so
+        e.g. text normalization of later payloads overlaps with synthesis of the
+        earlier ones. The default implementation does nothing.
+        """
+
+    def estimate_cost(self, payload: Dict[str, Any]) -> float:
+        """Estimate the synthesis cost of a payload for admission control.
+
+        The default implementation uses the raw text length; backends with a
+        text frontend should measure the normalized text instead.
+        """
+        return estimate_cost(len(payload.get('tts_text', '')), payload.get('mode', 'zero_shot'), bool(payload.get('stream', False)))
+
+    def stats(self) -> Dict[str, Any]:
+        """Per-model memory, request count and latency of the backend, logged periodically by the service."""
+        return {}
+
     @abstractmethod
     def process_one(self, payload: Dict[str, Any]) -> None:
         """Process a single payload.
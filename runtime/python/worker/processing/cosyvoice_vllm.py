@@ -1,10 +1,11 @@
 from __future__ import annotations
 
-from typing import Any, Dict, Iterable, List
+import time
+from typing import Any, Dict, Iterable, List, Optional
 
-import torchaudio
-
-from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.cli.registry import MemoryBudget, ModelRegistry, parse_models
+from cosyvoice.utils.admission import estimate_cost
+from cosyvoice.utils.audio_utils import save_audio
 from cosyvoice.utils.file_utils import logging
 from .base import Processor
 
@@ -17,49 +18,121 @@ class CosyVoiceVLLMProcessor(Processor):
     a single payload, but shines when used with batches.
     """
 
-    def __init__(self, model_dir: str, fp16: bool = False, load_trt: bool = False, trt_concurrent: int = 1) -> None:
+    def __init__(self, model_dir: str, fp16: bool = False, load_trt: bool = False, trt_concurrent: int = 1,
+                 n_timesteps: int = 10, solver: Optional[str] = None, cfg_strategy: Optional[str] = None,
+                 onnx_concurrent: int = 1, onnx_num_threads: int = 1, text_pool_workers: int = 0,
+                 models: Optional[str] = None, memory_budget_gb: float = 0,
+                 memory_budget: Optional[MemoryBudget] = None, degeneration_check: bool = False) -> None:
         # load_vllm=True enables vLLM inside the CosyVoice model
-        self.model = AutoModel(model_dir=model_dir, load_vllm=True, load_trt=load_trt, fp16=fp16, trt_concurrent=trt_concurrent)
-        self.sample_rate = getattr(self.model, 'sample_rate', 24000)
+        # a shared memory_budget also counts the models of the other processor, memory_budget_gb only this one's
+        budget = memory_budget if memory_budget is not None else int(memory_budget_gb * 2 ** 30)
+
+        def on_load(model):
+            if text_pool_workers > 0:
+                model.frontend.start_text_pool(num_workers=text_pool_workers)
+            if degeneration_check:
+                model.model.degeneration_kwargs = {}
+
+        self.registry = ModelRegistry(memory_budget=budget, load_vllm=True, load_trt=load_trt, fp16=fp16,
+                                      trt_concurrent=trt_concurrent, onnx_concurrent=onnx_concurrent, onnx_num_threads=onnx_num_threads,
+                                      on_load=on_load)
+        # model_dir serves payloads without a `model` field, `models` adds named ones loaded on first use
+        self.registry.register('default', model_dir)
+        for name, path in parse_models(models or '').items():
+            self.registry.register(name, path)
+        self.model = self.registry.get()
+        self.n_timesteps = n_timesteps
+        self.solver = solver
+        self.cfg_strategy = cfg_strategy
+
+    def _save_output(self, model, model_output, output_path: Optional[str], audio_format: Optional[str] = None) -> None:
+        # Every chunk is appended to one file, the format follows audio_format or the output_path extension
+        if output_path:
+            save_audio(model_output, output_path, getattr(model, 'sample_rate', 24000), audio_format)
+        else:
+            for _ in model_output:
+                pass
 
-    def _save_output(self, wav_tensor, output_path: str) -> None:
-        torchaudio.save(output_path, wav_tensor, self.sample_rate)
+    def _loaded_model(self, payload: Dict[str, Any]):
+        # the model of the payload if it is loaded, preprocessing never loads a model
+        try:
+            return self.registry.get(payload.get('model'), load=False)
+        except KeyError:
+            return None
+
+    def stats(self) -> Dict[str, Any]:
+        return self.registry.stats()
+
+    def prepare(self, payload: Dict[str, Any]) -> None:
+        # normalized texts land in the frontend cache, so the inference call of this payload skips normalization.
+        # without a text pool it would normalize right here on the receive path, inference normalizes then instead
+        model = self._loaded_model(payload)
+        if model is None or model.frontend.text_pool is None:
+            return
+        if 'tts_text' in payload:
+            model.frontend.text_normalize_async(payload['tts_text'], split=True, first_max_n=int(payload.get('first_max_n', 0)))
+        for key in ('prompt_text', 'instruct_text'):
+            if payload.get(key):
+                model.frontend.text_normalize_async(payload[key], split=False)
+
+    def estimate_cost(self, payload: Dict[str, Any]) -> float:
+        # numbers and symbols expand a lot in normalization, the normalized text is cached for processing
+        model = self._loaded_model(payload)
+        if not payload.get('tts_text') or model is None:
+            return super().estimate_cost(payload)
+        texts = model.frontend.text_normalize(payload.get('tts_text', ''), split=True)
+        return estimate_cost(sum(len(i) for i in texts), payload.get('mode', 'zero_shot'), bool(payload.get('stream', False)))
 
     def process_one(self, payload: Dict[str, Any]) -> None:
+        try:
+            model = self.registry.acquire(payload.get('model'))
+        except KeyError as e:
+            logging.warning(f"{e}, skipping message")
+            return
+        start_time = time.time()
+        try:
+            self._process(model, payload)
+        finally:
+            self.registry.release(payload.get('model'), time.time() - start_time)
+
+    def _process(self, model, payload: Dict[str, Any]) -> None:
         # Reuse the same logic as the single processor; vLLM will help internally
         mode = payload.get('mode', 'zero_shot')
         stream = bool(payload.get('stream', False))
         speed = float(payload.get('speed', 1.0))
+        n_timesteps = int(payload.get('n_timesteps', self.n_timesteps))
+        solver = payload.get('solver', self.solver)
+        cfg_strategy = payload.get('cfg_strategy', self.cfg_strategy)
         output_path = payload.get('output_path')
+        # > 0 cuts the first sentence to about this many tokens for a faster first audio
+        first_max_n = int(payload.get('first_max_n', 0))
 
         if mode == 'sft':
             text = payload['tts_text']
             spk_id = payload['spk_id']
-            for out in self.model.inference_sft(text, spk_id, stream=stream, speed=speed):
-                if output_path:
-                    self._save_output(out['tts_speech'], output_path)
+            model_output = model.inference_sft(text, spk_id, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver, cfg_strategy=cfg_strategy,
+                                               first_max_n=first_max_n)
         elif mode == 'zero_shot':
             text = payload['tts_text']
             prompt_text = payload.get('prompt_text', '')
             prompt_wav = payload['prompt_wav']
-            for out in self.model.inference_zero_shot(text, prompt_text, prompt_wav, stream=stream, speed=speed):
-                if output_path:
-                    self._save_output(out['tts_speech'], output_path)
+            model_output = model.inference_zero_shot(text, prompt_text, prompt_wav, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver, cfg_strategy=cfg_strategy,
+                                                     first_max_n=first_max_n)
         elif mode == 'cross_lingual':
             text = payload['tts_text']
             prompt_wav = payload['prompt_wav']
-            for out in self.model.inference_cross_lingual(text, prompt_wav, stream=stream, speed=speed):
-                if output_path:
-                    self._save_output(out['tts_speech'], output_path)
+            model_output = model.inference_cross_lingual(text, prompt_wav, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver, cfg_strategy=cfg_strategy,
+                                                         first_max_n=first_max_n)
         elif mode == 'instruct':
             text = payload['tts_text']
             spk_id = payload.get('spk_id', '')
             instruct_text = payload['instruct_text']
-            for out in self.model.inference_instruct(text, spk_id, instruct_text, stream=stream, speed=speed):
-                if output_path:
-                    self._save_output(out['tts_speech'], output_path)
+            model_output = model.inference_instruct(text, spk_id, instruct_text, stream=stream, speed=speed, n_timesteps=n_timesteps, solver=solver, cfg_strategy=cfg_strategy,
+                                                    first_max_n=first_max_n)
         else:
             logging.warning(f"Unknown mode '{mode}', skipping message")
+            return
+        self._save_output(model, model_output, output_path, payload.get('audio_format'))
 
     def process_batch(self, payloads: Iterable[Dict[str, Any]]) -> None:
         # Note: The CosyVoice high-level API is iterator-based per item. We
@@ -4,6 +4,7 @@ import threading
 import time
 from typing import List
 
+from cosyvoice.utils.admission import AdmissionController, AdmissionRejected
 from cosyvoice.utils.file_utils import logging
 
 from .config import WorkerConfig
@@ -27,9 +28,15 @@ class WorkerService:
         self.iq = InternalQueue(maxsize=config.internal_queue_maxsize)
         self.single = single_processor
         self.vllm = vllm_processor
+        # The consumer admits messages against the outstanding cost of queued and running work; a message that does
+        # not fit stays unacknowledged and SQS redelivers it after the visibility timeout
+        self.admission = AdmissionController(config.admission_capacity, slo=config.admission_slo_sec,
+                                             queue_timeout=config.admission_queue_sec,
+                                             saturation=config.vllm_batch_threshold) if config.admission_capacity > 0 else None
         self._stop = threading.Event()
         self._consumer_t = threading.Thread(target=self._consumer_loop, name='sqs-consumer', daemon=True)
         self._processor_t = threading.Thread(target=self._processor_loop, name='processor', daemon=True)
+        self._stats_ts = time.monotonic()
 
     def start(self) -> None:
         logging.info('Starting worker service...')
@@ -56,6 +63,12 @@ class WorkerService:
                     continue
                 for m in msgs:
                     item = WorkItem(payload=m.body, receipt_handle=m.receipt_handle, message_id=m.message_id)
+                    if self.admission is not None:
+                        try:
+                            item.ticket = self.admission.acquire(self.single.estimate_cost(m.body))
+                        except AdmissionRejected as e:
+                            logging.warning('Shedding message %s: %s', m.message_id, e)
+                            continue
                     try:
                         self.iq.put(item)
                     except Exception:
@@ -65,6 +78,7 @@ class WorkerService:
                             self.iq.put(item, timeout=1.0)
                         except Exception:
                             logging.warning('Internal queue full, dropping message %s', m.message_id)
+                            self._release([item])
             except Exception as e:
                 logging.error('SQS consumer loop error: %s', e)
                 time.sleep(1.0)
@@ -76,8 +90,16 @@ class WorkerService:
                 batch = self.iq.gather(self.cfg.gather_batch_max, self.cfg.gather_batch_window_sec)
                 if not batch:
                     continue
+            except Exception as e:
+                logging.error('Processor loop error: %s', e)
+                time.sleep(0.1)
+                continue
+            try:
                 receipt_handles = [w.receipt_handle for w in batch]
                 payloads = [w.payload for w in batch]
+                processor = self.vllm if len(batch) >= self.cfg.vllm_batch_threshold else self.single
+                for p in payloads:
+                    processor.prepare(p)
                 if len(batch) >= self.cfg.vllm_batch_threshold:
                     logging.info('Processing batch of %d with vLLM', len(batch))
                     self.vllm.process_batch(payloads)
@@ -98,3 +120,24 @@ class WorkerService:
                 # On failure, do not ack; message will reappear after visibility timeout
                 logging.error('Processor loop error: %s', e)
                 time.sleep(0.1)
+            finally:
+                self._release(batch)
+            self._log_stats()
+
+    def _log_stats(self) -> None:
+        if time.monotonic() - self._stats_ts < self.cfg.stats_interval_sec:
+            return
+        self._stats_ts = time.monotonic()
+        for backend, processor in (('single', self.single), ('vllm', self.vllm)):
+            for name, s in processor.stats().items():
+                if not s['loaded'] and s['requests'] == 0:
+                    continue
+                logging.info('Model %s/%s: loaded=%s memory=%.0fMB shared=%.0fMB requests=%d in_flight=%d latency_p50=%s latency_p90=%s degenerate=%s prefix_cache=%s',
+                             backend, name, s['loaded'], s['memory_mb'], s['shared_mb'], s['requests'], s['in_flight'],
+                             s['latency_p50'], s['latency_p90'], s['degenerate'], s['prefix_cache'])
+
+    def _release(self, items: List[WorkItem]) -> None:
+        for item in items:
+            if item.ticket is not None:
+                self.admission.release(item.ticket)
+                item.ticket = None
@@ -24,10 +24,12 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import hashlib
 import json
 import os
 import threading
 import time
+from collections import OrderedDict
 from uuid import uuid4
 
 import numpy as np
@@ -85,6 +87,10 @@ class TritonPythonModel:
             raise ValueError(f"spk2info.pt not found in {model_params['model_dir']}")
         spk_info = torch.load(spk_info_path, map_location="cpu", weights_only=False)
         self.default_spk_info = spk_info["001"]
+        # prompt tokens, feat and speaker embedding keyed by a hash of the reference wav, clients usually reuse a few
+        # reference speakers, a hit skips the audio tokenizer, speaker embedding and mel extraction
+        self.speaker_cache = OrderedDict()
+        self.speaker_cache_size = int(model_params.get("speaker_cache_size", 128))
 
     def forward_llm(self, input_ids):
         """
@@ -304,6 +310,33 @@ class TritonPythonModel:
         speech_feat = speech_feat.unsqueeze(dim=0)
         return speech_feat
 
+    def get_prompt(self, wav, wav_len):
+        """Prompt speech tokens, speech feat and speaker embedding of a reference wav, from the speaker cache when
+        the same samples were seen before.
+        """
+        wav_tensor = torch.from_numpy(wav.as_numpy())[:, :wav_len.as_numpy()[0][0]]
+        key = hashlib.sha1(wav_tensor.contiguous().numpy().tobytes()).hexdigest()
+        if key in self.speaker_cache:
+            self.speaker_cache.move_to_end(key)
+            return self.speaker_cache[key]
+
+        prompt_speech_tokens = self.forward_audio_tokenizer(wav, wav_len)
+        prompt_speech_tokens = prompt_speech_tokens.unsqueeze(0)
+
+        prompt_speech_resample = torchaudio.transforms.Resample(orig_freq=16000, new_freq=24000)(wav_tensor)
+        speech_feat = self._extract_speech_feat(prompt_speech_resample)
+        token_len = min(int(speech_feat.shape[1] / 2), prompt_speech_tokens.shape[-1])
+        prompt_speech_feat = speech_feat[:, :2 * token_len].contiguous().half()
+        prompt_speech_tokens = prompt_speech_tokens[:, :token_len].contiguous()
+
+        prompt_spk_embedding = self.forward_speaker_embedding(wav_tensor)
+        prompt = (prompt_speech_tokens, prompt_speech_feat, prompt_spk_embedding)
+        if self.speaker_cache_size > 0:
+            self.speaker_cache[key] = prompt
+            while len(self.speaker_cache) > self.speaker_cache_size:
+                self.speaker_cache.popitem(last=False)
+        return prompt
+
     def _llm_gen_thread(self, generated_ids_iter, semantic_token_ids_arr, llm_is_done_flag):
         for generated_ids in generated_ids_iter:
             generated_ids = generated_ids.tolist()
@@ -331,20 +364,10 @@ class TritonPythonModel:
             # Process reference audio through audio tokenizer
             if wav is not None:
                 wav_len = pb_utils.get_input_tensor_by_name(request, "reference_wav_len")
-                prompt_speech_tokens = self.forward_audio_tokenizer(wav, wav_len)
-                prompt_speech_tokens = prompt_speech_tokens.unsqueeze(0)
-
-                wav_tensor = wav.as_numpy()
-                wav_tensor = torch.from_numpy(wav_tensor)[:, :wav_len.as_numpy()[0][0]]
-                prompt_speech_resample = torchaudio.transforms.Resample(orig_freq=16000, new_freq=24000)(wav_tensor)
-                speech_feat = self._extract_speech_feat(prompt_speech_resample)
-                token_len = min(int(speech_feat.shape[1] / 2), prompt_speech_tokens.shape[-1])
-                prompt_speech_feat = speech_feat[:, :2 * token_len].contiguous().half()
-                prompt_speech_tokens = prompt_speech_tokens[:, :token_len].contiguous()
+                prompt_speech_tokens, prompt_speech_feat, prompt_spk_embedding = self.get_prompt(wav, wav_len)
 
                 reference_text = pb_utils.get_input_tensor_by_name(request, "reference_text").as_numpy()
                 reference_text = reference_text[0][0].decode('utf-8')
-                prompt_spk_embedding = self.forward_speaker_embedding(wav_tensor)
             else:
                 # using pre-cached reference text
                 reference_text = self.default_spk_info["prompt_text"]
@@ -29,8 +29,10 @@ import torchaudio
 import os
 import logging
 import argparse
+import hashlib
 import queue
 import time
+from collections import OrderedDict
 
 
 def convert_onnx_to_trt(trt_model, trt_kwargs, onnx_model, fp16):
@@ -90,11 +92,41 @@ class TrtContextWrapper:
         self.trt_context_pool.put([context, stream])
 
 
+class SpeakerCache:
+    """LRU of prompt features keyed by a hash of the prompt audio, a reused reference audio skips tokenization, campplus and mel extraction."""
+
+    def __init__(self, max_size: int = 128):
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def key(audio: torch.Tensor, sample_rate: int) -> str:
+        return hashlib.sha1(audio.detach().cpu().numpy().tobytes() + str(sample_rate).encode()).hexdigest()
+
+    def get(self, key: str):
+        if key not in self.cache:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.cache.move_to_end(key)
+        return self.cache[key]
+
+    def put(self, key: str, value: dict):
+        if self.max_size <= 0:
+            return
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+
 class CosyVoice2_Token2Wav(torch.nn.Module):
-    def __init__(self, model_dir: str = "./CosyVoice2-0.5B", enable_trt: bool = False, device_id: int = 0):
+    def __init__(self, model_dir: str = "./CosyVoice2-0.5B", enable_trt: bool = False, device_id: int = 0, speaker_cache_size: int = 128):
         super().__init__()
         self.device_id = device_id
         self.device = f"cuda:{device_id}"
+        self.speaker_cache = SpeakerCache(speaker_cache_size)
 
         self.flow = CausalMaskedDiffWithXvec()
         self.flow.half()
@@ -233,6 +265,31 @@ class CosyVoice2_Token2Wav(torch.nn.Module):
         prompt_mels_lens_for_flow = torch.tensor(prompt_mels_lens_for_flow)
         return prompt_mels_for_flow, prompt_mels_lens_for_flow
 
+    def get_prompt_features(self, prompt_audios_list: list[torch.Tensor], prompt_audios_sample_rate: list[int]):
+        """Prompt tokens, mels and speaker embeddings of a batch, only prompts missing from the speaker cache are computed."""
+        keys = [SpeakerCache.key(audio, sample_rate) for audio, sample_rate in zip(prompt_audios_list, prompt_audios_sample_rate)]
+        features = [self.speaker_cache.get(key) for key in keys]
+        # a prompt repeated inside the batch is computed once
+        missing = list(OrderedDict((key, i) for i, (key, feature) in enumerate(zip(keys, features)) if feature is None).values())
+        if len(missing) != 0:
+            audios = [prompt_audios_list[i] for i in missing]
+            sample_rates = [prompt_audios_sample_rate[i] for i in missing]
+            prompt_speech_tokens_list = self.prompt_audio_tokenization(audios)
+            prompt_mels_for_flow, prompt_mels_lens_for_flow = self.get_prompt_mels(audios, sample_rates)
+            spk_emb_for_flow = self.get_spk_emb(audios)
+            computed = {}
+            for j, i in enumerate(missing):
+                computed[keys[i]] = {'speech_tokens': prompt_speech_tokens_list[j],
+                                     'mel': prompt_mels_for_flow[j, :prompt_mels_lens_for_flow[j].item()],
+                                     'spk_emb': spk_emb_for_flow[j]}
+                self.speaker_cache.put(keys[i], computed[keys[i]])
+            features = [feature if feature is not None else computed[key] for key, feature in zip(keys, features)]
+        prompt_speech_tokens_list = [feature['speech_tokens'] for feature in features]
+        prompt_mels_for_flow = torch.nn.utils.rnn.pad_sequence([feature['mel'] for feature in features], batch_first=True, padding_value=0)
+        prompt_mels_lens_for_flow = torch.tensor([feature['mel'].shape[0] for feature in features])
+        spk_emb_for_flow = torch.stack([feature['spk_emb'] for feature in features])
+        return prompt_speech_tokens_list, prompt_mels_for_flow, prompt_mels_lens_for_flow, spk_emb_for_flow
+
     def forward_flow(self, prompt_speech_tokens_list: list[list[int]], generated_speech_tokens_list: list[list[int]], prompt_mels_for_flow: torch.Tensor,
                      prompt_mels_lens_for_flow: torch.Tensor, spk_emb_for_flow: torch.Tensor):
         batch_size = prompt_mels_for_flow.shape[0]
@@ -270,11 +327,8 @@ class CosyVoice2_Token2Wav(torch.nn.Module):
         # assert all item in prompt_audios_sample_rate is 16000
         assert all(sample_rate == 16000 for sample_rate in prompt_audios_sample_rate)
 
-        prompt_speech_tokens_list = self.prompt_audio_tokenization(prompt_audios_list)
-
-        prompt_mels_for_flow, prompt_mels_lens_for_flow = self.get_prompt_mels(prompt_audios_list, prompt_audios_sample_rate)
-
-        spk_emb_for_flow = self.get_spk_emb(prompt_audios_list)
+        prompt_speech_tokens_list, prompt_mels_for_flow, prompt_mels_lens_for_flow, spk_emb_for_flow = self.get_prompt_features(
+            prompt_audios_list, prompt_audios_sample_rate)
 
         generated_mels, generated_mels_lens = self.forward_flow(
             prompt_speech_tokens_list, generated_speech_tokens_list, prompt_mels_for_flow, prompt_mels_lens_for_flow, spk_emb_for_flow)
@@ -303,13 +357,14 @@ def get_args():
     parser.add_argument("--batch-size", type=int, default=4)
     parser.add_argument("--output-dir", type=str, default="generated_wavs")
     parser.add_argument("--huggingface-dataset-split", type=str, default="wenetspeech4tts")
+    parser.add_argument("--speaker-cache-size", type=int, default=128, help="Prompt features of this many reference audios are kept, 0 disables the cache")
     parser.add_argument("--warmup", type=int, default=3, help="Number of warmup epochs, performance statistics will only be collected from the last epoch")
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = get_args()
-    model = CosyVoice2_Token2Wav(model_dir=args.model_dir, enable_trt=args.enable_trt)
+    model = CosyVoice2_Token2Wav(model_dir=args.model_dir, enable_trt=args.enable_trt, speaker_cache_size=args.speaker_cache_size)
     # mkdir output_dir if not exists
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
@@ -332,4 +387,4 @@ if __name__ == "__main__":
 
         end_time = time.time()
         epoch_time = end_time - start_time
-        print(f"Measurement epoch time taken: {epoch_time:.4f} seconds")
+        print(f"Measurement epoch time taken: {epoch_time:.4f} seconds, speaker cache hits {model.speaker_cache.hits} misses {model.speaker_cache.misses}")
@@ -19,6 +19,7 @@ from runtime.python.worker.config import WorkerConfig
 from runtime.python.worker.processing.cosyvoice_single import CosyVoiceSingleProcessor
 from runtime.python.worker.processing.cosyvoice_vllm import CosyVoiceVLLMProcessor
 from runtime.python.worker.service import WorkerService
+from cosyvoice.cli.registry import MemoryBudget
 from cosyvoice.utils.file_utils import logging
 
 
@@ -41,8 +42,28 @@ def _build_config_from_args(args: argparse.Namespace) -> WorkerConfig:
         overrides['fp16'] = args.fp16
     if args.load_trt is not None:
         overrides['load_trt'] = args.load_trt
+    if args.load_static_decode is not None:
+        overrides['load_static_decode'] = args.load_static_decode
     if args.trt_concurrent is not None:
         overrides['trt_concurrent'] = args.trt_concurrent
+    if args.onnx_concurrent is not None:
+        overrides['onnx_concurrent'] = args.onnx_concurrent
+    if args.onnx_num_threads is not None:
+        overrides['onnx_num_threads'] = args.onnx_num_threads
+    if args.text_pool_workers is not None:
+        overrides['text_pool_workers'] = args.text_pool_workers
+    if args.degeneration_check is not None:
+        overrides['degeneration_check'] = args.degeneration_check
+    if args.models is not None:
+        overrides['models'] = args.models
+    if args.memory_budget_gb is not None:
+        overrides['memory_budget_gb'] = args.memory_budget_gb
+    if args.flow_n_timesteps is not None:
+        overrides['flow_n_timesteps'] = args.flow_n_timesteps
+    if args.flow_solver is not None:
+        overrides['flow_solver'] = args.flow_solver
+    if args.flow_cfg_strategy is not None:
+        overrides['flow_cfg_strategy'] = args.flow_cfg_strategy
     if args.receive_max_messages is not None:
         overrides['receive_max_messages'] = args.receive_max_messages
     if args.wait_time_seconds is not None:
@@ -57,6 +78,12 @@ def _build_config_from_args(args: argparse.Namespace) -> WorkerConfig:
         overrides['gather_batch_window_sec'] = args.gather_batch_window_sec
     if args.vllm_batch_threshold is not None:
         overrides['vllm_batch_threshold'] = args.vllm_batch_threshold
+    if args.admission_capacity is not None:
+        overrides['admission_capacity'] = args.admission_capacity
+    if args.admission_slo_sec is not None:
+        overrides['admission_slo_sec'] = args.admission_slo_sec
+    if args.admission_queue_sec is not None:
+        overrides['admission_queue_sec'] = args.admission_queue_sec
 
     try:
         cfg = WorkerConfig(**overrides)
@@ -74,7 +101,24 @@ def parse_args(argv=None) -> argparse.Namespace:
     p.add_argument('--model-dir', type=str, default=None, help='Model directory (or set MODEL_DIR)')
     p.add_argument('--fp16', action=argparse.BooleanOptionalAction, default=None, help='Enable fp16')
     p.add_argument('--load-trt', action=argparse.BooleanOptionalAction, default=None, help='Enable TensorRT')
+    p.add_argument('--load-static-decode', action=argparse.BooleanOptionalAction, default=None,
+                   help='Static kv cache LLM decode in the single processor (or set LOAD_STATIC_DECODE)')
     p.add_argument('--trt-concurrent', type=int, default=None, help='TensorRT concurrent streams')
+    p.add_argument('--onnx-concurrent', type=int, default=None, help='Frontend ONNX sessions per model (or set ONNX_CONCURRENT)')
+    p.add_argument('--onnx-num-threads', type=int, default=None, help='Intra-op threads per frontend ONNX session (or set ONNX_NUM_THREADS)')
+    p.add_argument('--text-pool-workers', type=int, default=None,
+                   help='Text normalization processes, 0 normalizes inline (or set TEXT_POOL_WORKERS)')
+    p.add_argument('--degeneration-check', action=argparse.BooleanOptionalAction, default=None,
+                   help='Stop looping, silent or far too long LLM generations early (or set DEGENERATION_CHECK)')
+    p.add_argument('--models', type=str, default=None,
+                   help='Extra models routed by the payload model field, name=model_dir,name=model_dir (or set MODELS)')
+    p.add_argument('--memory-budget-gb', type=float, default=None,
+                   help='Unload least recently used idle models beyond this many GB of weights, 0 means no limit (or set MEMORY_BUDGET_GB)')
+    p.add_argument('--flow-n-timesteps', type=int, default=None, help='Flow matching ODE steps (or set FLOW_N_TIMESTEPS)')
+    p.add_argument('--flow-solver', type=str, default=None, choices=['euler', 'midpoint', 'heun', 'multistep'],
+                   help='Flow matching ODE solver (or set FLOW_SOLVER)')
+    p.add_argument('--flow-cfg-strategy', type=str, default=None,
+                   help='Flow matching CFG schedule: full, none, early[:k] or reuse[:k] (or set FLOW_CFG_STRATEGY)')
     p.add_argument('--receive-max-messages', type=int, default=None)
     p.add_argument('--wait-time-seconds', type=int, default=None)
     p.add_argument('--visibility-timeout', type=int, default=None)
@@ -82,6 +126,12 @@ def parse_args(argv=None) -> argparse.Namespace:
     p.add_argument('--gather-batch-max', type=int, default=None)
     p.add_argument('--gather-batch-window-sec', type=float, default=None)
     p.add_argument('--vllm-batch-threshold', type=int, default=None)
+    p.add_argument('--admission-capacity', type=float, default=None,
+                   help='Initial normalized characters synthesized per second, 0 disables admission control (or set ADMISSION_CAPACITY)')
+    p.add_argument('--admission-slo-sec', type=float, default=None,
+                   help='Messages predicted to finish later than this are left for redelivery (or set ADMISSION_SLO_SEC)')
+    p.add_argument('--admission-queue-sec', type=float, default=None,
+                   help='How long the consumer waits for capacity before shedding a message (or set ADMISSION_QUEUE_SEC)')
     return p.parse_args(argv)
 
 
@@ -106,8 +156,19 @@ def main(argv=None) -> int:
     cfg = _build_config_from_args(args)
     logging.info('Starting worker with config: %s', cfg)
 
-    single = CosyVoiceSingleProcessor(cfg.model_dir, fp16=cfg.fp16, load_trt=cfg.load_trt, trt_concurrent=cfg.trt_concurrent)
-    vllm = CosyVoiceVLLMProcessor(cfg.model_dir, fp16=cfg.fp16, load_trt=cfg.load_trt, trt_concurrent=cfg.trt_concurrent)
+    # NOTE both processors load models into the same process and gpu, their models share one budget
+    budget = MemoryBudget(int(cfg.memory_budget_gb * 2 ** 30))
+    single = CosyVoiceSingleProcessor(cfg.model_dir, fp16=cfg.fp16, load_trt=cfg.load_trt, trt_concurrent=cfg.trt_concurrent,
+                                      load_static_decode=cfg.load_static_decode,
+                                      n_timesteps=cfg.flow_n_timesteps, solver=cfg.flow_solver,
+                                      cfg_strategy=cfg.flow_cfg_strategy, onnx_concurrent=cfg.onnx_concurrent,
+                                      onnx_num_threads=cfg.onnx_num_threads, text_pool_workers=cfg.text_pool_workers,
+                                      models=cfg.models, memory_budget=budget, degeneration_check=cfg.degeneration_check)
+    vllm = CosyVoiceVLLMProcessor(cfg.model_dir, fp16=cfg.fp16, load_trt=cfg.load_trt, trt_concurrent=cfg.trt_concurrent,
+                                  n_timesteps=cfg.flow_n_timesteps, solver=cfg.flow_solver,
+                                  cfg_strategy=cfg.flow_cfg_strategy, onnx_concurrent=cfg.onnx_concurrent,
+                                  onnx_num_threads=cfg.onnx_num_threads, text_pool_workers=cfg.text_pool_workers,
+                                  models=cfg.models, memory_budget=budget, degeneration_check=cfg.degeneration_check)
     service = WorkerService(cfg, single_processor=single, vllm_processor=vllm)
 
     with _graceful_shutdown(service):
@@ -0,0 +1,6 @@
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, '{}/third_party/Matcha-TTS'.format(ROOT_DIR))
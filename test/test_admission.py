@@ -0,0 +1,104 @@
+import threading
+from types import SimpleNamespace
+import pytest
+
+from cosyvoice.utils import admission
+from cosyvoice.utils.admission import AdmissionController, AdmissionRejected, estimate_cost
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=0.0)
+    monkeypatch.setattr(admission, 'time', SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def test_estimate_cost():
+    assert estimate_cost(100, 'sft') == pytest.approx(100)
+    assert estimate_cost(100, 'zero_shot', stream=True) == pytest.approx(100 * 1.3 * 1.25)
+    assert estimate_cost(100, 'unknown') == pytest.approx(130)
+    # an empty text still costs one character
+    assert estimate_cost(0, 'sft') == pytest.approx(1)
+
+
+def test_idle_server_admits_any_cost():
+    controller = AdmissionController(10, slo=1)
+    ticket = controller.acquire(1000)
+    assert controller.outstanding_num == 1
+    controller.release(ticket)
+    assert (controller.outstanding_cost, controller.outstanding_num) == (0, 0)
+
+
+def test_request_over_slo_is_rejected():
+    controller = AdmissionController(10, slo=10)
+    controller.acquire(50)
+    controller.acquire(40)
+    with pytest.raises(AdmissionRejected) as e:
+        controller.acquire(20)
+    assert e.value.predicted_latency == pytest.approx(11)
+    assert e.value.retry_after == pytest.approx(1)
+    # a rejected request takes nothing
+    assert (controller.outstanding_cost, controller.outstanding_num) == (90, 2)
+
+
+def test_release_frees_capacity():
+    controller = AdmissionController(10, slo=10)
+    first = controller.acquire(60)
+    controller.acquire(30)
+    with pytest.raises(AdmissionRejected):
+        controller.acquire(20)
+    controller.release(first)
+    controller.acquire(20)
+    assert controller.outstanding_cost == pytest.approx(50)
+
+
+def test_queue_timeout_waits_for_a_release():
+    controller = AdmissionController(10, slo=10, queue_timeout=5)
+    first = controller.acquire(80)
+    threading.Timer(0.1, controller.release, args=(first,)).start()
+    ticket = controller.acquire(50)
+    assert controller.outstanding_num == 1
+    controller.release(ticket)
+
+
+def test_queue_timeout_expires():
+    controller = AdmissionController(10, slo=10)
+    controller.acquire(80)
+    with pytest.raises(AdmissionRejected):
+        controller.acquire(50, timeout=0.05)
+
+
+def serve(controller, clock, cost, seconds):
+    # one request at a time
+    ticket = controller.acquire(cost)
+    clock.now += seconds
+    controller.release(ticket)
+
+
+def test_capacity_rises_with_measured_throughput(clock):
+    controller = AdmissionController(10, saturation=2, window=10)
+    serve(controller, clock, 250, 10)
+    # 25/s served, more than the configured 10/s even at low concurrency
+    assert controller.capacity == pytest.approx(0.7 * 10 + 0.3 * 25)
+
+
+def test_capacity_is_kept_below_saturation(clock):
+    controller = AdmissionController(10, saturation=2, window=10)
+    serve(controller, clock, 50, 10)
+    assert controller.capacity == pytest.approx(10)
+
+
+def test_capacity_falls_when_saturated(clock):
+    controller = AdmissionController(10, saturation=1, window=10)
+    serve(controller, clock, 25, 10)
+    assert controller.capacity == pytest.approx(0.7 * 10 + 0.3 * 2.5)
+
+
+def test_capacity_is_measured_over_busy_time_only(clock):
+    controller = AdmissionController(10, saturation=1, window=10)
+    serve(controller, clock, 250, 5)
+    # idle time between requests is not counted, the window is not full yet
+    clock.now += 100
+    assert controller.capacity == pytest.approx(10)
+    serve(controller, clock, 250, 5)
+    assert controller.capacity == pytest.approx(0.7 * 10 + 0.3 * 50)
@@ -0,0 +1,105 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('torchaudio')
+from cosyvoice.utils.file_utils import AudioReader, PromptAudio
+
+
+def test_reader_of_prompt_audio():
+    torch.manual_seed(0)
+    wav = torch.randn(2, 16000)
+    reader = AudioReader(PromptAudio(wav, sample_rate=16000))
+    assert len(reader) == 16000
+    assert torch.allclose(reader.read(100, 200), wav.mean(dim=0, keepdim=True)[:, 100: 200])
+
+
+def test_read_is_clipped_to_the_wav():
+    reader = AudioReader(PromptAudio(torch.randn(1, 16000), sample_rate=16000))
+    assert reader.read(-100, 100).shape == (1, 100)
+    assert reader.read(15900, 17000).shape == (1, 100)
+    assert reader.read(17000, 18000).shape == (1, 0)
+
+
+def test_reader_of_prompt_audio_resamples():
+    reader = AudioReader(PromptAudio(torch.randn(1, 24000), sample_rate=24000))
+    assert len(reader) == 16000
+    assert reader.read(0, 16000).shape == (1, 16000)
+
+
+def test_reader_of_a_file_decodes_only_the_window(tmp_path):
+    soundfile = pytest.importorskip('soundfile')
+    torch.manual_seed(0)
+    wav = torch.rand(16000 * 3, 2) - 0.5
+    path = str(tmp_path / 'source.wav')
+    soundfile.write(path, wav.numpy(), 16000, subtype='FLOAT')
+    reader = AudioReader(path)
+    assert len(reader) == 16000 * 3
+    assert torch.allclose(reader.read(20000, 20640), wav.mean(dim=1)[20000: 20640].unsqueeze(0))
+    assert reader.read(47900, 50000).shape == (1, 100)
+
+
+def test_reader_of_a_file_resamples(tmp_path):
+    soundfile = pytest.importorskip('soundfile')
+    path = str(tmp_path / 'source.wav')
+    soundfile.write(path, (torch.rand(24000 * 2) - 0.5).numpy(), 24000)
+    reader = AudioReader(path)
+    assert len(reader) == 16000 * 2
+    assert reader.read(1000, 9000).shape == (1, 8000)
+
+
+def test_reader_rejects_a_low_sample_rate(tmp_path):
+    soundfile = pytest.importorskip('soundfile')
+    path = str(tmp_path / 'source.wav')
+    soundfile.write(path, torch.zeros(8000).numpy(), 8000)
+    with pytest.raises(AssertionError):
+        AudioReader(path)
+
+
+def test_chunk_border_is_the_quietest_frame_near_nominal():
+    frontend = pytest.importorskip('cosyvoice.cli.frontend')
+    torch.manual_seed(0)
+    wav = torch.randn(1, 16000 * 4)
+    # two pauses, only the one within snap of nominal counts
+    wav[:, 30720: 31360] = 0
+    wav[:, 12800: 13440] = 0
+    reader = AudioReader(PromptAudio(wav, sample_rate=16000))
+    assert frontend.CosyVoiceFrontEnd._chunk_border(reader, 32000, 6400) == 30720
+    assert frontend.CosyVoiceFrontEnd._chunk_border(reader, 12160, 1920) == 12800
+    # borders stay multiples of 640 samples
+    assert frontend.CosyVoiceFrontEnd._chunk_border(reader, 48000, 6400) % 640 == 0
+
+
+def test_chunk_border_without_a_whole_frame_is_nominal():
+    frontend = pytest.importorskip('cosyvoice.cli.frontend')
+    reader = AudioReader(PromptAudio(torch.randn(1, 16000), sample_rate=16000))
+    assert frontend.CosyVoiceFrontEnd._chunk_border(reader, 16000, 300) == 16000
+    assert frontend.CosyVoiceFrontEnd._chunk_border(reader, 100, 50) == 100
+
+
+def join(crossfader, sentences):
+    # sentences are lists of stream chunks
+    outputs = []
+    for chunks in sentences:
+        outputs += [crossfader.update(chunk) for chunk in chunks] + [crossfader.end_sentence()]
+    outputs.append({'tts_speech': crossfader.tail} if crossfader.tail is not None else None)
+    return torch.concat([i['tts_speech'] for i in outputs if i is not None], dim=1)
+
+
+def test_crossfader_fades_the_overlap_of_consecutive_sentences():
+    common = pytest.importorskip('cosyvoice.utils.common')
+    torch.manual_seed(0)
+    a, b = torch.randn(1, 1000), torch.randn(1, 800)
+    speech = join(common.Crossfader(100), [[a], [b]])
+    assert speech.shape == (1, 1700)
+    assert torch.equal(speech[:, :900], a[:, :900]) and torch.equal(speech[:, 1000:], b[:, 100:])
+    assert torch.allclose(speech[:, 900: 1000], common.fade_in_out(b[:, :100], a[:, 900:], common.Crossfader(100).window))
+
+
+def test_crossfader_of_stream_chunks_matches_whole_sentences():
+    common = pytest.importorskip('cosyvoice.utils.common')
+    torch.manual_seed(0)
+    a, b, c = torch.randn(1, 1000), torch.randn(1, 800), torch.randn(1, 600)
+    whole = join(common.Crossfader(100), [[a], [b], [c]])
+    # chunks shorter than the overlap are held back until there is enough to fade
+    streamed = join(common.Crossfader(100), [a.split(30, dim=1), b.split(70, dim=1), c.split(250, dim=1)])
+    assert torch.allclose(whole, streamed)
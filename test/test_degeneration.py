@@ -0,0 +1,71 @@
+import random
+from collections import Counter
+import pytest
+
+from cosyvoice.utils.stream_utils import DegenerationDetector
+
+
+def feed(detector, tokens):
+    # index and reason of the first token the detector flags, or None
+    for i, token in enumerate(tokens):
+        reason = detector.update(token)
+        if reason is not None:
+            return i, reason
+    return None
+
+
+def test_varied_tokens_are_never_flagged():
+    rng = random.Random(0)
+    detector = DegenerationDetector(silent_tokens=(0,))
+    assert feed(detector, [rng.randrange(1, 6561) for _ in range(2000)]) is None
+
+
+def test_loop_is_flagged_once_the_window_is_full():
+    detector = DegenerationDetector(token_rate=25, ngram=4, window_sec=8)
+    assert feed(detector, [1, 2, 3] * 100) == (199, 'repetition')
+
+
+def test_repeated_phrase_with_enough_variety_is_not_a_loop():
+    rng = random.Random(1)
+    phrase = [rng.randrange(1, 6561) for _ in range(100)]
+    # a 100 token phrase said twice keeps about half of the ngrams of the window distinct
+    assert feed(DegenerationDetector(token_rate=25, ngram=4, window_sec=8, min_unique_ratio=0.3), phrase * 4) is None
+
+
+def test_silence_run():
+    detector = DegenerationDetector(silent_tokens=(0, 1), token_rate=1, max_silent_sec=5)
+    assert feed(detector, [7, 0, 1, 0, 1, 0, 1]) == (6, 'silence')
+
+
+def test_silence_run_is_reset_by_speech():
+    detector = DegenerationDetector(silent_tokens=(0,), token_rate=1, max_silent_sec=5)
+    assert feed(detector, ([0] * 5 + [9]) * 10) is None
+
+
+def test_token_rate():
+    rng = random.Random(2)
+    detector = DegenerationDetector(text_len=2, token_rate=1, max_sec_per_text_token=15, slack_sec=10)
+    assert feed(detector, [rng.randrange(1, 6561) for _ in range(100)]) == (40, 'token_rate')
+
+
+def test_token_rate_is_skipped_without_text_len():
+    rng = random.Random(3)
+    detector = DegenerationDetector(text_len=None)
+    assert feed(detector, [rng.randrange(1, 6561) for _ in range(1000)]) is None
+
+
+def test_incremental_ngram_counts_match_a_recount():
+    rng = random.Random(4)
+    detector = DegenerationDetector(token_rate=1, ngram=3, window_sec=20, min_unique_ratio=0)
+    for _ in range(200):
+        # a small alphabet, so ngrams repeat and leave the window while still counted elsewhere in it
+        detector.update(rng.randrange(4))
+        tokens = list(detector.tokens)
+        assert detector.ngrams == Counter(tuple(tokens[i: i + 3]) for i in range(len(tokens) - 2))
+
+
+def test_limits_scale_with_the_token_rate():
+    # a 50 Hz tokenizer gets the same seconds of speech as a 25 Hz one
+    v1, v2 = DegenerationDetector(text_len=10, token_rate=50), DegenerationDetector(text_len=10, token_rate=25)
+    assert (v1.max_len, v1.window, v1.max_silent_run) == (2 * v2.max_len, 2 * v2.window, 2 * v2.max_silent_run)
+    assert (v2.max_len, v2.window, v2.max_silent_run) == (250, 200, 125)
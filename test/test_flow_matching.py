@@ -0,0 +1,113 @@
+import math
+import pytest
+
+torch = pytest.importorskip('torch')
+flow_matching = pytest.importorskip('cosyvoice.flow.flow_matching')
+
+
+class Estimator(torch.nn.Module):
+    """dx/dt = -x, records the batch size of every call."""
+
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    def forward(self, x, mask, mu, t, spks, cond, streaming=False):
+        self.batches.append(x.size(0))
+        return -x
+
+
+def make_cfm(estimator, solver='euler', inference_cfg_rate=0.7):
+    cfm = flow_matching.ConditionalCFM.__new__(flow_matching.ConditionalCFM)
+    torch.nn.Module.__init__(cfm)
+    cfm.solver = solver
+    cfm.inference_cfg_rate = inference_cfg_rate
+    cfm.estimator = estimator
+    return cfm
+
+
+def solve(cfm, n_timesteps, solver=None, cfg_strategy='none', length=4):
+    x = torch.ones(1, 80, length, dtype=torch.float64)
+    mask = torch.ones(1, 1, length, dtype=torch.float64)
+    mu, cond = torch.zeros_like(x), torch.zeros_like(x)
+    spks = torch.zeros(1, 80, dtype=torch.float64)
+    t_span = torch.linspace(0, 1, n_timesteps + 1, dtype=torch.float64)
+    return cfm.solve(x, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, solver=solver, cfg_strategy=cfg_strategy)
+
+
+def error(cfm, n_timesteps, solver):
+    return (solve(cfm, n_timesteps, solver) - math.exp(-1)).abs().max().item()
+
+
+@pytest.mark.parametrize('solver,order', [('euler', 1), ('midpoint', 2), ('heun', 2), ('multistep', 2)])
+def test_solver_order(solver, order):
+    cfm = make_cfm(Estimator())
+    # halving the step divides the error by 2 ** order
+    ratio = error(cfm, 8, solver) / error(cfm, 16, solver)
+    assert 2 ** order * 0.75 < ratio < 2 ** order * 1.25
+
+
+def test_second_order_solvers_beat_euler():
+    cfm = make_cfm(Estimator())
+    for solver in ['midpoint', 'heun', 'multistep']:
+        assert error(cfm, 10, solver) < error(cfm, 10, 'euler') / 5
+
+
+@pytest.mark.parametrize('solver,calls', [('euler', 10), ('midpoint', 20), ('heun', 20), ('multistep', 10)])
+def test_solver_estimator_calls(solver, calls):
+    estimator = Estimator()
+    solve(make_cfm(estimator), 10, solver)
+    assert len(estimator.batches) == calls
+
+
+def test_default_solver_and_unknown_solver():
+    estimator = Estimator()
+    cfm = make_cfm(estimator, solver='heun')
+    solve(cfm, 5)
+    assert len(estimator.batches) == 10
+    with pytest.raises(ValueError):
+        solve(cfm, 5, solver='rk4')
+
+
+class GuidedEstimator(Estimator):
+    """dx/dt = mu, so the unconditional velocity is 0 and guidance scales the velocity by 1 + inference_cfg_rate."""
+
+    def forward(self, x, mask, mu, t, spks, cond, streaming=False):
+        self.batches.append(x.size(0))
+        return mu.clone()
+
+
+def guided(cfg_strategy, n_timesteps=4):
+    estimator = GuidedEstimator()
+    cfm = make_cfm(estimator, inference_cfg_rate=0.7)
+    x = torch.zeros(1, 80, 4, dtype=torch.float64)
+    mask = torch.ones(1, 1, 4, dtype=torch.float64)
+    mu = torch.ones_like(x)
+    spks = torch.zeros(1, 80, dtype=torch.float64)
+    t_span = torch.linspace(0, 1, n_timesteps + 1, dtype=torch.float64)
+    out = cfm.solve(x, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=torch.zeros_like(x), solver='euler', cfg_strategy=cfg_strategy)
+    return out.mean().item(), estimator.batches
+
+
+def test_cfg_schedule():
+    cfm = make_cfm(Estimator())
+    assert cfm.cfg_schedule(4) == ['full'] * 4
+    assert cfm.cfg_schedule(4, 'none') == ['none'] * 4
+    assert cfm.cfg_schedule(5, 'early') == ['full'] * 3 + ['none'] * 2
+    assert cfm.cfg_schedule(4, 'early:1') == ['full', 'none', 'none', 'none']
+    assert cfm.cfg_schedule(5, 'reuse') == ['full', 'reuse', 'full', 'reuse', 'full']
+    assert cfm.cfg_schedule(4, 'reuse:3') == ['full', 'reuse', 'reuse', 'full']
+    for cfg_strategy in ['half', 'full:2', 'early:x']:
+        with pytest.raises(ValueError):
+            cfm.cfg_schedule(4, cfg_strategy)
+
+
+@pytest.mark.parametrize('cfg_strategy,value,batches', [
+    ('full', 1.7, [2, 2, 2, 2]),
+    ('none', 1.0, [1, 1, 1, 1]),
+    ('early:1', 1.175, [2, 1, 1, 1]),
+    ('reuse', 1.7, [2, 1, 2, 1]),
+])
+def test_cfg_strategy_skips_the_unconditional_branch(cfg_strategy, value, batches):
+    # the torch estimator runs the conditional half alone on steps without a fresh unconditional velocity
+    assert guided(cfg_strategy) == (pytest.approx(value), batches)
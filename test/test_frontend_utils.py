@@ -0,0 +1,66 @@
+import pytest
+
+from cosyvoice.utils.frontend_utils import split_paragraph
+
+ZH_TEXT = '今天天气很好，我们一起去公园散步吧，顺便看看湖边的风景。我们还可以去喝杯咖啡。'
+
+
+def test_split_paragraph_keeps_sentences_together():
+    assert split_paragraph(ZH_TEXT, str.split) == [ZH_TEXT]
+
+
+def test_split_paragraph_appends_final_punctuation():
+    assert split_paragraph('今天天气很好', str.split) == ['今天天气很好。']
+    assert split_paragraph('Nice weather today', str.split, lang='en') == ['Nice weather today.']
+
+
+def test_first_clause_is_cut_to_first_max_n():
+    segments = split_paragraph(ZH_TEXT, str.split, first_max_n=8, first_min_n=3)
+    assert segments[0] == '今天天气很好，'
+    # later segments grow again, the short last sentence is merged into the one before
+    assert segments[1:] == ['我们一起去公园散步吧，顺便看看湖边的风景。我们还可以去喝杯咖啡。']
+
+
+def test_first_clause_is_not_cut_without_a_break_within_first_max_n():
+    text = '我们一起去公园散步吧，顺便看看湖边的风景。'
+    assert split_paragraph(text, str.split, first_max_n=8, first_min_n=3) == [text]
+
+
+def test_first_clause_is_not_cut_below_first_min_n():
+    text = '好，我们一起去公园散步吧。'
+    assert split_paragraph(text, str.split, first_max_n=8, first_min_n=3) == [text]
+
+
+def test_short_first_sentence_is_its_own_segment():
+    segments = split_paragraph('你好。' + ZH_TEXT, str.split, first_max_n=8, first_min_n=3)
+    # the short first segment is never merged into, and the sentence after it is not cut
+    assert segments[0] == '你好。'
+    assert ''.join(segments) == '你好。' + ZH_TEXT
+
+
+def test_english_segments_are_measured_in_tokens():
+    text = 'One two three. Four five six. Seven eight.'
+    assert split_paragraph(text, str.split, lang='en', token_max_n=4, token_min_n=2, merge_len=2) == \
+        ['One two three.', ' Four five six.', ' Seven eight.']
+    # a last segment shorter than merge_len is merged into the one before
+    assert split_paragraph(text, str.split, lang='en', token_max_n=4, token_min_n=2, merge_len=3) == \
+        ['One two three.', ' Four five six. Seven eight.']
+
+
+def test_comma_split():
+    assert split_paragraph('今天天气很好，我们去散步。', str.split, token_max_n=4, token_min_n=2, merge_len=0, comma_split=True) == \
+        ['今天天气很好，', '我们去散步。']
+
+
+def test_every_sentence_is_tokenized_once():
+    calls = []
+
+    def tokenize(text):
+        calls.append(text)
+        return text.split()
+
+    text = ' '.join('Sentence number {} is here.'.format(i) for i in range(50))
+    segments = split_paragraph(text, tokenize, lang='en', token_max_n=12, token_min_n=6, merge_len=3)
+    assert ''.join(segments) == text
+    assert len(segments) > 1
+    assert len(calls) == 50
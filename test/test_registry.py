@@ -0,0 +1,137 @@
+import itertools
+from types import SimpleNamespace
+import pytest
+
+torch = pytest.importorskip('torch')
+registry_module = pytest.importorskip('cosyvoice.cli.registry')
+from cosyvoice.cli.registry import MemoryBudget, ModelRegistry, parse_models
+
+
+BUILT = []
+
+
+def fake_auto_model(components=None, **kwargs):
+    # components handed in are used as they are, the others are built and recorded
+    modules = dict(components or {})
+    for component, size in [('llm', 64), ('flow', 32), ('hift', 16)]:
+        if component not in modules:
+            BUILT.append((kwargs['model_dir'], component))
+            modules[component] = torch.nn.Linear(size, size)
+            if component == 'llm' and kwargs.get('load_vllm'):
+                modules[component].vllm_memory = 1 << 20
+    return SimpleNamespace(model=SimpleNamespace(degeneration_count={}, **modules))
+
+
+def module_bytes(module):
+    return sum(p.nbytes for p in module.parameters())
+
+
+MODEL_BYTES = sum(module_bytes(torch.nn.Linear(n, n)) for n in (64, 32, 16))
+HIFT_BYTES = module_bytes(torch.nn.Linear(16, 16))
+
+
+@pytest.fixture(autouse=True)
+def fake_models(monkeypatch):
+    monkeypatch.setattr(registry_module, 'AutoModel', fake_auto_model)
+    # a strictly increasing clock, so the least recently used model is never a tie
+    ticks = itertools.count()
+    monkeypatch.setattr(registry_module, 'time', SimpleNamespace(time=lambda: float(next(ticks))))
+
+
+def make_model_dir(tmp_path, name, hift=None):
+    model_dir = tmp_path / name
+    model_dir.mkdir()
+    (model_dir / 'cosyvoice2.yaml').write_text('')
+    for component in ['llm', 'flow', 'hift']:
+        content = hift if component == 'hift' and hift is not None else '{} {}'.format(model_dir, component)
+        (model_dir / '{}.pt'.format(component)).write_text(content)
+    return str(model_dir)
+
+
+def make_registry(tmp_path, names, memory_budget=0, **kwargs):
+    return ModelRegistry({name: make_model_dir(tmp_path, name) for name in names}, memory_budget=memory_budget, **kwargs)
+
+
+def loaded(registry):
+    return sorted(name for name, entry in registry.entries.items() if entry.model is not None)
+
+
+def test_parse_models():
+    assert list(parse_models(' a=dir/a, b = dir/b=x ,').items()) == [('a', 'dir/a'), ('b', 'dir/b=x')]
+    assert len(parse_models('')) == 0
+
+
+def test_models_are_loaded_on_first_use(tmp_path):
+    models = []
+    registry = make_registry(tmp_path, ['a', 'b'], on_load=models.append)
+    assert registry.default == 'a' and loaded(registry) == []
+    assert registry.get(load=False) is None
+    model = registry.get()
+    assert models == [model] and registry.get('a') is model
+    assert loaded(registry) == ['a']
+    assert registry.model_memory('a') == (MODEL_BYTES, 0)
+
+
+def test_unknown_model(tmp_path):
+    registry = make_registry(tmp_path, ['a'])
+    with pytest.raises(KeyError):
+        registry.get('x')
+
+
+def test_identical_components_are_shared_and_counted_once(tmp_path):
+    registry = ModelRegistry()
+    registry.register('a', make_model_dir(tmp_path, 'a', hift='same hift'))
+    registry.register('b', make_model_dir(tmp_path, 'b', hift='same hift'))
+    a, b = registry.get('a'), registry.get('b')
+    assert a.model.hift is b.model.hift
+    # the shared hift is never built for b
+    assert [component for model_dir, component in BUILT if model_dir == registry.entries['b'].kwargs['model_dir']] == ['llm', 'flow']
+    assert a.model.flow is not b.model.flow
+    assert registry.model_memory('b') == (MODEL_BYTES, HIFT_BYTES)
+    assert registry.total_memory() == 2 * MODEL_BYTES - HIFT_BYTES
+
+
+def test_vllm_memory_is_counted(tmp_path):
+    registry = ModelRegistry()
+    registry.register('a', make_model_dir(tmp_path, 'a'), load_vllm=True)
+    registry.get('a')
+    assert registry.total_memory() == MODEL_BYTES + (1 << 20)
+
+
+def test_least_recently_used_model_is_unloaded(tmp_path):
+    registry = make_registry(tmp_path, ['a', 'b', 'c'], memory_budget=2 * MODEL_BYTES)
+    registry.get('a')
+    registry.get('b')
+    registry.get('a')
+    registry.get('c')
+    assert loaded(registry) == ['a', 'c']
+    # an unloaded model is loaded again on its next request
+    registry.get('b')
+    assert loaded(registry) == ['b', 'c']
+
+
+def test_model_in_flight_is_never_unloaded(tmp_path):
+    registry = make_registry(tmp_path, ['a', 'b', 'c'], memory_budget=2 * MODEL_BYTES)
+    with registry.use('a'):
+        registry.get('b')
+        registry.get('c')
+        assert loaded(registry) == ['a', 'c']
+    assert registry.entries['a'].in_flight == 0 and registry.entries['a'].requests == 1
+
+
+def test_budget_over_every_model_in_flight_keeps_them(tmp_path):
+    registry = make_registry(tmp_path, ['a', 'b'], memory_budget=MODEL_BYTES)
+    with registry.use('a'), registry.use('b'):
+        assert loaded(registry) == ['a', 'b']
+
+
+def test_shared_budget_evicts_across_registries(tmp_path):
+    budget = MemoryBudget(2 * MODEL_BYTES)
+    first = ModelRegistry({'a': make_model_dir(tmp_path, 'a')}, memory_budget=budget)
+    second = ModelRegistry({'b': make_model_dir(tmp_path, 'b'), 'c': make_model_dir(tmp_path, 'c')}, memory_budget=budget)
+    first.get('a')
+    second.get('b')
+    assert budget.used() == 2 * MODEL_BYTES
+    second.get('c')
+    assert loaded(first) == [] and loaded(second) == ['b', 'c']
+    assert budget.used() == 2 * MODEL_BYTES
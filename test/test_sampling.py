@@ -0,0 +1,63 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+from cosyvoice.utils.common import SamplingWindow, batch_ras_sampling
+
+
+def test_sampling_window_keeps_the_last_tokens():
+    window = SamplingWindow(2, 3)
+    assert torch.equal(window.tokens, torch.full((2, 3), -1))
+    window.append(torch.tensor([1, 5]))
+    assert window.tokens.tolist() == [[-1, -1, 1], [-1, -1, 5]]
+    for i in range(2, 5):
+        window.append(torch.tensor([i, i + 4]))
+    assert window.tokens.tolist() == [[2, 3, 4], [6, 7, 8]]
+
+
+def test_top_k_one_samples_the_argmax():
+    torch.manual_seed(0)
+    scores = torch.randn(8, 50)
+    window = SamplingWindow(8, 10).tokens
+    ids = batch_ras_sampling(scores, window, top_p=1.0, top_k=1, win_size=10, tau_r=0.1)
+    assert torch.equal(ids, scores.argmax(dim=1))
+
+
+def test_per_row_params():
+    torch.manual_seed(0)
+    scores = torch.randn(2, 50)
+    window = SamplingWindow(2, 10).tokens
+    ids = batch_ras_sampling(scores, window, top_p=1.0, top_k=torch.tensor([1, 1]), win_size=torch.tensor([10, 5]), tau_r=0.1)
+    assert torch.equal(ids, scores.argmax(dim=1))
+
+
+def test_repeated_token_falls_back_to_random_sampling():
+    torch.manual_seed(0)
+    # a flat distribution, the nucleus of one is always id 0
+    scores = torch.zeros(200, 10)
+    window = SamplingWindow(200, 10)
+    assert (batch_ras_sampling(scores, window.tokens, top_p=1.0, top_k=1, win_size=10, tau_r=0.1) == 0).all()
+    # every row now repeats id 0 past win_size * tau_r, they sample the full distribution instead
+    window.append(torch.zeros(200, dtype=torch.long))
+    ids = batch_ras_sampling(scores, window.tokens, top_p=1.0, top_k=1, win_size=10, tau_r=0.1)
+    assert (ids != 0).sum() > 150
+
+
+def test_only_the_last_win_size_tokens_count_as_repeats():
+    torch.manual_seed(0)
+    scores = torch.zeros(200, 10)
+    window = torch.full((200, 10), -1)
+    window[:, 0] = 0
+    ids = batch_ras_sampling(scores, window, top_p=1.0, top_k=1, win_size=5, tau_r=0.1)
+    assert (ids == 0).all()
+
+
+def test_ignore_eos_rows_never_sample_eos():
+    torch.manual_seed(0)
+    scores = torch.zeros(200, 10)
+    scores[:, 9] = 20
+    window = SamplingWindow(200, 10).tokens
+    ignore_eos = torch.arange(200) % 2 == 0
+    ids = batch_ras_sampling(scores, window, top_p=0.8, top_k=25, win_size=10, tau_r=0.1, ignore_eos=ignore_eos, eos_start=8)
+    # the nucleus of those rows is only eos, they fall back to the speech ids of the full distribution
+    assert (ids[ignore_eos] < 8).all()
+    assert (ids[~ignore_eos] == 9).all()
@@ -0,0 +1,80 @@
+from types import SimpleNamespace
+import pytest
+
+from cosyvoice.utils import stream_utils
+from cosyvoice.utils.stream_utils import StreamHopScheduler
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=0.0)
+    monkeypatch.setattr(stream_utils, 'time', SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def make_scheduler():
+    # one unit of tokens is one second of audio
+    return StreamHopScheduler(unit=25, max_multiple=4, token_rate=25, safety=0.5, smoothing=0.5)
+
+
+def test_first_hops_are_one_unit(clock):
+    scheduler = make_scheduler()
+    assert scheduler.hop_len() == 25
+    assert scheduler.buffered_sec() == 0
+    # the first chunk waited for prefill, it does not give an rtf yet
+    clock.now = 3.0
+    scheduler.update(25)
+    assert scheduler.rtf is None
+    assert scheduler.hop_len() == 25
+
+
+def test_fast_producer_grows_the_hop_up_to_max_multiple(clock):
+    scheduler = make_scheduler()
+    scheduler.update(25)
+    clock.now = 0.1
+    scheduler.update(25)
+    assert scheduler.rtf == pytest.approx(0.1)
+    assert scheduler.buffered_sec() == pytest.approx(1.9)
+    assert scheduler.hop_len() == 100
+
+
+def test_hop_fits_the_buffer(clock):
+    scheduler = make_scheduler()
+    scheduler.update(25)
+    clock.now = 0.25
+    scheduler.update(25)
+    # the budget is half of the 1.75s buffered, three units take 0.75s at rtf 0.25 and four take 1s
+    assert scheduler.hop_len() == 75
+
+
+def test_slow_producer_stays_at_one_unit(clock):
+    scheduler = make_scheduler()
+    scheduler.update(25)
+    clock.now = 1.5
+    scheduler.update(25)
+    assert scheduler.rtf == pytest.approx(1.5)
+    assert scheduler.hop_len() == 25
+
+
+def test_drained_buffer_shrinks_the_hop(clock):
+    scheduler = make_scheduler()
+    scheduler.update(25)
+    clock.now = 0.1
+    scheduler.update(25)
+    assert scheduler.hop_len() == 100
+    # the 2s sent since the first chunk have played out
+    clock.now = 2.0
+    assert scheduler.buffered_sec() == pytest.approx(0.0)
+    assert scheduler.hop_len() == 25
+
+
+def test_rtf_is_smoothed(clock):
+    scheduler = make_scheduler()
+    scheduler.update(25)
+    clock.now = 0.1
+    scheduler.update(25)
+    clock.now = 2.1
+    scheduler.update(50)
+    # the new chunk took 2s for 2s of audio, rtf 1 blended half and half with 0.1
+    assert scheduler.rtf == pytest.approx(0.55)
+    assert scheduler.audio_sec == pytest.approx(4.0)
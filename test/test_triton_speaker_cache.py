@@ -0,0 +1,218 @@
+import importlib.util
+import os
+import sys
+import types
+from collections import OrderedDict
+import pytest
+
+torch = pytest.importorskip('torch')
+np = pytest.importorskip('numpy')
+
+TRITON_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'runtime', 'triton_trtllm')
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope='module')
+def token2wav():
+    for name in ('torchaudio', 'onnxruntime', 's3tokenizer', 'datasets', 'flashcosyvoice'):
+        pytest.importorskip(name)
+    return load_module('triton_token2wav', os.path.join(TRITON_DIR, 'token2wav.py'))
+
+
+@pytest.fixture
+def bls_model(monkeypatch):
+    for name in ('torchaudio', 'transformers', 'matcha'):
+        pytest.importorskip(name)
+    # the BLS model only needs pb_utils inside execute, a bare module is enough to import it on CPU
+    monkeypatch.setitem(sys.modules, 'triton_python_backend_utils', types.ModuleType('triton_python_backend_utils'))
+    return load_module('triton_cosyvoice2_model', os.path.join(TRITON_DIR, 'model_repo', 'cosyvoice2', '1', 'model.py'))
+
+
+def make_token2wav(token2wav, speaker_cache_size):
+    # the prompt feature extractors are replaced by tiny random modules, each call records its batch size
+    model = token2wav.CosyVoice2_Token2Wav.__new__(token2wav.CosyVoice2_Token2Wav)
+    torch.nn.Module.__init__(model)
+    model.speaker_cache = token2wav.SpeakerCache(speaker_cache_size)
+    model.spk = torch.nn.Linear(16, 4)
+    model.mel = torch.nn.Linear(4, 3)
+    model.batches = []
+
+    def prompt_audio_tokenization(audios):
+        model.batches.append(len(audios))
+        return [(audio[:8].abs() * 100).long().tolist() for audio in audios]
+
+    @torch.no_grad()
+    def get_spk_emb(audios):
+        return torch.stack([model.spk(audio[:16]) for audio in audios])
+
+    @torch.no_grad()
+    def get_prompt_mels(audios, sample_rates):
+        mels = [model.mel(audio.reshape(-1, 4)) for audio in audios]
+        return torch.nn.utils.rnn.pad_sequence(mels, batch_first=True), torch.tensor([mel.shape[0] for mel in mels])
+
+    model.prompt_audio_tokenization = prompt_audio_tokenization
+    model.get_spk_emb = get_spk_emb
+    model.get_prompt_mels = get_prompt_mels
+    return model
+
+
+def assert_same_features(a, b):
+    assert a[0] == b[0]
+    assert torch.equal(a[1], b[1])
+    assert torch.equal(a[2], b[2])
+    assert torch.equal(a[3], b[3])
+
+
+def test_speaker_cache_counts_hits_and_misses(token2wav):
+    model = make_token2wav(token2wav, 8)
+    a, b = torch.randn(32), torch.randn(40)
+    first = model.get_prompt_features([a, b], [16000, 16000])
+    assert (model.speaker_cache.hits, model.speaker_cache.misses) == (0, 2)
+    second = model.get_prompt_features([a, b], [16000, 16000])
+    assert (model.speaker_cache.hits, model.speaker_cache.misses) == (2, 2)
+    assert model.batches == [2]
+    assert_same_features(first, second)
+
+
+def test_speaker_cache_matches_uncached_features(token2wav):
+    model = make_token2wav(token2wav, 8)
+    a, b = torch.randn(32), torch.randn(40)
+    model.get_prompt_features([a], [16000])
+    # a from the cache, b computed, padded together
+    mixed = model.get_prompt_features([b, a], [16000, 16000])
+    model.speaker_cache = token2wav.SpeakerCache(0)
+    assert_same_features(mixed, model.get_prompt_features([b, a], [16000, 16000]))
+
+
+def test_speaker_cache_sample_rate_is_part_of_the_key(token2wav):
+    model = make_token2wav(token2wav, 8)
+    a = torch.randn(32)
+    model.get_prompt_features([a], [16000])
+    model.get_prompt_features([a], [24000])
+    assert model.batches == [1, 1]
+
+
+def test_speaker_cache_computes_a_repeated_prompt_once(token2wav):
+    model = make_token2wav(token2wav, 8)
+    a, b = torch.randn(32), torch.randn(40)
+    tokens, mels, mels_lens, spk_emb = model.get_prompt_features([a, b, a], [16000, 16000, 16000])
+    assert model.batches == [2]
+    assert tokens[0] == tokens[2]
+    assert torch.equal(mels[0], mels[2]) and mels_lens[0] == mels_lens[2]
+    assert torch.equal(spk_emb[0], spk_emb[2])
+    assert len(model.speaker_cache.cache) == 2
+
+
+def test_speaker_cache_evicts_least_recently_used(token2wav):
+    model = make_token2wav(token2wav, 2)
+    a, b, c = torch.randn(32), torch.randn(36), torch.randn(40)
+    model.get_prompt_features([a], [16000])
+    model.get_prompt_features([b], [16000])
+    # a becomes the most recently used, so c evicts b
+    model.get_prompt_features([a], [16000])
+    model.get_prompt_features([c], [16000])
+    assert list(model.speaker_cache.cache.keys()) == [token2wav.SpeakerCache.key(a, 16000), token2wav.SpeakerCache.key(c, 16000)]
+    model.get_prompt_features([b], [16000])
+    assert model.batches == [1, 1, 1, 1]
+
+
+def test_speaker_cache_size_zero_disables_caching(token2wav):
+    model = make_token2wav(token2wav, 0)
+    a = torch.randn(32)
+    first = model.get_prompt_features([a], [16000])
+    second = model.get_prompt_features([a], [16000])
+    assert model.batches == [1, 1]
+    assert len(model.speaker_cache.cache) == 0
+    assert model.speaker_cache.hits == 0
+    assert_same_features(first, second)
+
+
+class Tensor:
+    """A pb_utils.Tensor stand-in, the BLS model only reads it with as_numpy."""
+
+    def __init__(self, array):
+        self.array = array
+
+    def as_numpy(self):
+        return self.array
+
+
+def make_bls_model(bls_model, speaker_cache_size):
+    # the tokenizer, speaker embedding and mel calls are replaced by counting stubs
+    model = bls_model.TritonPythonModel.__new__(bls_model.TritonPythonModel)
+    model.device = torch.device('cpu')
+    model.speaker_cache = OrderedDict()
+    model.speaker_cache_size = speaker_cache_size
+    model.calls = []
+
+    def forward_audio_tokenizer(wav, wav_len):
+        model.calls.append('tokenizer')
+        return torch.arange(50)
+
+    def forward_speaker_embedding(wav):
+        model.calls.append('embedding')
+        return torch.randn(1, 192)
+
+    def _extract_speech_feat(speech):
+        model.calls.append('mel')
+        return torch.randn(1, speech.shape[1] // 480, 80)
+
+    model.forward_audio_tokenizer = forward_audio_tokenizer
+    model.forward_speaker_embedding = forward_speaker_embedding
+    model._extract_speech_feat = _extract_speech_feat
+    return model
+
+
+def make_wav(seed, num_samples=16000, padding=800):
+    # a padded batch of one, the samples past wav_len are not part of the prompt
+    rng = np.random.default_rng(seed)
+    wav = np.zeros((1, num_samples + padding), dtype=np.float32)
+    wav[:, :num_samples] = rng.standard_normal(num_samples)
+    return Tensor(wav), Tensor(np.array([[num_samples]], dtype=np.int32))
+
+
+def test_bls_prompt_of_a_repeated_wav_is_computed_once(bls_model):
+    model = make_bls_model(bls_model, 8)
+    tokens, feat, embedding = model.get_prompt(*make_wav(0))
+    assert tokens.shape == (1, 25) and feat.shape == (1, 50, 80) and feat.dtype == torch.float16
+    # the same samples with different padding, as another request sends them, are a hit
+    wav, wav_len = make_wav(0)
+    wav.array = np.concatenate([wav.array, np.ones((1, 160), dtype=np.float32)], axis=1)
+    again = model.get_prompt(wav, wav_len)
+    assert all(x is y for x, y in zip(again, (tokens, feat, embedding)))
+    assert model.calls == ['tokenizer', 'mel', 'embedding']
+
+
+def test_bls_prompt_of_a_new_wav_is_a_miss(bls_model):
+    model = make_bls_model(bls_model, 8)
+    model.get_prompt(*make_wav(0))
+    model.get_prompt(*make_wav(1))
+    assert model.calls.count('tokenizer') == 2 and len(model.speaker_cache) == 2
+
+
+def test_bls_prompt_evicts_least_recently_used(bls_model):
+    model = make_bls_model(bls_model, 2)
+    a, b, c = [make_wav(seed) for seed in range(3)]
+    cached_a = model.get_prompt(*a)
+    model.get_prompt(*b)
+    model.get_prompt(*a)
+    # a is the most recently used, so c evicts b
+    model.get_prompt(*c)
+    assert model.get_prompt(*a)[0] is cached_a[0]
+    assert model.calls.count('tokenizer') == 3
+    model.get_prompt(*b)
+    assert model.calls.count('tokenizer') == 4 and len(model.speaker_cache) == 2
+
+
+def test_bls_prompt_cache_size_zero_disables_caching(bls_model):
+    model = make_bls_model(bls_model, 0)
+    model.get_prompt(*make_wav(0))
+    model.get_prompt(*make_wav(0))
+    assert model.calls.count('tokenizer') == 2
+    assert len(model.speaker_cache) == 0
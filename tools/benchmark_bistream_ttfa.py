@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Time to first audio of streaming text input (bistream), run once per backend
+    python3 tools/benchmark_bistream_ttfa.py --model_dir pretrained_models/CosyVoice2-0.5B
+    python3 tools/benchmark_bistream_ttfa.py --model_dir pretrained_models/CosyVoice2-0.5B --load_vllm
+    text pieces are fed with --text_interval seconds in between to mimic an upstream text llm.
+"""
+import argparse
+import os
+import sys
+import time
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.utils.common import set_all_random_seed
+
+
+def text_generator(pieces, interval):
+    for piece in pieces:
+        time.sleep(interval)
+        yield piece
+
+
+def main():
+    if args.load_vllm:
+        from vllm import ModelRegistry
+        from cosyvoice.vllm.cosyvoice2 import CosyVoice2ForCausalLM
+        ModelRegistry.register_model("CosyVoice2ForCausalLM", CosyVoice2ForCausalLM)
+    cosyvoice = AutoModel(model_dir=args.model_dir, load_trt=args.load_trt, load_vllm=args.load_vllm, fp16=args.fp16)
+    pieces = args.tts_text.split('|')
+    # warmup
+    for _ in cosyvoice.inference_zero_shot(text_generator(pieces, 0), args.prompt_text, args.prompt_wav, stream=True):
+        pass
+    ttfa, total = [], []
+    for i in range(args.num_runs):
+        set_all_random_seed(i)
+        start_time, first_time = time.time(), None
+        for _ in cosyvoice.inference_zero_shot(text_generator(pieces, args.text_interval), args.prompt_text, args.prompt_wav, stream=True):
+            if first_time is None:
+                first_time = time.time()
+        ttfa.append(first_time - start_time)
+        total.append(time.time() - start_time)
+    print('{} ttfa {:.1f} ms, total {:.1f} ms over {} runs'.format('vllm' if args.load_vllm else 'huggingface',
+                                                                   sum(ttfa) / len(ttfa) * 1000, sum(total) / len(total) * 1000, args.num_runs))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='pretrained_models/CosyVoice2-0.5B')
+    parser.add_argument('--tts_text', type=str, default='收到好友从远方寄来的生日礼物，|那份意外的惊喜与深深的祝福|让我心中充满了甜蜜的快乐，|笑容如花儿般绽放。',
+                        help='text pieces separated by |')
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--prompt_wav', type=str, default='{}/../asset/zero_shot_prompt.wav'.format(ROOT_DIR))
+    parser.add_argument('--text_interval', type=float, default=0.1)
+    parser.add_argument('--num_runs', type=int, default=5)
+    parser.add_argument('--load_vllm', action='store_true')
+    parser.add_argument('--load_trt', action='store_true')
+    parser.add_argument('--fp16', action='store_true')
+    args = parser.parse_args()
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Cpu rtf of the torch model against the onnx cpu profile, fp32 and int8
+    python3 cosyvoice/bin/export_onnx.py --model_dir pretrained_models/CosyVoice2-0.5B --cpu --int8
+    python3 tools/benchmark_cpu_rtf.py --model_dir pretrained_models/CosyVoice2-0.5B --profiles torch,fp32,int8
+    every profile synthesizes the same text with the same seeds, save the audio with --output_dir to check int8 quality.
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import torch
+import torchaudio
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.utils.common import set_all_random_seed
+
+PROFILES = {'torch': {}, 'fp32': {'load_onnx_cpu': True}, 'int8': {'load_onnx_cpu': True, 'onnx_cpu_int8': True}}
+
+
+def run(cosyvoice, stream):
+    rtf, speech = [], []
+    for i in range(args.num_runs):
+        set_all_random_seed(i)
+        start_time, speech = time.time(), []
+        for model_output in cosyvoice.inference_zero_shot(args.tts_text, args.prompt_text, args.prompt_wav, stream=stream):
+            speech.append(model_output['tts_speech'])
+        speech = torch.concat(speech, dim=1)
+        rtf.append((time.time() - start_time) / (speech.shape[1] / cosyvoice.sample_rate))
+    return sum(rtf) / len(rtf), speech
+
+
+def main():
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    for profile in args.profiles.split(','):
+        cosyvoice = AutoModel(model_dir=args.model_dir, onnx_concurrent=args.onnx_concurrent, onnx_num_threads=args.onnx_num_threads,
+                              onnx_cpu_num_threads=args.onnx_cpu_num_threads, **PROFILES[profile])
+        # warmup
+        for _ in cosyvoice.inference_zero_shot(args.tts_text, args.prompt_text, args.prompt_wav):
+            pass
+        for stream in [False, True] if args.stream else [False]:
+            rtf, speech = run(cosyvoice, stream)
+            print('profile {} stream {} rtf {:.3f} over {} runs'.format(profile, stream, rtf, args.num_runs))
+            if args.output_dir:
+                torchaudio.save('{}/{}_stream_{}.wav'.format(args.output_dir, profile, int(stream)), speech, cosyvoice.sample_rate)
+        del cosyvoice
+        gc.collect()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='pretrained_models/CosyVoice2-0.5B')
+    parser.add_argument('--tts_text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--prompt_wav', type=str, default='{}/../asset/zero_shot_prompt.wav'.format(ROOT_DIR))
+    parser.add_argument('--profiles', type=str, default='torch,fp32,int8', help='comma separated profiles of {}'.format(list(PROFILES.keys())))
+    parser.add_argument('--num_runs', type=int, default=3)
+    parser.add_argument('--num_threads', type=int, default=0, help='torch intra op threads, 0 keeps the torch default')
+    parser.add_argument('--onnx_concurrent', type=int, default=1, help='onnxruntime sessions per model, cores are split between them')
+    parser.add_argument('--onnx_num_threads', type=int, default=1, help='threads of every campplus and speech tokenizer session of the frontend')
+    parser.add_argument('--onnx_cpu_num_threads', type=int, default=0, help='threads of every flow and hift session, 0 splits the cores left by the frontend')
+    parser.add_argument('--stream', action='store_true', help='also measure streaming inference')
+    parser.add_argument('--output_dir', type=str, default='', help='save the audio of every profile to compare quality')
+    args = parser.parse_args()
+    main()
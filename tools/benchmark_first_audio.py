@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Time to first audio of sentence splitting with and without a short first segment
+    python3 tools/benchmark_first_audio.py --model_dir pretrained_models/CosyVoice2-0.5B --first_segment_max_n 0,15,25
+    every setting synthesizes the same text, 0 is the default split. the segments of every setting are printed, so the
+    artificial split points can be listened to in --output_dir.
+"""
+import argparse
+import os
+import sys
+import time
+import torch
+import torchaudio
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.utils.common import set_all_random_seed
+
+
+def run(cosyvoice, stream, first_max_n):
+    ttfa, total, speech = [], [], []
+    for i in range(args.num_runs):
+        set_all_random_seed(i)
+        start_time, first_time, speech = time.time(), None, []
+        for model_output in cosyvoice.inference_zero_shot(args.tts_text, args.prompt_text, args.prompt_wav, stream=stream, first_max_n=first_max_n):
+            if first_time is None:
+                first_time = time.time()
+            speech.append(model_output['tts_speech'])
+        ttfa.append(first_time - start_time)
+        total.append(time.time() - start_time)
+    return sum(ttfa) / len(ttfa), sum(total) / len(total), torch.concat(speech, dim=1)
+
+
+def main():
+    cosyvoice = AutoModel(model_dir=args.model_dir, load_trt=args.load_trt, fp16=args.fp16)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    # warmup
+    for _ in cosyvoice.inference_zero_shot(args.tts_text, args.prompt_text, args.prompt_wav):
+        pass
+    for first_max_n in [int(i) for i in args.first_segment_max_n.split(',')]:
+        segments = cosyvoice.frontend.text_normalize(args.tts_text, split=True, first_max_n=first_max_n)
+        print('first_segment_max_n {} segments {}'.format(first_max_n, segments))
+        for stream in [False, True] if args.stream else [False]:
+            ttfa, total, speech = run(cosyvoice, stream, first_max_n)
+            print('first_segment_max_n {} stream {} ttfa {:.1f} ms, total {:.1f} ms over {} runs'.format(
+                first_max_n, stream, ttfa * 1000, total * 1000, args.num_runs))
+            if args.output_dir:
+                torchaudio.save('{}/first_{}_stream_{}.wav'.format(args.output_dir, first_max_n, int(stream)), speech, cosyvoice.sample_rate)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='pretrained_models/CosyVoice2-0.5B')
+    parser.add_argument('--tts_text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。'
+                                                        '我们一起去公园散步吧，顺便看看湖边的风景，听说那里新开了一家咖啡店，味道非常不错。')
+    parser.add_argument('--prompt_text', type=str, default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--prompt_wav', type=str, default='{}/../asset/zero_shot_prompt.wav'.format(ROOT_DIR))
+    parser.add_argument('--first_segment_max_n', type=str, default='0,15,25', help='comma separated settings, 0 is the default split')
+    parser.add_argument('--num_runs', type=int, default=5)
+    parser.add_argument('--stream', action='store_true', help='also measure streaming inference')
+    parser.add_argument('--output_dir', type=str, default='', help='save the audio of every setting to check the joins')
+    parser.add_argument('--load_trt', action='store_true')
+    parser.add_argument('--fp16', action='store_true')
+    args = parser.parse_args()
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Flow matching classifier-free guidance schedule benchmark on cpu
+    CUDA_VISIBLE_DEVICES="" python3 tools/benchmark_flow_cfg.py --model_dir pretrained_models/Fun-CosyVoice3-0.5B \
+        --cfg_strategies full,early,early:3,reuse,none
+    the prompt speech tokens are decoded chunk by chunk, estimator rows counts every sample the estimator sees,
+    so a full cfg call counts 2 rows and a conditional only call counts 1.
+"""
+import argparse
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.utils.common import set_all_random_seed
+
+
+def run_chunk(cosyvoice, token, model_input, n_timesteps, cfg_strategy):
+    device = cosyvoice.model.device
+    flow = cosyvoice.model.flow
+    prompt_token, prompt_feat = model_input['flow_prompt_speech_token'], model_input['prompt_speech_feat']
+    kwargs = {'token': token.to(device),
+              'token_len': torch.tensor([token.shape[1]], dtype=torch.int32).to(device),
+              'prompt_token': prompt_token.to(device),
+              'prompt_token_len': torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(device),
+              'prompt_feat': prompt_feat.to(device),
+              'prompt_feat_len': torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(device),
+              'embedding': model_input['flow_embedding'].to(device),
+              'n_timesteps': n_timesteps,
+              'cfg_strategy': cfg_strategy}
+    if hasattr(flow, 'pre_lookahead_len'):
+        kwargs.update({'streaming': True, 'finalize': False})
+    else:
+        kwargs.update({'flow_cache': torch.zeros(1, 80, 0, 2)})
+    set_all_random_seed(0)
+    start_time = time.time()
+    mel, _ = flow.inference(**kwargs)
+    return mel, time.time() - start_time
+
+
+def main():
+    torch.set_num_threads(args.num_threads)
+    cosyvoice = AutoModel(model_dir=args.model_dir)
+    model_input = cosyvoice.frontend.frontend_zero_shot('', cosyvoice.frontend.text_normalize(args.prompt_text, split=False),
+                                                        args.prompt_wav, cosyvoice.sample_rate, '')
+    # resynthesize the prompt speech tokens, chunk size follows the streaming hop of the model
+    speech_token = model_input['flow_prompt_speech_token']
+    chunk_len = args.chunk_len if args.chunk_len > 0 else getattr(cosyvoice.model, 'token_hop_len', 25)
+    if hasattr(cosyvoice.model.flow, 'pre_lookahead_len'):
+        chunk_len += cosyvoice.model.flow.pre_lookahead_len
+    chunks = [speech_token[:, i: i + chunk_len] for i in range(0, speech_token.shape[1] - chunk_len + 1, chunk_len)]
+    assert len(chunks) > 0, 'prompt wav is too short for chunk_len {}'.format(chunk_len)
+
+    counter = {'calls': 0, 'rows': 0}
+
+    def count_estimator(module, inputs):
+        counter['calls'] += 1
+        counter['rows'] += inputs[0].shape[0]
+    cosyvoice.model.flow.decoder.estimator.register_forward_pre_hook(count_estimator)
+
+    references = [run_chunk(cosyvoice, chunk, model_input, args.n_timesteps, 'full')[0] for chunk in chunks]
+    print('{:<12} {:>8} {:>8} {:>12} {:>12}'.format('cfg', 'calls', 'rows', 'chunk_ms', 'mel_l1'))
+    for cfg_strategy in args.cfg_strategies.split(','):
+        counter['calls'], counter['rows'] = 0, 0
+        costs, distances = [], []
+        for _ in range(args.num_runs):
+            for chunk, reference in zip(chunks, references):
+                mel, cost = run_chunk(cosyvoice, chunk, model_input, args.n_timesteps, cfg_strategy)
+                costs.append(cost)
+                distances.append((mel - reference).abs().mean().item())
+        num_chunks = len(chunks) * args.num_runs
+        print('{:<12} {:>8.1f} {:>8.1f} {:>12.1f} {:>12.5f}'.format(cfg_strategy, counter['calls'] / num_chunks, counter['rows'] / num_chunks,
+                                                                    sum(costs) / num_chunks * 1000, sum(distances) / num_chunks))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='pretrained_models/Fun-CosyVoice3-0.5B')
+    parser.add_argument('--prompt_text', type=str, default='You are a helpful assistant.<|endofprompt|>希望你以后能够做的比我还好呦。')
+    parser.add_argument('--prompt_wav', type=str, default='{}/../asset/zero_shot_prompt.wav'.format(ROOT_DIR))
+    parser.add_argument('--cfg_strategies', type=str, default='full,early,reuse,none')
+    parser.add_argument('--n_timesteps', type=int, default=10)
+    parser.add_argument('--chunk_len', type=int, default=0, help='speech tokens per chunk, 0 means model token_hop_len')
+    parser.add_argument('--num_runs', type=int, default=3)
+    parser.add_argument('--num_threads', type=int, default=4)
+    args = parser.parse_args()
+    main()
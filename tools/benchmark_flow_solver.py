@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Flow matching quality versus latency benchmark
+    python3 tools/benchmark_flow_solver.py --model_dir pretrained_models/Fun-CosyVoice3-0.5B \
+        --solvers euler,midpoint,heun,multistep --n_timesteps 2,4,6,8,10
+    mel distance is the mean absolute difference against the 10 step euler reference on the same speech tokens.
+"""
+import argparse
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils.file_utils import logging
+
+
+def generate_speech_token(cosyvoice, model_input):
+    device = cosyvoice.model.device
+    set_all_random_seed(0)
+    llm_embedding = model_input['llm_embedding'] if cosyvoice.__class__.__name__ == 'CosyVoice' else torch.zeros(0, 192)
+    token_generator = cosyvoice.model.llm.inference(text=model_input['text'].to(device),
+                                                    text_len=torch.tensor([model_input['text'].shape[1]], dtype=torch.int32).to(device),
+                                                    prompt_text=model_input['prompt_text'].to(device),
+                                                    prompt_text_len=torch.tensor([model_input['prompt_text'].shape[1]], dtype=torch.int32).to(device),
+                                                    prompt_speech_token=model_input['llm_prompt_speech_token'].to(device),
+                                                    prompt_speech_token_len=torch.tensor([model_input['llm_prompt_speech_token'].shape[1]],
+                                                                                         dtype=torch.int32).to(device),
+                                                    embedding=llm_embedding.to(device),
+                                                    uuid='benchmark')
+    return torch.tensor([list(token_generator)], dtype=torch.int32)
+
+
+def run_flow(cosyvoice, token, model_input, n_timesteps, solver):
+    device = cosyvoice.model.device
+    flow = cosyvoice.model.flow
+    prompt_token, prompt_feat = model_input['flow_prompt_speech_token'], model_input['prompt_speech_feat']
+    kwargs = {'token': token.to(device),
+              'token_len': torch.tensor([token.shape[1]], dtype=torch.int32).to(device),
+              'prompt_token': prompt_token.to(device),
+              'prompt_token_len': torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(device),
+              'prompt_feat': prompt_feat.to(device),
+              'prompt_feat_len': torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(device),
+              'embedding': model_input['flow_embedding'].to(device),
+              'n_timesteps': n_timesteps,
+              'solver': solver}
+    if hasattr(flow, 'pre_lookahead_len'):
+        kwargs.update({'streaming': False, 'finalize': True})
+    else:
+        kwargs.update({'flow_cache': torch.zeros(1, 80, 0, 2)})
+    # CosyVoice flow samples fresh noise every call, fix the seed so every config starts from the same noise
+    set_all_random_seed(0)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start_time = time.time()
+    with torch.cuda.amp.autocast(cosyvoice.model.fp16):
+        mel, _ = flow.inference(**kwargs)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return mel, time.time() - start_time
+
+
+def main():
+    cosyvoice = AutoModel(model_dir=args.model_dir, load_trt=args.load_trt, fp16=args.fp16)
+    model_input = cosyvoice.frontend.frontend_zero_shot(cosyvoice.frontend.text_normalize(args.tts_text, split=False),
+                                                        cosyvoice.frontend.text_normalize(args.prompt_text, split=False),
+                                                        args.prompt_wav, cosyvoice.sample_rate, '')
+    token = generate_speech_token(cosyvoice, model_input)
+    logging.info('benchmark {} speech tokens'.format(token.shape[1]))
+
+    reference, _ = run_flow(cosyvoice, token, model_input, 10, 'euler')
+    audio_len = reference.shape[2] * cosyvoice.model.hift.f0_upsamp.scale_factor / cosyvoice.sample_rate
+    print('{:<10} {:>6} {:>12} {:>10} {:>8}'.format('solver', 'steps', 'mel_l1', 'flow_ms', 'rtf'))
+    for solver in args.solvers.split(','):
+        for n_timesteps in [int(i) for i in args.n_timesteps.split(',')]:
+            costs, mel = [], None
+            for _ in range(args.num_runs):
+                mel, cost = run_flow(cosyvoice, token, model_input, n_timesteps, solver)
+                costs.append(cost)
+            cost = sorted(costs)[len(costs) // 2]
+            distance = (mel - reference).abs().mean().item()
+            print('{:<10} {:>6} {:>12.5f} {:>10.1f} {:>8.4f}'.format(solver, n_timesteps, distance, cost * 1000, cost / audio_len))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='pretrained_models/Fun-CosyVoice3-0.5B')
+    parser.add_argument('--tts_text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--prompt_text', type=str, default='You are a helpful assistant.<|endofprompt|>希望你以后能够做的比我还好呦。')
+    parser.add_argument('--prompt_wav', type=str, default='{}/../asset/zero_shot_prompt.wav'.format(ROOT_DIR))
+    parser.add_argument('--solvers', type=str, default='euler,midpoint,heun,multistep')
+    parser.add_argument('--n_timesteps', type=str, default='2,4,6,8,10')
+    parser.add_argument('--num_runs', type=int, default=3)
+    parser.add_argument('--load_trt', action='store_true')
+    parser.add_argument('--fp16', action='store_true')
+    args = parser.parse_args()
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" LLM decode throughput, dynamic huggingface cache versus preallocated static kv cache, with and without the prompt prefix
+    kv cache. the prefix cache stats report the prefill time saved net of copying the cached prefix.
+    CUDA_VISIBLE_DEVICES="" python3 tools/benchmark_llm_decode.py --model_dir pretrained_models/Fun-CosyVoice3-0.5B --compile
+"""
+import argparse
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.utils.common import set_all_random_seed
+
+
+def decode(cosyvoice, model_input):
+    device = cosyvoice.model.device
+    set_all_random_seed(0)
+    start_time = time.time()
+    with torch.cuda.amp.autocast(cosyvoice.model.fp16):
+        tokens = list(cosyvoice.model.llm.inference(text=model_input['text'].to(device),
+                                                    text_len=torch.tensor([model_input['text'].shape[1]], dtype=torch.int32).to(device),
+                                                    prompt_text=model_input['prompt_text'].to(device),
+                                                    prompt_text_len=torch.tensor([model_input['prompt_text'].shape[1]], dtype=torch.int32).to(device),
+                                                    prompt_speech_token=model_input['llm_prompt_speech_token'].to(device),
+                                                    prompt_speech_token_len=torch.tensor([model_input['llm_prompt_speech_token'].shape[1]],
+                                                                                         dtype=torch.int32).to(device),
+                                                    embedding=torch.zeros(0, 192).to(device),
+                                                    uuid='benchmark'))
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return tokens, time.time() - start_time
+
+
+def report(name, cosyvoice, model_input):
+    # first run warms up kernels and torch.compile
+    decode(cosyvoice, model_input)
+    num_tokens, cost = 0, 0
+    for _ in range(args.num_runs):
+        tokens, this_cost = decode(cosyvoice, model_input)
+        num_tokens, cost = num_tokens + len(tokens), cost + this_cost
+    print('{:<10} {:>8} tokens {:>10.2f} tokens/s'.format(name, num_tokens // args.num_runs, num_tokens / cost))
+
+
+def main():
+    torch.set_num_threads(args.num_threads)
+    cosyvoice = AutoModel(model_dir=args.model_dir, fp16=args.fp16)
+    assert cosyvoice.__class__.__name__ != 'CosyVoice', 'static kv cache decode is implemented for Qwen2 based CosyVoice2/3'
+    model_input = cosyvoice.frontend.frontend_zero_shot(cosyvoice.frontend.text_normalize(args.tts_text, split=False),
+                                                        cosyvoice.frontend.text_normalize(args.prompt_text, split=False),
+                                                        args.prompt_wav, cosyvoice.sample_rate, '')
+    prefix_cache_size = cosyvoice.model.llm.prefix_cache_size
+    cosyvoice.model.llm.prefix_cache_size = 0
+    report('no_prefix', cosyvoice, model_input)
+    cosyvoice.model.llm.prefix_cache_size = prefix_cache_size
+    report('dynamic', cosyvoice, model_input)
+    print('prefix cache {}, min prefix len {}'.format(cosyvoice.model.llm.prefix_cache_stats, cosyvoice.model.llm.prefix_cache_min_len))
+    cosyvoice.model.load_static_decode(compile=args.compile)
+    report('static', cosyvoice, model_input)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='pretrained_models/Fun-CosyVoice3-0.5B')
+    parser.add_argument('--tts_text', type=str, default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--prompt_text', type=str, default='You are a helpful assistant.<|endofprompt|>希望你以后能够做的比我还好呦。')
+    parser.add_argument('--prompt_wav', type=str, default='{}/../asset/zero_shot_prompt.wav'.format(ROOT_DIR))
+    parser.add_argument('--num_runs', type=int, default=3)
+    parser.add_argument('--num_threads', type=int, default=4)
+    parser.add_argument('--compile', action='store_true', help='torch.compile the static decode step')
+    parser.add_argument('--fp16', action='store_true')
+    args = parser.parse_args()
+    main()
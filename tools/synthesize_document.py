@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# Copyright (c) 2024 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Long form synthesis of a text document into one wav
+    python3 tools/synthesize_document.py --model_dir pretrained_models/Fun-CosyVoice3-0.5B \
+        --document chapter1.txt --output chapter1.wav
+    paragraphs are separated by blank lines, progress is checkpointed to chapter1.wav.json after every sentence,
+    running the same command again resumes from the last finished sentence.
+"""
+import argparse
+import os
+import sys
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/..'.format(ROOT_DIR))
+sys.path.append('{}/../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.cli.longform import LongFormSynthesizer
+
+
+def main():
+    cosyvoice = AutoModel(model_dir=args.model_dir, load_trt=args.load_trt, load_vllm=args.load_vllm, fp16=args.fp16)
+    if args.text_pool_workers > 0:
+        cosyvoice.frontend.start_text_pool(num_workers=args.text_pool_workers)
+    synthesizer = LongFormSynthesizer(cosyvoice, args.prompt_text, args.prompt_wav, instruct_text=args.instruct_text, lookahead=args.lookahead,
+                                      crossfade=args.crossfade, paragraph_pause=args.paragraph_pause,
+                                      n_timesteps=args.n_timesteps, solver=args.solver, cfg_strategy=args.cfg_strategy)
+    with open(args.document, 'r', encoding='utf8') as f:
+        document = f.read()
+    manifest = synthesizer.synthesize(document, args.output, args.manifest)
+    print('{} sentences, {:.1f}s of audio written to {}'.format(manifest['sentences'], manifest['frames'] / manifest['sample_rate'], args.output))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='pretrained_models/Fun-CosyVoice3-0.5B')
+    parser.add_argument('--document', type=str, required=True, help='utf8 text file, paragraphs separated by blank lines')
+    parser.add_argument('--output', type=str, required=True)
+    parser.add_argument('--manifest', type=str, default=None, help='checkpoint manifest, default <output>.json')
+    parser.add_argument('--prompt_text', type=str, default='You are a helpful assistant.<|endofprompt|>希望你以后能够做的比我还好呦。')
+    parser.add_argument('--prompt_wav', type=str, default='{}/../asset/zero_shot_prompt.wav'.format(ROOT_DIR))
+    parser.add_argument('--instruct_text', type=str, default='', help='use instruct2 mode with this instruction')
+    parser.add_argument('--lookahead', type=int, default=2, help='sentences synthesized ahead of the one being written, decoded as one batch with --load_vllm, capped at 1 without')
+    parser.add_argument('--crossfade', type=float, default=0.05, help='crossfade seconds between sentences of a paragraph')
+    parser.add_argument('--paragraph_pause', type=float, default=0.4, help='silence seconds between paragraphs')
+    parser.add_argument('--n_timesteps', type=int, default=10)
+    parser.add_argument('--solver', type=str, default=None)
+    parser.add_argument('--cfg_strategy', type=str, default=None)
+    parser.add_argument('--text_pool_workers', type=int, default=0)
+    parser.add_argument('--load_trt', action='store_true')
+    parser.add_argument('--load_vllm', action='store_true')
+    parser.add_argument('--fp16', action='store_true')
+    args = parser.parse_args()
+    main()